@@ -0,0 +1,502 @@
+# api_server.py - Headless OpenAI-compatible HTTP API for CodeBuddy models
+#
+# Usage:
+#   python api_server.py [--host 127.0.0.1] [--port 8000] [--max-concurrency 1] [--max-pending 16]
+#   python api_server.py --replicas 4 --preload python   # 4 CPU worker processes
+#   python api_server.py --stub --stub-tokens-per-sec 50  # fake model, for load tests
+#
+# Endpoints:
+#   GET  /health                Readiness, queue depth and loaded models
+#   GET  /v1/models             Languages that can be requested as `model`
+#   POST /v1/chat/completions   `messages` -> the manager's chat prompt format
+#   POST /v1/completions        `prompt` -> the language's prompt template
+#
+# With --memory-debug (in-process manager only):
+#   GET  /debug/memory          Host RSS, device memory, top Python allocators
+#   POST /debug/memory/record   {"requests": N, "python": bool} record the next N requests
+#   POST /debug/memory/snapshot {"name": "x.pickle"} export allocator history now
+#
+# Both POST endpoints accept `"stream": true` for server-sent events,
+# `"best_of": N` to sample N candidates in one batch and return the one whose
+# code parses (not streamed: the answer arrives in one chunk), and, when
+# started with --training-dir, `"few_shot": N` to add the N most similar
+# saved training examples to the prompt. Requests
+# are queued fairly per session (X-Session-Id header or `user` field) and may
+# set `X-Priority: batch` to yield to interactive traffic. Responses carry the
+# time spent queued in X-Queue-Wait-Ms; a full queue answers 429 with Retry-After.
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from model_manager import MultiModelManager, MAX_BEST_OF, MAX_FEW_SHOT
+from example_index import ExampleIndex
+from replica_pool import ReplicaPool
+from stub_backend import stub_models_config
+from cancellation import CancellationToken, cancellation_metrics
+from request_queue import RequestQueue, QueueFull, INTERACTIVE, estimate_cost
+
+CACHE_DIR = "models"
+
+# Seconds between checks for a disconnected client while waiting on the model
+DISCONNECT_POLL_INTERVAL = 0.5
+
+# Marks the end of a generation on the queue between the inference thread and the event loop
+_DONE = object()
+
+
+def split_messages(messages):
+    """
+    Split OpenAI-style `messages` into the current message and the chat history
+
+    The last user message becomes the prompt; everything before it is passed
+    to `_format_chat_prompt` as history. System messages are dropped because
+    each prompt format supplies its own system prompt.
+
+    :param messages: List of {"role", "content"} dicts
+    :return: (current_message, chat_history)
+    """
+    if not isinstance(messages, list) or not messages:
+        raise ValueError("'messages' must be a non-empty list")
+
+    for i in range(len(messages) - 1, -1, -1):
+        if messages[i].get("role") == "user":
+            break
+    else:
+        raise ValueError("'messages' must contain a user message")
+
+    history = [
+        {"role": m.get("role"), "content": m.get("content") or ""}
+        for m in messages[:i] if m.get("role") in ("user", "assistant")
+    ]
+    return messages[i].get("content") or "", history
+
+
+class APIServer:
+    def __init__(self, model_manager, max_concurrency=1, max_pending=16, max_per_session=4,
+                 memory_debug=False):
+        """
+        OpenAI-compatible endpoints around a `MultiModelManager`
+
+        Generation runs on a dedicated inference thread pool; partial results
+        are handed to the event loop through an asyncio queue so the loop never
+        blocks on the model.
+
+        :param model_manager: Manager used to load models and generate
+        :param max_concurrency: Generations running at the same time
+        :param max_pending: Requests allowed to wait for a free slot before
+            new ones are rejected with 429
+        :param max_per_session: Requests one session may have queued or running
+        :param memory_debug: Serve the /debug/memory endpoints
+        """
+        self.model_manager = model_manager
+        self.memory_debug = memory_debug
+        self.request_queue = RequestQueue(max_concurrency, max_pending, max_per_session)
+        self.inference_pool = ThreadPoolExecutor(
+            max_workers=max_concurrency,
+            thread_name_prefix="inference"
+        )
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get("/health", self.health)
+        app.router.add_get("/v1/models", self.list_models)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/completions", self.completions)
+        if self.memory_debug:
+            app.router.add_get("/debug/memory", self.memory_summary)
+            app.router.add_post("/debug/memory/record", self.memory_record)
+            app.router.add_post("/debug/memory/snapshot", self.memory_snapshot)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    async def _on_cleanup(self, app):
+        self.inference_pool.shutdown(wait=False, cancel_futures=True)
+
+    ### Helpers
+
+    def _resolve_language(self, model, prompt):
+        """Map the request's `model` field to a configured language, detecting it if absent"""
+        if model and model.lower() in self.model_manager.models_config:
+            return model.lower()
+        return self.model_manager.detect_language(prompt)
+
+    def _count_tokens(self, language, text):
+        tokenizer = self.model_manager.loaded_tokenizers.get(language)
+        if tokenizer is None:
+            return None
+        return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def _run_generation(self, loop, queue, kwargs):
+        """Drive the `generate_code` generator on an inference thread"""
+        try:
+            for text in self.model_manager.generate_code(**kwargs):
+                if kwargs["cancel_token"].cancelled:
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, text)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, _DONE)
+
+    async def _generate(self, request, kwargs):
+        """
+        Yield cumulative response text from the inference pool without blocking the loop
+
+        Cancels the request's token as soon as the client disconnects.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        loop.run_in_executor(self.inference_pool, self._run_generation, loop, queue, kwargs)
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), DISCONNECT_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                if request.transport is None or request.transport.is_closing():
+                    kwargs["cancel_token"].cancel("client disconnected")
+                continue
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    @staticmethod
+    def _client_address(request):
+        """The original client's address, also behind `cluster_router.py` (which sets X-Forwarded-For)"""
+        forwarded = request.headers.get("X-Forwarded-For")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+        return request.remote
+
+    @staticmethod
+    def _error(status, message, error_type="invalid_request_error"):
+        return web.json_response({"error": {"message": message, "type": error_type}}, status=status)
+
+    async def _parse_request(self, request):
+        try:
+            body = await request.json()
+        except Exception:
+            raise ValueError("Request body must be JSON")
+        if not isinstance(body, dict):
+            raise ValueError("Request body must be a JSON object")
+        return body
+
+    @staticmethod
+    def _number(body, name, kind, default, minimum, exclusive=False):
+        """A numeric request field, or ValueError naming the field"""
+        value = body.get(name)
+        if value is None:
+            return default
+        try:
+            if isinstance(value, bool):
+                raise TypeError
+            number = kind(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"'{name}' must be {'an integer' if kind is int else 'a number'}")
+        if number < minimum or (exclusive and number == minimum):
+            raise ValueError(f"'{name}' must be {'greater than' if exclusive else 'at least'} {minimum}")
+        return number
+
+    def _generation_kwargs(self, body, prompt, history, language):
+        """Generation settings from a request body; raises ValueError for invalid fields"""
+        return {
+            "prompt": prompt,
+            "chat_history": history,
+            "language": language,
+            "temperature": self._number(body, "temperature", float, 0.2, 0, exclusive=True),
+            "max_new_tokens": self._number(body, "max_tokens", int, 1024, 1),
+            "repetition_penalty": self._number(body, "repetition_penalty", float, 1.1, 0, exclusive=True),
+            "stream": bool(body.get("stream", False)),
+            "best_of": min(self._number(body, "best_of", int, 1, 1), MAX_BEST_OF),
+            "few_shot": min(self._number(body, "few_shot", int, 0, 0), MAX_FEW_SHOT),
+        }
+
+    def _finish_reason(self, language, text, max_new_tokens):
+        """'length' when the response used the whole token budget (unknown without a local tokenizer)"""
+        tokens = self._count_tokens(language, text)
+        return "length" if tokens is not None and tokens >= max_new_tokens else "stop"
+
+    ### Endpoints
+
+    async def health(self, request):
+        """
+        Liveness, readiness and load, polled by `cluster_router.py`
+
+        A node is ready while it can queue another request without a 429.
+        """
+        queue = self.request_queue.stats()
+        return web.json_response({
+            "status": "ok",
+            "ready": queue["waiting"] < queue["max_depth"] or queue["running"] < queue["max_concurrency"],
+            "in_flight": queue["running"] + queue["waiting"],
+            "max_concurrency": queue["max_concurrency"],
+            "max_pending": queue["max_depth"],
+            "queue": queue,
+            "cancellation": (self.model_manager.cancellation_metrics()
+                             if hasattr(self.model_manager, "cancellation_metrics") else cancellation_metrics()),
+            "model_loading": (self.model_manager.load_metrics()
+                              if hasattr(self.model_manager, "load_metrics") else {}),
+            "loaded_models": sorted(self.model_manager.loaded_models),
+        })
+
+    async def memory_summary(self, request):
+        profiler = self.model_manager.memory_profiler
+        return web.json_response(await asyncio.to_thread(profiler.summary))
+
+    async def memory_record(self, request):
+        try:
+            body = await self._parse_request(request)
+            num_requests = int(body.get("requests", 1))
+            if num_requests < 1:
+                raise ValueError("'requests' must be at least 1")
+        except ValueError as e:
+            return self._error(400, str(e))
+        profiler = self.model_manager.memory_profiler
+        profiler.record_requests(num_requests, trace_python=bool(body.get("python", False)))
+        return web.json_response(profiler.summary()["recording"])
+
+    async def memory_snapshot(self, request):
+        try:
+            body = await self._parse_request(request)
+        except ValueError as e:
+            return self._error(400, str(e))
+        profiler = self.model_manager.memory_profiler
+        path = None
+        if body.get("name"):
+            # Only a file name: snapshots stay inside the profiler's output directory
+            path = os.path.join(profiler.output_dir, os.path.basename(str(body["name"])))
+        path = await asyncio.to_thread(profiler.export_snapshot, path)
+        if path is None:
+            return self._error(409, "No CUDA allocator history is being recorded; POST /debug/memory/record first")
+        return web.json_response({"path": path})
+
+    async def list_models(self, request):
+        created = int(time.time())
+        return web.json_response({
+            "object": "list",
+            "data": [
+                {
+                    "id": language,
+                    "object": "model",
+                    "created": created,
+                    "owned_by": config.get("model_name", "codebuddy"),
+                }
+                for language, config in self.model_manager.models_config.items()
+            ],
+        })
+
+    async def chat_completions(self, request):
+        try:
+            body = await self._parse_request(request)
+            prompt, history = split_messages(body.get("messages"))
+        except ValueError as e:
+            return self._error(400, str(e))
+        return await self._complete(request, body, prompt, history, chat=True)
+
+    async def completions(self, request):
+        try:
+            body = await self._parse_request(request)
+        except ValueError as e:
+            return self._error(400, str(e))
+        prompt = body.get("prompt")
+        if isinstance(prompt, list) and len(prompt) == 1:
+            prompt = prompt[0]
+        if not isinstance(prompt, str) or not prompt:
+            return self._error(400, "'prompt' must be a non-empty string")
+        return await self._complete(request, body, prompt, None, chat=False)
+
+    async def _complete(self, request, body, prompt, history, chat):
+        language = self._resolve_language(body.get("model"), prompt)
+        try:
+            kwargs = self._generation_kwargs(body, prompt, history, language)
+        except ValueError as e:
+            return self._error(400, str(e))
+        completion_id = ("chatcmpl-" if chat else "cmpl-") + uuid.uuid4().hex
+        kwargs["cancel_token"] = CancellationToken()
+
+        # Priority and session come from headers or the OpenAI `user` field
+        priority = request.headers.get("X-Priority") or body.get("priority") or INTERACTIVE
+        session_id = request.headers.get("X-Session-Id") or body.get("user") or self._client_address(request)
+        try:
+            ticket = self.request_queue.submit(
+                session_id, estimate_cost(prompt, kwargs["max_new_tokens"] * kwargs["best_of"], history), priority
+            )
+        except QueueFull as e:
+            return web.json_response(
+                {"error": {"message": str(e), "type": "rate_limit_error", "code": e.reason}},
+                status=429, headers={"Retry-After": str(e.retry_after)}
+            )
+        except ValueError as e:
+            return self._error(400, str(e))
+
+        try:
+            await ticket.wait_async()
+            headers = {"X-Queue-Wait-Ms": str(int(ticket.wait_time * 1000))}
+            if kwargs["stream"]:
+                return await self._stream_response(request, kwargs, completion_id, language, chat, headers)
+
+            text = ""
+            async for text in self._generate(request, kwargs):
+                pass
+            return web.json_response(self._completion_body(completion_id, language, chat, prompt, text,
+                                                            kwargs["max_new_tokens"]),
+                                     headers=headers)
+        except Exception as e:
+            print(f"Error during API generation: {e}")
+            return self._error(500, str(e), "server_error")
+        finally:
+            # No-op for finished generations; stops one whose handler was torn down
+            kwargs["cancel_token"].cancel("request ended")
+            self.request_queue.release(ticket)
+
+    def _completion_body(self, completion_id, language, chat, prompt, text, max_new_tokens):
+        prompt_tokens = self._count_tokens(language, prompt)
+        completion_tokens = self._count_tokens(language, text)
+        finish_reason = "length" if completion_tokens is not None and completion_tokens >= max_new_tokens else "stop"
+        if chat:
+            choice = {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}
+        else:
+            choice = {"index": 0, "text": text, "logprobs": None, "finish_reason": finish_reason}
+        body = {
+            "id": completion_id,
+            "object": "chat.completion" if chat else "text_completion",
+            "created": int(time.time()),
+            "model": language,
+            "choices": [choice],
+        }
+        if prompt_tokens is not None and completion_tokens is not None:
+            body["usage"] = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
+        return body
+
+    def _chunk(self, completion_id, language, chat, delta, finish_reason=None):
+        if chat:
+            choice = {"index": 0, "delta": delta, "finish_reason": finish_reason}
+        else:
+            choice = {"index": 0, "text": delta.get("content", ""), "logprobs": None,
+                      "finish_reason": finish_reason}
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk" if chat else "text_completion",
+            "created": int(time.time()),
+            "model": language,
+            "choices": [choice],
+        }
+
+    async def _stream_response(self, request, kwargs, completion_id, language, chat, headers):
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            **headers,
+        })
+        await response.prepare(request)
+
+        async def send(payload):
+            await response.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+
+        try:
+            if chat:
+                await send(self._chunk(completion_id, language, chat, {"role": "assistant"}))
+            sent = ""
+            async for text in self._generate(request, kwargs):
+                # Responses are cumulative and cleaned as a whole; only send what was appended
+                if not text.startswith(sent) or len(text) == len(sent):
+                    continue
+                await send(self._chunk(completion_id, language, chat, {"content": text[len(sent):]}))
+                sent = text
+            finish_reason = self._finish_reason(language, sent, kwargs["max_new_tokens"])
+            await send(self._chunk(completion_id, language, chat, {}, finish_reason=finish_reason))
+        except (ConnectionResetError, asyncio.CancelledError):
+            # Client went away; stop feeding tokens to it
+            kwargs["cancel_token"].cancel("client disconnected")
+            raise
+        except Exception as e:
+            print(f"Error during API streaming: {e}")
+            await send({"error": {"message": str(e), "type": "server_error"}})
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible HTTP API for CodeBuddy models")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="Model cache directory")
+    parser.add_argument("--max-concurrency", type=int, default=1,
+                        help="Generations running at the same time (one inference thread each)")
+    parser.add_argument("--max-pending", type=int, default=16,
+                        help="Requests allowed to queue for a free slot before returning 429")
+    parser.add_argument("--max-per-session", type=int, default=4,
+                        help="Requests one session (X-Session-Id, `user` or client address) may have in flight")
+    parser.add_argument("--performance-mode", choices=["balanced", "speed", "memory"], default="balanced")
+    parser.add_argument("--replicas", type=int, default=0,
+                        help="Run N inference worker processes pinned to disjoint CPU cores (0: in-process)")
+    parser.add_argument("--preload", nargs="*", default=[], help="Languages to load at start-up")
+    parser.add_argument("--training-dir", default=None,
+                        help="Training data directory to retrieve few-shot examples from (see example_index.py)")
+    parser.add_argument("--stub", action="store_true",
+                        help="Serve a deterministic fake model (stub_backend.py) to load-test the server")
+    parser.add_argument("--stub-tokens-per-sec", type=float, default=None)
+    parser.add_argument("--stub-ttft", type=float, default=None, help="Stub time to first token in seconds")
+    parser.add_argument("--stub-fail-every", type=int, default=None, help="Make every Nth stub generation fail")
+    parser.add_argument("--compile", action="store_true",
+                        help="Decode through torch.compile with a static KV cache (warms up at model load)")
+    parser.add_argument("--memory-debug", action="store_true",
+                        help="Serve /debug/memory endpoints for on-demand memory profiling")
+    parser.add_argument("--record-memory", type=int, default=0, metavar="N",
+                        help="Record allocator history and Python allocations for the first N requests")
+    args = parser.parse_args()
+    if args.replicas > 0 and (args.memory_debug or args.record_memory or args.compile):
+        parser.error("--compile and memory profiling need the in-process manager (no --replicas)")
+    return args
+
+
+def main():
+    args = parse_args()
+
+    hf_token = os.environ.get("HUGGING_FACE_HUB_TOKEN")
+    models_config = {}
+    if args.stub:
+        models_config = stub_models_config(tokens_per_sec=args.stub_tokens_per_sec, ttft=args.stub_ttft,
+                                           fail_every=args.stub_fail_every)
+    if args.replicas > 0:
+        model_manager = ReplicaPool(args.replicas, models_config=models_config, cache_dir=args.cache_dir,
+                                    hf_token=hf_token, preload=args.preload, training_dir=args.training_dir)
+        # Inference threads only wait on replica queues; allow at least one per replica
+        max_concurrency = max(args.max_concurrency, args.replicas)
+    else:
+        model_manager = MultiModelManager(models_config, cache_dir=args.cache_dir)
+        model_manager.set_auth_token(hf_token)
+        model_manager.set_performance_mode(args.performance_mode)
+        if args.training_dir:
+            model_manager.example_index = ExampleIndex.open(args.training_dir)
+        if args.compile:
+            model_manager.set_compile_mode(True)
+        for language in args.preload:
+            model_manager.load_model(language)
+        if args.record_memory:
+            model_manager.memory_profiler.record_requests(args.record_memory, trace_python=True)
+        max_concurrency = args.max_concurrency
+
+    server = APIServer(model_manager, max_concurrency=max_concurrency, max_pending=args.max_pending,
+                       max_per_session=args.max_per_session, memory_debug=args.memory_debug)
+    print(f"\nServing OpenAI-compatible API on http://{args.host}:{args.port}/v1")
+    try:
+        web.run_app(server.create_app(), host=args.host, port=args.port, print=None)
+    finally:
+        model_manager.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+# batch_autotune.py - Probe the largest micro-batch that fits and pick gradient accumulation
+
+import os
+import gc
+import json
+import math
+import time
+from datetime import datetime
+
+import psutil
+import torch
+
+# Host-specific tuning results live outside the repository
+AUTOTUNE_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "codebuddy", "batch_autotune.json")
+
+# Steps timed per probe (after one untimed warm-up step)
+PROBE_STEPS = 2
+
+# On CPU there is no OOM signal, so a probe fails once RSS crosses this share of RAM
+HOST_MEMORY_BUDGET = 0.85
+
+
+def _is_oom(error):
+    if hasattr(torch.cuda, "OutOfMemoryError") and isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    return isinstance(error, RuntimeError) and "out of memory" in str(error).lower()
+
+
+def _release_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def _device_key():
+    if torch.cuda.is_available():
+        props = torch.cuda.get_device_properties(0)
+        return f"cuda:{props.name}:{props.total_memory}"
+    return f"cpu:{psutil.virtual_memory().total}"
+
+
+def cache_key(model_name, seq_len, **settings):
+    """Identify an autotune result by model, sequence length, hardware and training settings"""
+    return json.dumps({"model": model_name, "seq_len": seq_len, "device": _device_key(), **settings},
+                      sort_keys=True)
+
+
+def load_cached(key, cache_path=AUTOTUNE_CACHE):
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            return json.load(f).get(key)
+    except (OSError, ValueError):
+        return None
+
+
+def save_cached(key, result, cache_path=AUTOTUNE_CACHE):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache[key] = result
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_path, cache_path)
+
+
+def probe_micro_batch(model, micro_batch, seq_len, steps=PROBE_STEPS):
+    """
+    Run a few real training steps at one micro-batch size
+
+    The optimizer runs with a learning rate of 0, so its state is allocated
+    exactly as in training but the weights are left untouched.
+
+    :return: Median step time in seconds, or None if the batch does not fit
+    """
+    device = next(model.parameters()).device
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = torch.optim.AdamW(params, lr=0.0, weight_decay=0.0)
+    process = psutil.Process()
+    host_budget = psutil.virtual_memory().total * HOST_MEMORY_BUDGET
+    use_autocast = device.type == "cuda"
+
+    try:
+        input_ids = torch.randint(0, model.config.vocab_size, (micro_batch, seq_len), device=device)
+        step_times = []
+        for step in range(steps + 1):
+            start = time.perf_counter()
+            with torch.autocast(device_type="cuda", dtype=torch.float16, enabled=use_autocast):
+                loss = model(input_ids=input_ids, labels=input_ids).loss
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            elif process.memory_info().rss > host_budget:
+                return None
+            if step > 0:
+                step_times.append(time.perf_counter() - start)
+        return sorted(step_times)[len(step_times) // 2]
+    except Exception as e:
+        if _is_oom(e):
+            return None
+        raise
+    finally:
+        optimizer.zero_grad(set_to_none=True)
+        del optimizer
+        _release_memory()
+
+
+def _set_gradient_checkpointing(model, enabled):
+    if enabled:
+        model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+    elif getattr(model, "is_gradient_checkpointing", False):
+        model.gradient_checkpointing_disable()
+    # Training never reuses the KV cache; building it would only inflate the probes
+    model.config.use_cache = False
+
+
+def autotune(model, seq_len, target_batch_size, try_gradient_checkpointing=True, max_micro_batch=None,
+             require_gradient_checkpointing=False):
+    """
+    Find the fastest micro-batch / gradient checkpointing combination that fits
+
+    Micro-batch sizes double from 1 until a probe runs out of memory or the
+    target global batch size is reached, with and without gradient
+    checkpointing. The configuration with the highest samples/sec wins and
+    accumulation steps are chosen to reach `target_batch_size`.
+
+    :param model: Model prepared for training (LoRA and quantization already applied)
+    :param seq_len: Sequence length to probe with (the longest a batch will see)
+    :param target_batch_size: Desired global batch size
+    :param require_gradient_checkpointing: Checkpointing was requested explicitly;
+        only probe with it on
+    :return: Dict with the chosen configuration and its measured step time
+    """
+    max_micro_batch = max_micro_batch or target_batch_size
+    was_training = model.training
+    model.train()
+
+    if require_gradient_checkpointing:
+        options = [True]
+    else:
+        options = [False, True] if try_gradient_checkpointing else [False]
+    measurements = []
+    for checkpointing in options:
+        _set_gradient_checkpointing(model, checkpointing)
+        micro_batch = 1
+        while micro_batch <= max_micro_batch:
+            step_time = probe_micro_batch(model, micro_batch, seq_len)
+            label = "gc" if checkpointing else "no gc"
+            if step_time is None:
+                print(f"  micro-batch {micro_batch:>4} ({label}): does not fit")
+                break
+            print(f"  micro-batch {micro_batch:>4} ({label}): {step_time * 1000:.0f} ms/step, "
+                  f"{micro_batch / step_time:.2f} samples/sec")
+            measurements.append((micro_batch / step_time, not checkpointing, micro_batch, step_time, checkpointing))
+            micro_batch *= 2
+
+    if not measurements:
+        raise RuntimeError(f"Even a micro-batch of 1 x {seq_len} tokens does not fit in memory")
+
+    # Highest throughput first; prefer no checkpointing on ties
+    _, _, micro_batch, step_time, checkpointing = max(measurements)
+    _set_gradient_checkpointing(model, checkpointing)
+    model.train(was_training)
+
+    return {
+        "micro_batch_size": micro_batch,
+        "gradient_accumulation_steps": max(1, math.ceil(target_batch_size / micro_batch)),
+        "gradient_checkpointing": checkpointing,
+        "step_time_sec": round(step_time, 4),
+        "samples_per_sec": round(micro_batch / step_time, 3),
+        "target_batch_size": target_batch_size,
+        "measured_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def autotune_cached(model, model_name, seq_len, target_batch_size, retune=False, gradient_checkpointing=False,
+                    **settings):
+    """
+    Return a cached autotune result for this model/hardware/settings, probing only on a miss
+
+    :param gradient_checkpointing: Checkpointing was requested explicitly; it stays on
+    :param settings: Extra training settings that affect memory (LoRA, quantization, ...)
+    """
+    key = cache_key(model_name, seq_len, target_batch_size=target_batch_size,
+                    gradient_checkpointing=gradient_checkpointing, **settings)
+    result = None if retune else load_cached(key)
+    if result:
+        print(f"Using cached batch configuration from {result['measured_at']}")
+        _set_gradient_checkpointing(model, result["gradient_checkpointing"] or gradient_checkpointing)
+    else:
+        print(f"Autotuning micro-batch size for {seq_len}-token sequences...")
+        result = autotune(model, seq_len, target_batch_size, require_gradient_checkpointing=gradient_checkpointing)
+        save_cached(key, result)
+
+    print(f"Micro-batch {result['micro_batch_size']} x {result['gradient_accumulation_steps']} accumulation steps "
+          f"(gradient checkpointing {'on' if result['gradient_checkpointing'] else 'off'}, "
+          f"{result['step_time_sec'] * 1000:.0f} ms/step)")
+    return result
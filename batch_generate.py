@@ -0,0 +1,209 @@
+# batch_generate.py - Offline batched generation over a JSONL prompt file
+#
+# Usage:
+#   python batch_generate.py prompts.jsonl results.jsonl [--batch-size 8] [--language python]
+#
+# Every input line is a JSON object with a prompt (field set by --prompt-field)
+# and optionally "id", "language" and "chat_history". Results are appended to
+# the output file as each batch finishes; re-running the same command skips
+# ids that are already in the output, so an interrupted run resumes.
+
+import os
+import json
+import time
+import signal
+import argparse
+
+from model_manager import MultiModelManager
+from cancellation import CancellationToken, cancellation_metrics
+
+CACHE_DIR = "models"
+
+# Prompts read ahead and sorted together; larger windows bucket better
+WINDOW_SIZE = 512
+
+
+def read_requests(path, prompt_field="prompt", id_field="id"):
+    """
+    Stream requests from a JSONL file
+
+    :yield: Request dicts with 'id', 'prompt' and any optional fields; ids
+        default to the line number
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                print(f"Skipping line {line_number}: {e}")
+                continue
+            prompt = record.get(prompt_field)
+            if not prompt:
+                print(f"Skipping line {line_number}: no '{prompt_field}'")
+                continue
+            yield {
+                "id": str(record.get(id_field, line_number)),
+                "prompt": prompt,
+                "language": record.get("language"),
+                "chat_history": record.get("chat_history"),
+            }
+
+
+def _drop_partial_line(path):
+    """Truncate a line left unfinished by an interrupted run so appends start clean"""
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+def completed_ids(path):
+    """Ids already present in an output file"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    _drop_partial_line(path)
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                done.add(str(json.loads(line)["id"]))
+            except (ValueError, KeyError):
+                continue
+    return done
+
+
+def _windows(requests, size):
+    window = []
+    for request in requests:
+        window.append(request)
+        if len(window) == size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+def run_batch(model_manager, input_path, output_path, batch_size=8, window_size=WINDOW_SIZE,
+              language=None, prompt_field="prompt", id_field="id", cancel_token=None, **generation_kwargs):
+    """
+    Generate a response for every request in `input_path` that is not yet in `output_path`
+
+    :param cancel_token: Optional `CancellationToken`; once cancelled, the running
+        batch stops at its next decoding step and its rows are left for the next run
+    :return: Dict with counts and aggregate throughput
+    """
+    done = completed_ids(output_path)
+    if done:
+        print(f"Resuming: {len(done)} results already in {output_path}")
+
+    pending = (
+        r for r in read_requests(input_path, prompt_field, id_field)
+        if r["id"] not in done
+    )
+
+    completed = 0
+    generated_tokens = 0
+    start = time.perf_counter()
+    with open(output_path, "a", encoding="utf-8") as out:
+        for window in _windows(pending, window_size):
+            if cancel_token is not None and cancel_token.cancelled:
+                break
+            for request in window:
+                request["cancel_token"] = cancel_token
+                request["language"] = (language or request["language"]
+                                       or model_manager.detect_language(request["prompt"]))
+            for index, response, num_tokens in model_manager.generate_batch(
+                window, batch_size=batch_size, **generation_kwargs
+            ):
+                request = window[index]
+                out.write(json.dumps({
+                    "id": request["id"],
+                    "language": request["language"],
+                    "prompt": request["prompt"],
+                    "response": response,
+                    "generated_tokens": num_tokens,
+                }) + "\n")
+                completed += 1
+                generated_tokens += num_tokens
+                if completed % batch_size == 0:
+                    out.flush()
+                    elapsed = time.perf_counter() - start
+                    print(f"  {completed} done, {completed / elapsed:.2f} prompts/sec, "
+                          f"{generated_tokens / elapsed:.1f} tokens/sec")
+            out.flush()
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        "completed": completed,
+        "skipped": len(done),
+        "generated_tokens": generated_tokens,
+        "seconds": round(elapsed, 1),
+        "prompts_per_sec": round(completed / elapsed, 3) if elapsed else 0.0,
+        "tokens_per_sec": round(generated_tokens / elapsed, 1) if elapsed else 0.0,
+        "interrupted": bool(cancel_token is not None and cancel_token.cancelled),
+    }
+    print(f"Generated {completed} responses ({generated_tokens} tokens) in {elapsed:.1f}s: "
+          f"{summary['prompts_per_sec']} prompts/sec, {summary['tokens_per_sec']} tokens/sec")
+    if summary["interrupted"]:
+        metrics = cancellation_metrics()
+        print(f"Interrupted ({metrics.get('cancelled_tokens_saved', 0)} tokens not generated); "
+              f"run the same command again to resume")
+    return summary
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Batched generation over a JSONL prompt file")
+    parser.add_argument("input", help="JSONL file of requests")
+    parser.add_argument("output", help="JSONL file results are appended to")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--window-size", type=int, default=WINDOW_SIZE,
+                        help="Requests read ahead and sorted by length together")
+    parser.add_argument("--language", default=None, help="Force one language instead of per-request/detected")
+    parser.add_argument("--prompt-field", default="prompt")
+    parser.add_argument("--id-field", default="id")
+    parser.add_argument("--max-new-tokens", type=int, default=1024)
+    parser.add_argument("--temperature", type=float, default=0.2)
+    parser.add_argument("--repetition-penalty", type=float, default=1.1)
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="Model cache directory")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    model_manager = MultiModelManager({}, cache_dir=args.cache_dir)
+    model_manager.set_auth_token(os.environ.get("HUGGING_FACE_HUB_TOKEN"))
+
+    # First Ctrl+C stops the running batch within one decoding step and keeps
+    # everything already written; a second one aborts immediately
+    cancel_token = CancellationToken()
+
+    def on_interrupt(signum, frame):
+        if cancel_token.cancelled:
+            raise KeyboardInterrupt
+        print("\nStopping after the current decoding step (Ctrl+C again to abort)...")
+        cancel_token.cancel("interrupted")
+
+    signal.signal(signal.SIGINT, on_interrupt)
+    try:
+        run_batch(
+            model_manager, args.input, args.output,
+            batch_size=args.batch_size,
+            window_size=args.window_size,
+            language=args.language,
+            prompt_field=args.prompt_field,
+            id_field=args.id_field,
+            max_new_tokens=args.max_new_tokens,
+            temperature=args.temperature,
+            repetition_penalty=args.repetition_penalty,
+            cancel_token=cancel_token,
+        )
+    finally:
+        model_manager.shutdown()
+
+
+if __name__ == "__main__":
+    main()
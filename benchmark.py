@@ -0,0 +1,310 @@
+# benchmark.py - Micro-benchmarks for CodeBuddy training and inference paths
+#
+# Usage:
+#   python benchmark.py finetune [--model-name PATH] [--steps 10]
+#   python benchmark.py replicas --model-name PATH [--replicas 1 2 4] [--requests 32]
+#   python benchmark.py decode [--model-name PATH] [--prompt-lengths 100 500] [--new-tokens 64]
+#   python benchmark.py overhead [--requests 50] [--tokens-per-sec 200]
+
+import os
+import time
+import shutil
+import tempfile
+import argparse
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import psutil
+import torch
+
+
+def tiny_llama_config(vocab_size=32016):
+    """A few-million-parameter Llama config for benchmarks that must run anywhere"""
+    from transformers import LlamaConfig
+    return LlamaConfig(
+        vocab_size=vocab_size,
+        hidden_size=256,
+        intermediate_size=688,
+        num_hidden_layers=4,
+        num_attention_heads=8,
+        num_key_value_heads=8,
+        max_position_embeddings=2048,
+    )
+
+
+def load_benchmark_model(model_name=None):
+    """Load `model_name`, or build a randomly initialised tiny Llama when it is None"""
+    from transformers import AutoModelForCausalLM, LlamaForCausalLM
+    if model_name:
+        return AutoModelForCausalLM.from_pretrained(model_name)
+    torch.manual_seed(0)
+    return LlamaForCausalLM(tiny_llama_config())
+
+
+def _directory_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path) for name in names
+    )
+
+
+def _run_finetune_case(case, model_name, steps, batch_size, seq_len):
+    """Run a few optimizer steps for one configuration; executed in a fresh process"""
+    from finetune_model import load_base_model, prepare_model_for_training
+
+    process = psutil.Process()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    if case.get("quantize", "none") != "none":
+        model = load_base_model(model_name, case["quantize"])
+    else:
+        model = load_benchmark_model(model_name).to(device)
+    model = prepare_model_for_training(
+        model,
+        lora=case.get("lora", False),
+        gradient_checkpointing=case.get("gradient_checkpointing", False),
+    )
+    model.train()
+
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = torch.optim.AdamW(params, lr=1e-4)
+    vocab_size = model.config.vocab_size
+    input_ids = torch.randint(0, vocab_size, (batch_size, seq_len), device=device)
+
+    if device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    peak_rss = process.memory_info().rss
+    step_times = []
+    for step in range(steps + 1):
+        start = time.perf_counter()
+        loss = model(input_ids=input_ids, labels=input_ids).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        if device == "cuda":
+            torch.cuda.synchronize()
+        if step > 0:  # first step includes lazy initialisation
+            step_times.append(time.perf_counter() - start)
+        peak_rss = max(peak_rss, process.memory_info().rss)
+
+    checkpoint_dir = tempfile.mkdtemp(prefix="codebuddy-bench-")
+    try:
+        model.save_pretrained(checkpoint_dir)
+        checkpoint_mb = _directory_size(checkpoint_dir) / (1024**2)
+    finally:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+    return {
+        "case": case["name"],
+        "trainable_params": sum(p.numel() for p in params),
+        "step_ms": statistics.median(step_times) * 1000,
+        "peak_mb": (torch.cuda.max_memory_allocated() if device == "cuda" else peak_rss) / (1024**2),
+        "memory_kind": "CUDA allocated" if device == "cuda" else "host RSS",
+        "checkpoint_mb": checkpoint_mb,
+    }
+
+
+def benchmark_finetune(args):
+    """Compare full fine-tuning against LoRA variants on the same model and batch"""
+    cases = [
+        {"name": "full"},
+        {"name": "full+gc", "gradient_checkpointing": True},
+        {"name": "lora", "lora": True},
+        {"name": "lora+gc", "lora": True, "gradient_checkpointing": True},
+    ]
+    if torch.cuda.is_available() and args.model_name:
+        cases.append({"name": "qlora-4bit+gc", "lora": True, "quantize": "4bit", "gradient_checkpointing": True})
+
+    print(f"\nFine-tuning benchmark: {args.model_name or 'tiny random Llama'}, "
+          f"batch {args.batch_size} x {args.seq_len} tokens, {args.steps} steps")
+    print(f"{'case':<16}{'trainable':>14}{'step ms':>10}{'peak MB':>10}{'ckpt MB':>10}")
+
+    results = []
+    for case in cases:
+        # A fresh process per case so peak memory is not polluted by earlier runs
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            result = pool.submit(
+                _run_finetune_case, case, args.model_name, args.steps, args.batch_size, args.seq_len
+            ).result()
+        results.append(result)
+        print(f"{result['case']:<16}{result['trainable_params']:>14,}{result['step_ms']:>10.1f}"
+              f"{result['peak_mb']:>10.1f}{result['checkpoint_mb']:>10.1f}")
+
+    print(f"(peak memory is {results[0]['memory_kind']})")
+    return results
+
+
+def benchmark_replicas(args):
+    """Measure serving throughput as the number of pinned CPU replicas grows"""
+    from concurrent.futures import ThreadPoolExecutor
+    from replica_pool import ReplicaPool
+
+    models_config = {"python": {"model_name": args.model_name, "supports_chat": False}}
+    prompt = "Write a function that parses a CSV file and returns the rows as dictionaries."
+
+    print(f"\nReplica benchmark: {args.model_name}, {args.requests} requests x {args.max_new_tokens} new tokens")
+    print(f"{'replicas':>8}{'cores/replica':>15}{'seconds':>10}{'req/sec':>10}{'speedup':>10}")
+
+    results = []
+    for num_replicas in args.replicas:
+        pool = ReplicaPool(num_replicas, models_config=models_config, preload=["python"])
+        try:
+            def run_one(_):
+                for _ in pool.generate_code(prompt, language="python",
+                                            max_new_tokens=args.max_new_tokens):
+                    pass
+            # Warm every replica once before timing
+            with ThreadPoolExecutor(max_workers=num_replicas) as clients:
+                list(clients.map(run_one, range(num_replicas)))
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=num_replicas * 2) as clients:
+                list(clients.map(run_one, range(args.requests)))
+            elapsed = time.perf_counter() - start
+        finally:
+            pool.shutdown()
+
+        result = {
+            "replicas": num_replicas,
+            "cores_per_replica": len(pool.core_sets[0]),
+            "seconds": elapsed,
+            "requests_per_sec": args.requests / elapsed,
+        }
+        result["speedup"] = result["requests_per_sec"] / results[0]["requests_per_sec"] if results else 1.0
+        results.append(result)
+        print(f"{num_replicas:>8}{result['cores_per_replica']:>15}{elapsed:>10.1f}"
+              f"{result['requests_per_sec']:>10.2f}{result['speedup']:>10.2f}")
+    return results
+
+
+def _time_generate(generate, input_ids, new_tokens, repeats):
+    """Median seconds for one greedy generation of exactly `new_tokens` tokens"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with torch.no_grad():
+            generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                     max_new_tokens=new_tokens, min_new_tokens=new_tokens, do_sample=False, pad_token_id=0)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def benchmark_decode(args):
+    """Per-token decode latency of eager generation vs compiled generation with a static KV cache"""
+    from compiled_generation import CompiledGenerator
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = load_benchmark_model(args.model_name).to(device).eval()
+    compiled = CompiledGenerator(model, pad_token_id=0, max_new_tokens=max(args.new_tokens, 16))
+    warm_up_sec = compiled.warm_up()
+
+    print(f"\nDecode benchmark: {args.model_name or 'tiny random Llama'} on {device}, "
+          f"{args.new_tokens} new tokens, median of {args.repeats}")
+    print(f"{'prompt':>8}{'bucket':>8}{'eager ms/tok':>14}{'compiled ms/tok':>17}{'speedup':>10}")
+
+    results = []
+    torch.manual_seed(0)
+    for prompt_length in args.prompt_lengths:
+        input_ids = torch.randint(3, model.config.vocab_size, (1, prompt_length), device=device)
+        per_token = {}
+        for name, generate in (("eager", model.generate), ("compiled", compiled.generate)):
+            # Prefill is the same in both modes; the difference of two runs isolates the decode steps
+            first = _time_generate(generate, input_ids, 1, args.repeats)
+            full = _time_generate(generate, input_ids, args.new_tokens, args.repeats)
+            per_token[name] = (full - first) / (args.new_tokens - 1)
+        result = {
+            "prompt_tokens": prompt_length,
+            "bucket": compiled.fits({"input_ids": input_ids, "max_new_tokens": args.new_tokens})
+                      and min(b for b in compiled.buckets if b >= prompt_length),
+            "eager_ms_per_token": per_token["eager"] * 1000,
+            "compiled_ms_per_token": per_token["compiled"] * 1000,
+        }
+        result["speedup"] = per_token["eager"] / per_token["compiled"]
+        results.append(result)
+        print(f"{prompt_length:>8}{result['bucket'] or 'eager':>8}{result['eager_ms_per_token']:>14.2f}"
+              f"{result['compiled_ms_per_token']:>17.2f}{result['speedup']:>10.2f}")
+    print(f"(compile + warm-up of {len(compiled.buckets)} buckets: {warm_up_sec:.1f}s; "
+          f"rerun to see the effect of the on-disk compiler cache)")
+    return results
+
+
+def benchmark_overhead(args):
+    """Time spent around `generate` (tokenize, format, stream, clean) using the stub backend"""
+    from model_manager import MultiModelManager
+    from stub_backend import stub_models_config
+
+    manager = MultiModelManager(stub_models_config(("python",), tokens_per_sec=args.tokens_per_sec, ttft=args.ttft))
+    model, tokenizer = manager.load_model("python")
+    prompt = "Write a function that removes duplicates from a list and returns it sorted."
+
+    print(f"\nServing overhead: {args.requests} requests, stub at {args.tokens_per_sec:g} tok/s, "
+          f"TTFT {args.ttft * 1000:.0f} ms")
+    print(f"{'mode':<10}{'tokens':>8}{'model ms':>10}{'total ms':>10}{'overhead ms':>13}{'overhead %':>12}")
+
+    results = []
+    for stream in (False, True):
+        totals, tokens = [], 0
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            for text in manager.generate_code(prompt, language="python", max_new_tokens=args.max_new_tokens,
+                                              stream=stream):
+                pass
+            totals.append(time.perf_counter() - start)
+            tokens = len(tokenizer(text, add_special_tokens=False)["input_ids"])
+        # What the stub itself spends: time to first token plus its paced decode steps (+1 for EOS)
+        model_sec = args.ttft + (tokens + 1) / args.tokens_per_sec
+        total_sec = statistics.median(totals)
+        result = {
+            "mode": "stream" if stream else "blocking",
+            "tokens": tokens,
+            "model_ms": model_sec * 1000,
+            "total_ms": total_sec * 1000,
+            "overhead_ms": (total_sec - model_sec) * 1000,
+        }
+        results.append(result)
+        print(f"{result['mode']:<10}{tokens:>8}{result['model_ms']:>10.1f}{result['total_ms']:>10.1f}"
+              f"{result['overhead_ms']:>13.1f}{100 * result['overhead_ms'] / result['total_ms']:>11.1f}%")
+    manager.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CodeBuddy benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    finetune = subparsers.add_parser("finetune", help="Full fine-tune vs LoRA memory and step time")
+    finetune.add_argument("--model-name", default=None, help="Model to benchmark (default: tiny random Llama)")
+    finetune.add_argument("--steps", type=int, default=10)
+    finetune.add_argument("--batch-size", type=int, default=4)
+    finetune.add_argument("--seq-len", type=int, default=256)
+    finetune.set_defaults(func=benchmark_finetune)
+
+    replicas = subparsers.add_parser("replicas", help="Serving throughput vs number of pinned CPU replicas")
+    replicas.add_argument("--model-name", required=True, help="Model to serve (local path or hub id)")
+    replicas.add_argument("--replicas", type=int, nargs="+", default=[1, 2, 4])
+    replicas.add_argument("--requests", type=int, default=32)
+    replicas.add_argument("--max-new-tokens", type=int, default=64)
+    replicas.set_defaults(func=benchmark_replicas)
+
+    decode = subparsers.add_parser("decode", help="Per-token decode latency, eager vs torch.compile + static cache")
+    decode.add_argument("--model-name", default=None, help="Model to benchmark (default: tiny random Llama)")
+    decode.add_argument("--prompt-lengths", type=int, nargs="+", default=[100, 500])
+    decode.add_argument("--new-tokens", type=int, default=64)
+    decode.add_argument("--repeats", type=int, default=3)
+    decode.set_defaults(func=benchmark_decode)
+
+    overhead = subparsers.add_parser("overhead", help="Per-request serving overhead around a stub model")
+    overhead.add_argument("--requests", type=int, default=50)
+    overhead.add_argument("--tokens-per-sec", type=float, default=200.0)
+    overhead.add_argument("--ttft", type=float, default=0.05)
+    overhead.add_argument("--max-new-tokens", type=int, default=512)
+    overhead.set_defaults(func=benchmark_overhead)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+# bulk_io.py - Streaming bulk import and export of training and comparison data
+#
+# Import reads JSONL or Parquet in chunks, validates every record against the
+# training data schema, detects missing languages for a whole chunk at once,
+# writes one JSON file per example into the training data directory (the
+# same files `save_training_example` / `save_comparison_example` write) and
+# updates the duplicate and few-shot indexes once per chunk. Exact duplicates
+# of existing examples (or of earlier records) are skipped. Export streams
+# the directory back out the same way. Only one chunk is in memory at a time,
+# so memory use does not grow with the file size.
+#
+# Stop the app while importing: it loads its indexes at start-up.
+#
+# Usage:
+#   python bulk_io.py import corpus.jsonl [--source Imported] [--chunk-size 5000]
+#   python bulk_io.py import comparisons.parquet --instruction-field question
+#   python bulk_io.py import corpus.jsonl --dry-run        # validate only
+#   python bulk_io.py export corpus.parquet [--language Python] [--source AI_Comparison]
+#
+# A record with `other_ai_response` is a comparison example; any other record
+# needs `instruction` and `response`. Optional fields: source, language,
+# timestamp, codebuddy_response, other_ai_name, comparison_notes.
+
+import os
+import re
+import json
+import time
+import argparse
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from dedup import DedupIndex
+from example_index import ExampleIndex
+from language_detection import POWERSHELL_KEYWORDS
+
+TRAINING_DIR = "training_data"
+
+# Records read, validated and written per chunk (and per index save)
+CHUNK_SIZE = 5000
+
+# Invalid records reported individually before only being counted
+MAX_REPORTED_ERRORS = 20
+
+EXPORT_SCHEMA = pa.schema([
+    ("file", pa.string()),
+    ("instruction", pa.string()),
+    ("response", pa.string()),
+    ("codebuddy_response", pa.string()),
+    ("other_ai_response", pa.string()),
+    ("other_ai_name", pa.string()),
+    ("source", pa.string()),
+    ("language", pa.string()),
+    ("timestamp", pa.string()),
+    ("comparison_notes", pa.string()),
+])
+
+FIELDS = EXPORT_SCHEMA.names[1:]
+
+_POWERSHELL_RE = "|".join(re.escape(keyword) for keyword in POWERSHELL_KEYWORDS)
+_UNSAFE_NAME_RE = re.compile(r"[^A-Za-z0-9_-]+")
+
+
+def _format(path):
+    if path.endswith((".parquet", ".pq")):
+        return "parquet"
+    if path.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    raise ValueError(f"Unknown file type for {path} (use .jsonl or .parquet)")
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE, fields=None):
+    """
+    Stream records from a JSONL or Parquet file
+
+    :param fields: Columns to read from Parquet (default: all)
+    :yield: Lists of (record number, dict or error message) of up to `chunk_size` records
+    """
+    if _format(path) == "parquet":
+        parquet = pq.ParquetFile(path)
+        columns = [name for name in parquet.schema_arrow.names if fields is None or name in fields]
+        number = 0
+        for batch in parquet.iter_batches(batch_size=chunk_size, columns=columns):
+            records = batch.to_pylist()
+            yield [(number + i + 1, record) for i, record in enumerate(records)]
+            number += len(records)
+        return
+
+    chunk = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                chunk.append((line_number, json.loads(line)))
+            except ValueError as e:
+                chunk.append((line_number, f"invalid JSON: {e}"))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def validate_record(record, instruction_field="instruction", response_field="response"):
+    """
+    Check a record against the training data schema
+
+    :return: (data dict as saved to the training data directory, None) or (None, error message)
+    """
+    if not isinstance(record, dict):
+        return None, record if isinstance(record, str) else "not a JSON object"
+    record = dict(record)
+    record["instruction"] = record.pop(instruction_field, None)
+    record["response"] = record.pop(response_field, None)
+    for field in FIELDS:
+        value = record.get(field)
+        if value is not None and not isinstance(value, str):
+            return None, f"'{field}' must be a string"
+
+    if not (record["instruction"] or "").strip():
+        return None, f"missing '{instruction_field}'"
+    if record.get("other_ai_response") or record.get("source") == "AI_Comparison":
+        if not (record.get("other_ai_response") or "").strip():
+            return None, "comparison without 'other_ai_response'"
+        data = {
+            "instruction": record["instruction"],
+            "codebuddy_response": record.get("codebuddy_response") or record["response"] or "",
+            "other_ai_response": record["other_ai_response"],
+            "other_ai_name": record.get("other_ai_name") or "Unknown",
+            "source": "AI_Comparison",
+            "comparison_notes": record.get("comparison_notes") or "",
+        }
+    else:
+        if not (record["response"] or "").strip():
+            return None, f"missing '{response_field}'"
+        data = {"instruction": record["instruction"], "response": record["response"],
+                "source": record.get("source")}
+    data["language"] = record.get("language")
+    data["timestamp"] = record.get("timestamp")
+    return data, None
+
+
+def detect_languages(texts):
+    """`detect_language` over a chunk of texts in one vectorized pass"""
+    is_powershell = pc.match_substring_regex(pc.utf8_lower(pa.array(texts, type=pa.string())), _POWERSHELL_RE)
+    return ["powershell" if flag else "python" for flag in is_powershell.to_pylist()]
+
+
+def _filename(training_dir, data, sequence):
+    """A new file name in the UI's naming scheme, plus a sequence number since the UI names files by second"""
+    if data["source"] == "AI_Comparison":
+        prefix = f"Comparison_{data['other_ai_name']}"
+    else:
+        prefix = data["source"]
+    stem = _UNSAFE_NAME_RE.sub("_", f"{prefix}_{data['language']}_{data['timestamp']}")
+    while True:
+        filename = f"{stem}_{sequence:07d}.json"
+        if not os.path.exists(os.path.join(training_dir, filename)):
+            return filename
+        sequence += 1
+
+
+def import_file(path, training_dir=TRAINING_DIR, chunk_size=CHUNK_SIZE, source="Imported",
+                instruction_field="instruction", response_field="response", dry_run=False):
+    """
+    Import training and comparison examples from a JSONL or Parquet file
+
+    :param source: Source recorded for training examples that do not set one
+    :param dry_run: Only validate; nothing is written
+    :return: dict of counts and throughput
+    """
+    os.makedirs(training_dir, exist_ok=True)
+    dedup_index = example_index = None
+    if not dry_run:
+        dedup_index = DedupIndex.open(training_dir)
+        example_index = ExampleIndex.open(training_dir)
+
+    run_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    stats = {"read": 0, "imported": 0, "invalid": 0, "duplicates": 0, "near_duplicates": 0}
+    fields = set(FIELDS) | {instruction_field, response_field}
+    start = time.perf_counter()
+
+    for chunk in read_chunks(path, chunk_size, fields):
+        stats["read"] += len(chunk)
+        valid = []
+        for number, record in chunk:
+            data, error = validate_record(record, instruction_field, response_field)
+            if error is None:
+                valid.append(data)
+                continue
+            stats["invalid"] += 1
+            if stats["invalid"] <= MAX_REPORTED_ERRORS:
+                print(f"Skipping record {number}: {error}")
+
+        # One detection pass for every record without a language
+        undetected = [data for data in valid if not data["language"]]
+        if undetected:
+            for data, language in zip(undetected, detect_languages([d["instruction"] for d in undetected])):
+                data["language"] = language
+        for data in valid:
+            data["language"] = data["language"].capitalize()
+            data["source"] = data["source"] or source
+            data["timestamp"] = data["timestamp"] or run_timestamp
+
+        if dry_run:
+            stats["imported"] += len(valid)
+            continue
+
+        indexed = []
+        for data in valid:
+            response = data.get("other_ai_response") or data["response"]
+            filename = _filename(training_dir, data, stats["imported"] + 1)
+            duplicate = dedup_index.add(filename, data["instruction"], response, data["source"])
+            if duplicate and duplicate["kind"] == "exact":
+                dedup_index.remove(filename)
+                stats["duplicates"] += 1
+                continue
+            if duplicate:
+                stats["near_duplicates"] += 1
+            with open(os.path.join(training_dir, filename), "w", encoding="utf8") as f:
+                json.dump(data, f, indent=2)
+            indexed.append((filename, data["instruction"], data["language"]))
+            stats["imported"] += 1
+
+        # Indexes are saved once per chunk; a crash mid-chunk is repaired by
+        # their sync with the directory on the next open
+        example_index.add_many(indexed)
+        dedup_index.save()
+        example_index.save()
+
+        elapsed = time.perf_counter() - start
+        print(f"  {stats['read']} read, {stats['imported']} imported, {stats['duplicates']} duplicates, "
+              f"{stats['invalid']} invalid ({stats['read'] / elapsed:.0f} records/s)")
+
+    stats["seconds"] = time.perf_counter() - start
+    stats["records_per_sec"] = stats["read"] / stats["seconds"] if stats["seconds"] else 0.0
+    print(f"{'Validated' if dry_run else 'Imported'} {stats['imported']} of {stats['read']} records "
+          f"in {stats['seconds']:.1f}s ({stats['records_per_sec']:.0f} records/s): "
+          f"{stats['duplicates']} exact duplicates skipped, {stats['near_duplicates']} near duplicates kept, "
+          f"{stats['invalid']} invalid")
+    return stats
+
+
+def _iter_examples(training_dir, language=None, source=None):
+    """Stream (filename, data) for the examples in a directory that pass the filters"""
+    with os.scandir(training_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".json") or not entry.is_file():
+                continue
+            try:
+                with open(entry.path, "r", encoding="utf8") as f:
+                    data = json.load(f)
+            except Exception as e:
+                print(f"Skipping {entry.name}: {e}")
+                continue
+            if language and (data.get("language") or "").lower() != language.lower():
+                continue
+            if source and data.get("source") != source:
+                continue
+            yield entry.name, data
+
+
+def export_file(path, training_dir=TRAINING_DIR, chunk_size=CHUNK_SIZE, language=None, source=None):
+    """
+    Export the training data directory to a JSONL or Parquet file
+
+    :param language: Only export examples in this language
+    :param source: Only export examples from this source (e.g. 'AI_Comparison')
+    :return: dict with the number of examples written and throughput
+    """
+    file_format = _format(path)
+    tmp_path = path + ".tmp"
+    start = time.perf_counter()
+    written = 0
+    chunk = []
+
+    def rows(chunk):
+        return [dict({field: data.get(field) for field in FIELDS}, file=name) for name, data in chunk]
+
+    if file_format == "parquet":
+        writer = pq.ParquetWriter(tmp_path, EXPORT_SCHEMA)
+        flush = lambda chunk: writer.write_table(pa.Table.from_pylist(rows(chunk), schema=EXPORT_SCHEMA))
+    else:
+        writer = open(tmp_path, "w", encoding="utf-8")
+        flush = lambda chunk: writer.writelines(
+            json.dumps({key: value for key, value in row.items() if value is not None}, ensure_ascii=False) + "\n"
+            for row in rows(chunk)
+        )
+    try:
+        for example in _iter_examples(training_dir, language, source):
+            chunk.append(example)
+            if len(chunk) == chunk_size:
+                flush(chunk)
+                written += len(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+            written += len(chunk)
+    finally:
+        writer.close()
+    os.replace(tmp_path, path)
+
+    seconds = time.perf_counter() - start
+    print(f"Exported {written} examples to {path} in {seconds:.1f}s ({written / seconds if seconds else 0:.0f} records/s)")
+    return {"exported": written, "seconds": seconds}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Bulk import and export of training data")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    importer = subparsers.add_parser("import", help="Import examples from a .jsonl or .parquet file")
+    importer.add_argument("input", help="JSONL or Parquet file of examples")
+    importer.add_argument("--source", default="Imported", help="Source for records that do not set one")
+    importer.add_argument("--instruction-field", default="instruction")
+    importer.add_argument("--response-field", default="response")
+    importer.add_argument("--dry-run", action="store_true", help="Validate the file without importing it")
+
+    exporter = subparsers.add_parser("export", help="Export examples to a .jsonl or .parquet file")
+    exporter.add_argument("output", help="JSONL or Parquet file to write")
+    exporter.add_argument("--language", default=None, help="Only export this language")
+    exporter.add_argument("--source", default=None, help="Only export this source, e.g. AI_Comparison")
+
+    for subparser in (importer, exporter):
+        subparser.add_argument("--training-dir", default=TRAINING_DIR)
+        subparser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                               help="Records held in memory (and written per index save) at a time")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "import":
+        import_file(args.input, args.training_dir, args.chunk_size, source=args.source,
+                    instruction_field=args.instruction_field, response_field=args.response_field,
+                    dry_run=args.dry_run)
+    else:
+        export_file(args.output, args.training_dir, args.chunk_size, language=args.language, source=args.source)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# cancellation.py - Cooperative cancellation of in-flight generation
+#
+# A CancellationToken travels with a request from the front end (Gradio,
+# HTTP, batch CLI) into `model.generate`, where CancellationCriteria checks it
+# after every decoding step. A cancelled request stops within one step, which
+# ends `generate` and releases its KV cache.
+
+import threading
+from collections import Counter
+
+import torch
+from transformers import StoppingCriteria
+
+# Process-wide cancellation counters, see `cancellation_metrics`
+_metrics = Counter()
+_metrics_lock = threading.Lock()
+
+
+def record_cancellation(generated_tokens, max_new_tokens):
+    """Count one cancelled generation, the tokens it had produced and the tokens it no longer will"""
+    with _metrics_lock:
+        _metrics["cancelled_requests"] += 1
+        _metrics["cancelled_tokens_generated"] += generated_tokens
+        _metrics["cancelled_tokens_saved"] += max(0, max_new_tokens - generated_tokens)
+
+
+def cancellation_metrics():
+    with _metrics_lock:
+        return dict(_metrics)
+
+
+class CancellationToken:
+    def __init__(self):
+        """Thread-safe flag set by a front end and polled by the generation loop"""
+        self._event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason="cancelled"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    def is_cancelled(self):
+        return self._event.is_set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+
+class CancellationCriteria(StoppingCriteria):
+    def __init__(self, tokens, prompt_length, max_new_tokens):
+        """
+        Stop generation for rows whose token is cancelled
+
+        :param tokens: One token per batch row (None for rows that cannot be
+            cancelled), or a single token for the whole batch
+        :param prompt_length: Padded prompt length, to count generated tokens
+        :param max_new_tokens: Generation budget, to count tokens saved
+        """
+        self.tokens = tokens if isinstance(tokens, (list, tuple)) else [tokens]
+        self.prompt_length = prompt_length
+        self.max_new_tokens = max_new_tokens
+        self.recorded = set()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        batch_size = input_ids.shape[0]
+        # Beams and multiple return sequences repeat each request's row consecutively
+        repeat = max(1, batch_size // len(self.tokens))
+        tokens = [token for token in self.tokens for _ in range(repeat)]
+
+        done = torch.zeros(batch_size, dtype=torch.bool, device=input_ids.device)
+        generated = input_ids.shape[1] - self.prompt_length
+        for row, token in enumerate(tokens):
+            if token is not None and token.is_cancelled():
+                done[row] = True
+                request_row = row // repeat
+                if request_row not in self.recorded:
+                    self.recorded.add(request_row)
+                    record_cancellation(generated, self.max_new_tokens)
+        return done
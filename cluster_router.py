@@ -0,0 +1,377 @@
+# cluster_router.py - Route OpenAI-compatible requests across several CodeBuddy API servers
+#
+# Usage:
+#   python cluster_router.py --nodes http://gpu-1:8000 http://gpu-2:8000 [--port 8080]
+#   python cluster_router.py --local-workers 3 --worker-args "--replicas 2"   # localhost test cluster
+#
+# Every node is an `api_server.py` instance. The router polls each node's
+# /health for readiness, queue depth and loaded models, sends each request to
+# a ready node that already has the requested model loaded (least loaded
+# first), retries on another node if one fails before the response starts,
+# and streams the node's response back unchanged.
+#
+# The client's X-Session-Id and X-Priority headers are passed on, and its
+# address in X-Forwarded-For, so nodes queue each client as its own session.
+# A node's 429 for a full queue is retried elsewhere; a 429 for the client's
+# own session limit is returned as is, with its Retry-After.
+
+import sys
+import time
+import shlex
+import asyncio
+import argparse
+import subprocess
+
+import aiohttp
+from aiohttp import web
+
+from language_detection import detect_language
+
+# Seconds between health polls of every node
+HEALTH_INTERVAL = 2.0
+
+# Timeout for a single health poll
+HEALTH_TIMEOUT = 2.0
+
+# Attempts per request on different nodes before giving up
+MAX_ATTEMPTS = 3
+
+# Request headers passed on to nodes, and node response headers passed back to clients
+FORWARDED_REQUEST_HEADERS = ("X-Session-Id", "X-Priority")
+FORWARDED_RESPONSE_HEADERS = ("Retry-After", "X-Queue-Wait-Ms")
+
+
+class Node:
+    def __init__(self, url):
+        """
+        Router-side view of one inference server
+
+        :param url: Base URL of an `api_server.py` instance
+        """
+        self.url = url.rstrip("/")
+        self.healthy = False
+        self.ready = False
+        self.in_flight = 0  # as reported by the node
+        self.active = 0  # requests this router currently has open on the node
+        self.capacity = 1
+        self.loaded_models = set()
+        self.failures = 0
+        self.last_error = None
+        self.routed = 0
+
+    @property
+    def load(self):
+        # The node's report lags by up to one poll; our own open requests are current
+        return max(self.in_flight, self.active) / max(1, self.capacity)
+
+    def update(self, health):
+        self.healthy = health.get("status") == "ok"
+        self.ready = bool(health.get("ready", self.healthy))
+        self.in_flight = int(health.get("in_flight", 0))
+        self.capacity = int(health.get("max_concurrency", 1))
+        self.loaded_models = set(health.get("loaded_models", []))
+        self.failures = 0
+        self.last_error = None
+
+    def mark_failed(self, error):
+        self.healthy = False
+        self.ready = False
+        self.failures += 1
+        self.last_error = str(error) or type(error).__name__
+
+    def describe(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "ready": self.ready,
+            "in_flight": self.in_flight,
+            "active": self.active,
+            "capacity": self.capacity,
+            "loaded_models": sorted(self.loaded_models),
+            "routed": self.routed,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+
+class _Retryable(Exception):
+    def __init__(self, error, retry_after=None):
+        """
+        The node failed before any of its response reached the client
+
+        :param retry_after: The node's Retry-After when it was only full (HTTP 429)
+        """
+        super().__init__(error)
+        self.retry_after = retry_after
+
+
+def forwarded_headers(request):
+    """Headers for a node: the client's session and priority, and its address in X-Forwarded-For"""
+    headers = {name: request.headers[name] for name in FORWARDED_REQUEST_HEADERS if name in request.headers}
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    if request.remote:
+        forwarded_for = f"{forwarded_for}, {request.remote}" if forwarded_for else request.remote
+    if forwarded_for:
+        headers["X-Forwarded-For"] = forwarded_for
+    return headers
+
+
+def relayed_headers(upstream):
+    return {name: upstream.headers[name] for name in FORWARDED_RESPONSE_HEADERS if name in upstream.headers}
+
+
+def request_language(body):
+    """The language a completion request will be served with (the `model` field or detected)"""
+    if body.get("model"):
+        return str(body["model"]).lower()
+    if body.get("messages"):
+        users = [m.get("content") or "" for m in body["messages"] if m.get("role") == "user"]
+        return detect_language(users[-1] if users else "")
+    prompt = body.get("prompt") or ""
+    return detect_language(prompt if isinstance(prompt, str) else " ".join(prompt))
+
+
+class ClusterRouter:
+    def __init__(self, node_urls, health_interval=HEALTH_INTERVAL, max_attempts=MAX_ATTEMPTS):
+        """
+        Load-aware, model-residency-aware router in front of several API servers
+
+        :param node_urls: Base URLs of the nodes
+        :param health_interval: Seconds between health polls
+        :param max_attempts: Nodes tried per request before returning 503
+        """
+        self.nodes = [Node(url) for url in node_urls]
+        self.health_interval = health_interval
+        self.max_attempts = max_attempts
+        self.session = None
+        self.health_task = None
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get("/health", self.health)
+        app.router.add_get("/v1/models", self.list_models)
+        app.router.add_post("/v1/chat/completions", self.proxy_completion)
+        app.router.add_post("/v1/completions", self.proxy_completion)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    async def _on_startup(self, app):
+        # No total timeout: generations can legitimately take minutes
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_connect=5))
+        await self.poll_health()
+        self.health_task = asyncio.create_task(self._health_loop())
+
+    async def _on_cleanup(self, app):
+        self.health_task.cancel()
+        await self.session.close()
+
+    ### Health
+
+    async def _poll_node(self, node):
+        try:
+            async with self.session.get(node.url + "/health",
+                                        timeout=aiohttp.ClientTimeout(total=HEALTH_TIMEOUT)) as response:
+                response.raise_for_status()
+                was_healthy = node.healthy
+                node.update(await response.json())
+                if not was_healthy:
+                    print(f"Node {node.url} is up ({', '.join(sorted(node.loaded_models)) or 'no models loaded'})")
+        except Exception as e:
+            if node.healthy:
+                print(f"Node {node.url} failed its health check: {e or type(e).__name__}")
+            node.mark_failed(e)
+
+    async def poll_health(self):
+        await asyncio.gather(*(self._poll_node(node) for node in self.nodes))
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.poll_health()
+
+    ### Routing
+
+    def candidates(self, language):
+        """
+        Nodes to try, best first
+
+        Ready nodes with the model already loaded come first, then ready nodes
+        that would have to load it, each group least loaded first. Nodes that
+        are unhealthy or full are tried last, in case they recovered since the
+        last poll.
+        """
+        def rank(node):
+            return (
+                not (node.healthy and node.ready),
+                language not in node.loaded_models,
+                node.load,
+                node.failures,
+            )
+        return sorted(self.nodes, key=rank)
+
+    async def _forward(self, node, request, path, body):
+        """Send one request to `node` and stream its response back to the client"""
+        try:
+            upstream = await self.session.post(node.url + path, json=body, headers=forwarded_headers(request))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            node.mark_failed(e)
+            raise _Retryable(e)
+
+        async with upstream:
+            if upstream.status == 429:
+                try:
+                    error_body = await upstream.json(content_type=None)
+                    reason = error_body["error"].get("code")
+                except Exception:
+                    error_body, reason = None, None
+                if reason == "session_limit" and error_body is not None:
+                    # The client's own limit; another node would only let it exceed it
+                    return web.json_response(error_body, status=429, headers={
+                        **relayed_headers(upstream), "X-CodeBuddy-Node": node.url,
+                    })
+                node.ready = False  # full until the next poll says otherwise
+                raise _Retryable(f"HTTP {upstream.status}", upstream.headers.get("Retry-After", "1"))
+            if upstream.status >= 500:
+                error = f"HTTP {upstream.status}"
+                node.mark_failed(error)
+                raise _Retryable(error)
+
+            response = web.StreamResponse(status=upstream.status, headers={
+                "Content-Type": upstream.headers.get("Content-Type", "application/json"),
+                "Cache-Control": "no-cache",
+                "X-CodeBuddy-Node": node.url,
+                **relayed_headers(upstream),
+            })
+            await response.prepare(request)
+            try:
+                async for chunk in upstream.content.iter_any():
+                    await response.write(chunk)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Part of the response is already with the client, so it cannot be replayed elsewhere
+                print(f"Node {node.url} failed mid-response: {e or type(e).__name__}")
+                node.mark_failed(e)
+            await response.write_eof()
+            return response
+
+    async def proxy_completion(self, request):
+        try:
+            body = await request.json()
+        except Exception:
+            return web.json_response(
+                {"error": {"message": "Request body must be JSON", "type": "invalid_request_error"}}, status=400
+            )
+        language = request_language(body)
+
+        errors, retry_afters = [], []
+        for node in self.candidates(language)[:self.max_attempts]:
+            node.active += 1
+            node.routed += 1
+            try:
+                return await self._forward(node, request, request.path, body)
+            except _Retryable as e:
+                errors.append(f"{node.url}: {e}")
+                if e.retry_after is not None:
+                    retry_afters.append(e.retry_after)
+                print(f"Retrying {request.path} after {node.url} failed: {e}")
+            finally:
+                node.active -= 1
+
+        if errors and len(retry_afters) == len(errors):
+            # Every node tried was only full: the client should back off, not treat the cluster as down
+            retry_after = min(int(value) if str(value).isdigit() else 1 for value in retry_afters)
+            return web.json_response(
+                {"error": {"message": "All nodes are busy (" + "; ".join(errors) + ")",
+                           "type": "rate_limit_error", "code": "queue_full"}},
+                status=429, headers={"Retry-After": str(retry_after)}
+            )
+        return web.json_response(
+            {"error": {"message": "No node could serve the request (" + "; ".join(errors) + ")",
+                       "type": "server_error"}},
+            status=503
+        )
+
+    ### Endpoints
+
+    async def list_models(self, request):
+        for node in self.candidates(None):
+            try:
+                async with self.session.get(node.url + "/v1/models",
+                                            timeout=aiohttp.ClientTimeout(total=HEALTH_TIMEOUT)) as response:
+                    if response.status == 200:
+                        return web.json_response(await response.json())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                node.mark_failed(e)
+        return web.json_response({"error": {"message": "No node is reachable", "type": "server_error"}}, status=503)
+
+    async def health(self, request):
+        nodes = [node.describe() for node in self.nodes]
+        return web.json_response({
+            "status": "ok",
+            "ready": any(node["ready"] for node in nodes),
+            "nodes": nodes,
+        })
+
+
+def start_local_workers(count, port_base, worker_args):
+    """
+    Start `count` api_server.py processes on localhost to stand in for nodes
+
+    :return: (list of Popen, list of base URLs)
+    """
+    processes, urls = [], []
+    for i in range(count):
+        port = port_base + i
+        command = [sys.executable, "api_server.py", "--port", str(port)] + shlex.split(worker_args)
+        print(f"Starting local worker: {' '.join(command)}")
+        processes.append(subprocess.Popen(command))
+        urls.append(f"http://127.0.0.1:{port}")
+    return processes, urls
+
+
+def stop_local_workers(processes):
+    for process in processes:
+        process.terminate()
+    deadline = time.monotonic() + 30
+    for process in processes:
+        try:
+            process.wait(timeout=max(0.1, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Route requests across several CodeBuddy API servers")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--nodes", nargs="*", default=[], help="Base URLs of api_server.py nodes")
+    parser.add_argument("--local-workers", type=int, default=0,
+                        help="Also start N api_server.py processes on localhost as nodes")
+    parser.add_argument("--worker-port-base", type=int, default=8101)
+    parser.add_argument("--worker-args", default="", help="Extra arguments for local workers")
+    parser.add_argument("--health-interval", type=float, default=HEALTH_INTERVAL)
+    parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS)
+    args = parser.parse_args()
+    if not args.nodes and not args.local_workers:
+        parser.error("give --nodes and/or --local-workers")
+    return args
+
+
+def main():
+    args = parse_args()
+
+    workers, local_urls = [], []
+    if args.local_workers:
+        workers, local_urls = start_local_workers(args.local_workers, args.worker_port_base, args.worker_args)
+
+    router = ClusterRouter(args.nodes + local_urls, health_interval=args.health_interval,
+                           max_attempts=args.max_attempts)
+    print(f"\nRouting across {len(router.nodes)} nodes on http://{args.host}:{args.port}/v1")
+    try:
+        web.run_app(router.create_app(), host=args.host, port=args.port, print=None)
+    finally:
+        stop_local_workers(workers)
+
+
+if __name__ == "__main__":
+    main()
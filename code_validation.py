@@ -0,0 +1,124 @@
+# code_validation.py - Cheap syntax checks for generated code
+#
+# Used to rerank best-of-n candidates: Python must parse with `ast.parse`;
+# PowerShell gets a structural check (balanced braces, brackets and
+# parentheses outside strings and comments, closed strings and here-strings),
+# since there is no PowerShell parser in Python. Functions are top-level so
+# they can run on a process pool.
+#
+# Usage:
+#   check_code("```python\ndef f(:\n```", "python")   # {'valid': False, 'error': "line 1: invalid syntax"}
+
+import re
+import ast
+
+_FENCE_RE = re.compile(r"```[\w+-]*[ \t]*\n([\s\S]*?)(?:\n```|$)")
+
+_CLOSING = {")": "(", "]": "[", "}": "{"}
+
+
+def extract_code(text):
+    """The code in a response: its fenced code blocks joined, or the text before any closing fence"""
+    blocks = _FENCE_RE.findall(text)
+    if blocks:
+        return "\n\n".join(blocks)
+    # Prompts that open the fence themselves get code followed by a closing fence
+    return text.split("```", 1)[0]
+
+
+def check_python(code):
+    """:return: None if `code` parses, otherwise the syntax error"""
+    try:
+        ast.parse(code)
+    except SyntaxError as e:
+        return f"line {e.lineno}: {e.msg}"
+    except ValueError as e:  # e.g. null bytes
+        return str(e)
+    return None
+
+
+def check_powershell(code):
+    """
+    Structural check for PowerShell: brackets balance and strings and
+    comments are closed
+
+    :return: None if the structure is sound, otherwise the first problem found
+    """
+    stack = []
+    i, line = 0, 1
+    length = len(code)
+    while i < length:
+        char = code[i]
+        if char == "\n":
+            line += 1
+        elif code.startswith("<#", i):
+            end = code.find("#>", i + 2)
+            if end < 0:
+                return f"line {line}: unclosed block comment"
+            line += code.count("\n", i, end)
+            i = end + 2
+            continue
+        elif char == "#":
+            end = code.find("\n", i)
+            i = length if end < 0 else end
+            continue
+        elif code.startswith('@"', i) or code.startswith("@'", i):
+            quote = code[i + 1]
+            end = code.find(f"\n{quote}@", i + 2)
+            if end < 0:
+                return f"line {line}: unclosed here-string"
+            line += code.count("\n", i, end + 1)
+            i = end + 3
+            continue
+        elif char in ("'", '"'):
+            j = i + 1
+            while j < length:
+                if code[j] == "`" and char == '"':
+                    j += 2
+                    continue
+                if code[j] == char:
+                    # Doubled quotes are an escaped quote
+                    if j + 1 < length and code[j + 1] == char:
+                        j += 2
+                        continue
+                    break
+                j += 1
+            if j >= length:
+                return f"line {line}: unclosed string"
+            line += code.count("\n", i, j)
+            i = j + 1
+            continue
+        elif char == "`":
+            # Escape / line continuation: skip the next character
+            i += 2
+            continue
+        elif char in "([{":
+            stack.append((char, line))
+        elif char in _CLOSING:
+            if not stack or stack[-1][0] != _CLOSING[char]:
+                return f"line {line}: unexpected '{char}'"
+            stack.pop()
+        i += 1
+    if stack:
+        char, opened = stack[-1]
+        return f"line {opened}: '{char}' is never closed"
+    return None
+
+
+CHECKS = {
+    "python": check_python,
+    "powershell": check_powershell,
+}
+
+
+def check_code(text, language):
+    """
+    Syntax-check the code in a model response
+
+    :param text: Response text (code fences are stripped)
+    :param language: 'python' or 'powershell'; other languages always pass
+    :return: dict with 'valid' (bool) and 'error' (str or None)
+    """
+    check = CHECKS.get((language or "").lower())
+    error = check(extract_code(text)) if check else None
+    return {"valid": error is None, "error": error}
@@ -0,0 +1,285 @@
+# cpu_calibration.py - Measure the best CPU thread settings for this host
+#
+# Times a short generation over a grid of intra-op and inter-op thread counts
+# (each point in a fresh process, since torch fixes its inter-op pool at first
+# use), then sizes the tokenizer pool by tokenizing while a generation runs.
+# The winner is cached per CPU model, core count and served model, and
+# MultiModelManager applies it at startup instead of guessing from the CPU
+# name. Thread overhead dominates on small models, so a result only applies
+# to the model it was measured with.
+#
+# Usage:
+#   python cpu_calibration.py --model-name meta-llama/CodeLlama-13b-Instruct-hf   # (re)calibrate for a model
+#   python cpu_calibration.py --show               # print this host's cached results
+#   python cpu_calibration.py                      # quick look with a tiny model (not cached)
+
+import os
+import json
+import time
+import platform
+import argparse
+import statistics
+import threading
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import psutil
+import torch
+
+from batch_autotune import load_cached, save_cached
+
+# Host-specific results live outside the repository
+CALIBRATION_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "codebuddy", "cpu_calibration.json")
+
+# Recorded as the model of measurements without one; never cached or applied
+TINY_MODEL = "tiny-random-llama"
+
+# Generation timed at each grid point (after one untimed warm-up run)
+PROMPT_TOKENS = 128
+NEW_TOKENS = 32
+REPEATS = 3
+
+# Prompts tokenized per tokenizer pool size
+TOKENIZE_PROMPTS = 256
+
+# The smallest tokenizer pool within this factor of the fastest wins
+TOKENIZER_TOLERANCE = 1.10
+
+
+def cpu_model_name():
+    """Marketing name of the CPU, e.g. 'AMD Ryzen 7 7800X3D 8-Core Processor'"""
+    try:
+        import cpuinfo
+        return cpuinfo.get_cpu_info().get('brand_raw') or platform.processor() or "unknown"
+    except Exception:
+        pass
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine() or "unknown"
+
+
+def usable_cores():
+    """(physical, logical) cores this process may run on"""
+    logical = psutil.cpu_count(logical=True) or 1
+    physical = psutil.cpu_count(logical=False) or logical
+    if hasattr(os, "sched_getaffinity"):
+        allowed = len(os.sched_getaffinity(0))
+        if allowed < logical:
+            # Pinned to a subset: assume SMT siblings are pinned together
+            physical = max(1, allowed * physical // logical)
+            logical = allowed
+    return physical, logical
+
+
+def host_key():
+    """CPU model and the cores available to this process"""
+    physical, logical = usable_cores()
+    return f"{cpu_model_name()} | {physical} cores / {logical} threads"
+
+
+def calibration_key(model_name):
+    """Calibration cache key: the host and the model measured on it"""
+    return f"{host_key()} | {model_name}"
+
+
+def thread_grid(physical, logical):
+    """(intra-op, inter-op) thread counts worth timing on this many cores"""
+    intra = sorted({max(1, physical // 2), physical, logical} | ({physical - 2} if physical > 4 else set()))
+    interop = sorted({1, 2} if logical > 1 else {1})
+    return [(i, j) for i in intra for j in interop]
+
+
+def _benchmark_model(model_name=None, cache_dir=None):
+    """Model and tokenizer to calibrate with: `model_name`, or a tiny random Llama with a byte tokenizer"""
+    if model_name:
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(model_name, cache_dir=cache_dir)
+        model = AutoModelForCausalLM.from_pretrained(model_name, cache_dir=cache_dir)
+    else:
+        from benchmark import load_benchmark_model
+        from stub_backend import stub_tokenizer
+        tokenizer = stub_tokenizer()
+        model = load_benchmark_model()
+    model.eval()
+    return model, tokenizer
+
+
+def _generate(model, input_ids):
+    with torch.no_grad():
+        model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                       max_new_tokens=NEW_TOKENS, min_new_tokens=NEW_TOKENS, do_sample=False,
+                       pad_token_id=0)
+
+
+def _time_thread_setting(intra_op, interop, model_name, cache_dir):
+    """Tokens per second of a short generation; executed in a fresh process"""
+    torch.set_num_threads(intra_op)
+    torch.set_num_interop_threads(interop)
+    model, _ = _benchmark_model(model_name, cache_dir)
+    torch.manual_seed(0)
+    input_ids = torch.randint(3, model.config.vocab_size, (1, PROMPT_TOKENS))
+    _generate(model, input_ids)
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        _generate(model, input_ids)
+        times.append(time.perf_counter() - start)
+    return NEW_TOKENS / statistics.median(times)
+
+
+def _time_tokenizer_pools(intra_op, interop, pool_sizes, model_name, cache_dir):
+    """
+    Seconds to tokenize a batch of prompts per pool size, while a generation
+    keeps the torch threads busy as it would in serving; executed in a fresh process
+    """
+    torch.set_num_threads(intra_op)
+    torch.set_num_interop_threads(interop)
+    model, tokenizer = _benchmark_model(model_name, cache_dir)
+    prompts = [f"Write a Python function number {i} that " + "parses a log line. " * (1 + i % 20)
+               for i in range(TOKENIZE_PROMPTS)]
+    input_ids = torch.randint(3, model.config.vocab_size, (1, PROMPT_TOKENS))
+
+    busy = threading.Event()
+    busy.set()
+
+    def keep_generating():
+        while busy.is_set():
+            _generate(model, input_ids)
+
+    background = threading.Thread(target=keep_generating, daemon=True)
+    background.start()
+    results = {}
+    try:
+        for size in pool_sizes:
+            with ThreadPoolExecutor(max_workers=size) as pool:
+                list(pool.map(tokenizer, prompts[:16]))
+                start = time.perf_counter()
+                list(pool.map(tokenizer, prompts))
+                results[size] = time.perf_counter() - start
+    finally:
+        busy.clear()
+        background.join()
+    return results
+
+
+def _in_fresh_process(fn, *args):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:  # Avoid fork issues
+        return pool.submit(fn, *args).result()
+
+
+def calibrate(model_name=None, cache_dir=None):
+    """
+    Benchmark the thread grid and tokenizer pool sizes on this host
+
+    :param model_name: Model (and tokenizer) to time; each grid point loads it
+        in a fresh process. Without one a tiny random Llama is timed, whose
+        ranking does not carry over to real models.
+    :param cache_dir: Model cache directory
+    :return: dict with intra_op_threads, interop_threads, tokenizer_threads and the measurements
+    """
+    physical, logical = usable_cores()
+    print(f"Calibrating CPU threads for {host_key()} ({model_name or 'tiny random Llama'})...")
+
+    grid = []
+    for intra_op, interop in thread_grid(physical, logical):
+        try:
+            tokens_per_sec = _in_fresh_process(_time_thread_setting, intra_op, interop, model_name, cache_dir)
+        except Exception as e:
+            print(f"  intra-op {intra_op:>3}, inter-op {interop}: failed ({e})")
+            continue
+        grid.append({"intra_op_threads": intra_op, "interop_threads": interop, "tokens_per_sec": tokens_per_sec})
+        print(f"  intra-op {intra_op:>3}, inter-op {interop}: {tokens_per_sec:8.1f} tokens/s")
+    if not grid:
+        raise RuntimeError("CPU calibration failed at every grid point")
+    best = max(grid, key=lambda point: point["tokens_per_sec"])
+
+    pool_sizes = sorted({1, 2, max(1, logical // 2), logical})
+    pool_times = _in_fresh_process(_time_tokenizer_pools, best["intra_op_threads"], best["interop_threads"],
+                                   pool_sizes, model_name, cache_dir)
+    fastest = min(pool_times.values())
+    tokenizer_threads = min(size for size, seconds in pool_times.items() if seconds <= fastest * TOKENIZER_TOLERANCE)
+    for size, seconds in sorted(pool_times.items()):
+        print(f"  tokenizer pool {size:>3}: {TOKENIZE_PROMPTS / seconds:8.0f} prompts/s")
+
+    result = {
+        "intra_op_threads": best["intra_op_threads"],
+        "interop_threads": best["interop_threads"],
+        "tokenizer_threads": tokenizer_threads,
+        "tokens_per_sec": best["tokens_per_sec"],
+        "grid": grid,
+        "tokenizer_pool_seconds": {str(size): seconds for size, seconds in pool_times.items()},
+        "model": model_name or TINY_MODEL,
+        "torch": torch.__version__,
+        "measured_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    print(f"Best: {result['intra_op_threads']} intra-op / {result['interop_threads']} inter-op threads, "
+          f"{tokenizer_threads} tokenizer threads ({result['tokens_per_sec']:.1f} tokens/s)")
+    return result
+
+
+def load_calibration(model_name, cache_path=CALIBRATION_CACHE):
+    """Cached calibration for this host and `model_name`, or None"""
+    result = load_cached(calibration_key(model_name), cache_path)
+    if result is not None and result.get("model") != model_name:
+        print(f"Ignoring CPU calibration measured with {result.get('model')}, not {model_name}")
+        return None
+    return result
+
+
+def calibrate_cached(model_name, recalibrate=False, cache_path=CALIBRATION_CACHE, cache_dir=None):
+    """Cached calibration for this host and `model_name`, calibrating (and caching) on a miss"""
+    if not model_name:
+        raise ValueError("Calibrations are only cached for a served model")
+    result = None if recalibrate else load_calibration(model_name, cache_path)
+    if result is None:
+        result = calibrate(model_name, cache_dir)
+        save_cached(calibration_key(model_name), result, cache_path)
+    return result
+
+
+def cached_calibrations(cache_path=CALIBRATION_CACHE):
+    """This host's cached calibrations, by model"""
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    prefix = host_key() + " | "
+    return {key[len(prefix):]: result for key, result in cache.items() if key.startswith(prefix)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the best CPU thread settings for this host")
+    parser.add_argument("--model-name", help="Model to calibrate for, as in models_config (default: a tiny "
+                                             "random Llama, measured but not cached)")
+    parser.add_argument("--cache-dir", default="models", help="Model cache directory")
+    parser.add_argument("--show", action="store_true", help="Print the cached results instead of calibrating")
+    args = parser.parse_args()
+
+    if args.show:
+        results = cached_calibrations()
+        if not results:
+            print(f"No calibration cached for {host_key()}")
+        for model_name, result in sorted(results.items()):
+            print(f"{host_key()} with {model_name} (measured {result['measured_at']}):")
+            print(f"  intra-op threads:  {result['intra_op_threads']}")
+            print(f"  inter-op threads:  {result['interop_threads']}")
+            print(f"  tokenizer threads: {result['tokenizer_threads']}")
+        return
+
+    if not args.model_name:
+        calibrate(cache_dir=args.cache_dir)
+        print("Not saved: thread settings for a tiny model do not carry over; pass --model-name to calibrate for one")
+        return
+    calibrate_cached(args.model_name, recalibrate=True, cache_dir=args.cache_dir)
+    print(f"Saved to {CALIBRATION_CACHE}; it is applied the next time the model manager serves {args.model_name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+# dataset_builder.py - Incremental, content-hashed dataset builder for fine-tuning
+
+import os
+import json
+import time
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Name of the cache directory created inside the training data directory
+CACHE_DIR_NAME = ".dataset_cache"
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+# Below this many changed files, spawning a process pool costs more than it saves
+PARALLEL_THRESHOLD = 64
+
+# Number of old snapshots to keep next to the current one
+KEEP_SNAPSHOTS = 1
+
+SNAPSHOT_SCHEMA = pa.schema([
+    ("source_file", pa.string()),
+    ("content_hash", pa.string()),
+    ("source", pa.string()),
+    ("language", pa.string()),
+    ("messages", pa.list_(pa.struct([
+        ("role", pa.string()),
+        ("content", pa.string()),
+    ]))),
+])
+
+
+def hash_bytes(raw):
+    """Return the content hash used in the manifest for a file's raw bytes"""
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def to_training_example(data):
+    """
+    Convert a saved training example into the chat messages format
+
+    :param data: Parsed JSON of a file in the training data directory
+    :return: List of message dicts
+    """
+    if data.get("source") == "AI_Comparison":
+        # Comparison examples train on the other AI's answer (usually the better one)
+        response = data["other_ai_response"]
+    else:
+        response = data["response"]
+
+    return [
+        {"role": "user", "content": data["instruction"]},
+        {"role": "assistant", "content": response}
+    ]
+
+
+def format_conversation(messages):
+    """
+    Render chat messages into the plain-text training template
+
+    :param messages: List of {"role", "content"} dicts
+    :return: "role: content" lines
+    """
+    return "".join(f"{message['role']}: {message['content']}\n" for message in messages)
+
+
+def convert_file(path):
+    """
+    Hash and convert a single training data file
+
+    Runs in worker processes, so it only returns plain picklable values.
+
+    :param path: Path to the JSON file
+    :return: (filename, content_hash, row or None, error message or None)
+    """
+    filename = os.path.basename(path)
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+    except OSError as e:
+        return filename, None, None, str(e)
+
+    content_hash = hash_bytes(raw)
+    try:
+        data = json.loads(raw.decode("utf-8"))
+        row = {
+            "source_file": filename,
+            "content_hash": content_hash,
+            "source": data.get("source", "Unknown"),
+            "language": data.get("language", "Unknown"),
+            "messages": to_training_example(data),
+        }
+        return filename, content_hash, row, None
+    except Exception as e:
+        return filename, content_hash, None, str(e)
+
+
+def read_snapshot(path):
+    """Read a snapshot as a pyarrow Table, memory-mapped without copying its buffers"""
+    with pa.memory_map(path, "r") as source:
+        return pa.ipc.open_stream(source).read_all()
+
+
+def write_snapshot(table, path):
+    """Atomically write a table in the Arrow streaming format used for snapshots"""
+    tmp_path = path + ".tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+class DatasetBuilder:
+    def __init__(self, training_data_dir, cache_dir=None, max_workers=None):
+        """
+        Incrementally build a versioned Arrow snapshot of the training data
+
+        The manifest records the stat signature and content hash of every
+        JSON file. Only new or changed files are converted; unchanged rows are
+        carried over from the previous snapshot, which is read memory-mapped.
+
+        :param training_data_dir: Directory containing the JSON examples
+        :param cache_dir: Where to keep the manifest and snapshots
+        :param max_workers: Process pool size for converting changed files
+        """
+        self.training_data_dir = training_data_dir
+        self.cache_dir = cache_dir or os.path.join(training_data_dir, CACHE_DIR_NAME)
+        self.snapshot_dir = os.path.join(self.cache_dir, "snapshots")
+        self.manifest_path = os.path.join(self.cache_dir, MANIFEST_NAME)
+        self.max_workers = max_workers or max(2, (os.cpu_count() or 2) // 2)
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("manifest_version") == MANIFEST_VERSION:
+                return manifest
+        except (OSError, ValueError):
+            pass
+        return {"manifest_version": MANIFEST_VERSION, "files": {}, "snapshot": None, "version": None}
+
+    def _save_manifest(self, manifest):
+        # Write atomically so an interrupted build never leaves a torn manifest
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _scan(self):
+        """Return {filename: (mtime_ns, size)} for every JSON example"""
+        files = {}
+        with os.scandir(self.training_data_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".json") and entry.is_file():
+                    st = entry.stat()
+                    files[entry.name] = (st.st_mtime_ns, st.st_size)
+        return files
+
+    def _convert(self, filenames):
+        paths = [os.path.join(self.training_data_dir, name) for name in filenames]
+        if len(paths) < PARALLEL_THRESHOLD:
+            return [convert_file(path) for path in paths]
+
+        with ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context('spawn')  # Avoid fork issues
+        ) as pool:
+            return list(pool.map(convert_file, paths, chunksize=32))
+
+    def _prune_snapshots(self, current):
+        snapshots = sorted(
+            (os.path.join(self.snapshot_dir, name) for name in os.listdir(self.snapshot_dir)
+             if name.endswith(".arrow")),
+            key=os.path.getmtime,
+            reverse=True
+        )
+        keep = {current}
+        keep.update([p for p in snapshots if p != current][:KEEP_SNAPSHOTS])
+        for path in snapshots:
+            if path not in keep:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def build(self):
+        """
+        Bring the snapshot up to date with the training data directory
+
+        :return: Path to the current Arrow snapshot
+        """
+        start = time.perf_counter()
+        manifest = self._load_manifest()
+        previous_snapshot = manifest.get("snapshot")
+        if not previous_snapshot or not os.path.exists(previous_snapshot):
+            # Nothing to carry rows over from - convert everything
+            manifest["files"] = {}
+            previous_snapshot = None
+
+        known = manifest["files"]
+        current = self._scan()
+
+        # Fast path: an unchanged stat signature means unchanged content
+        changed = [
+            name for name, sig in current.items()
+            if name not in known or tuple(known[name][:2]) != sig
+        ]
+        removed = [name for name in known if name not in current]
+
+        new_rows = []
+        replaced = set(removed)
+        errors = 0
+        for filename, content_hash, row, error in self._convert(changed):
+            if error:
+                errors += 1
+                print(f"Error processing {filename}: {error}")
+            previous = known.get(filename)
+            if previous and content_hash == previous[2]:
+                # Touched but not modified - keep the existing row
+                known[filename] = list(current[filename]) + [content_hash]
+                continue
+            if previous:
+                replaced.add(filename)
+            if row is not None:
+                new_rows.append(row)
+                known[filename] = list(current[filename]) + [content_hash]
+            else:
+                known.pop(filename, None)
+        for filename in removed:
+            known.pop(filename, None)
+
+        version_hash = hashlib.blake2b(digest_size=8)
+        for filename in sorted(known):
+            version_hash.update(f"{filename}:{known[filename][2]}\n".encode("utf-8"))
+        version = version_hash.hexdigest()
+        snapshot_path = os.path.join(self.snapshot_dir, f"train-{version}.arrow")
+
+        if not os.path.exists(snapshot_path):
+            if previous_snapshot:
+                table = read_snapshot(previous_snapshot)
+                if replaced:
+                    keep_mask = pc.invert(pc.is_in(
+                        table["source_file"], value_set=pa.array(sorted(replaced), pa.string())
+                    ))
+                    table = table.filter(keep_mask)
+            else:
+                table = SNAPSHOT_SCHEMA.empty_table()
+
+            if new_rows:
+                table = pa.concat_tables([table, pa.Table.from_pylist(new_rows, schema=SNAPSHOT_SCHEMA)])
+            write_snapshot(table, snapshot_path)
+
+        manifest.update({"files": known, "snapshot": snapshot_path, "version": version})
+        self._save_manifest(manifest)
+        self._prune_snapshots(snapshot_path)
+
+        elapsed = time.perf_counter() - start
+        print(f"Dataset {version}: {len(known)} examples "
+              f"({len(new_rows)} converted, {len(removed)} removed, {errors} errors) in {elapsed:.2f}s")
+        return snapshot_path
+
+
+def load_snapshot(snapshot_path):
+    """
+    Load a snapshot as a memory-mapped `datasets.Dataset`
+
+    The snapshot is written in the Arrow streaming format that `datasets`
+    uses for its own cache files, so no conversion or copy is needed.
+    """
+    from datasets import Dataset
+    return Dataset.from_file(snapshot_path)
+
+
+def build_dataset(training_data_dir, cache_dir=None, max_workers=None):
+    """Convenience wrapper: build the snapshot and return it as a Dataset"""
+    builder = DatasetBuilder(training_data_dir, cache_dir=cache_dir, max_workers=max_workers)
+    return load_snapshot(builder.build())
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the fine-tuning dataset snapshot")
+    parser.add_argument("--training-data-dir", default="./training_data")
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    print(DatasetBuilder(args.training_data_dir, args.cache_dir, args.workers).build())
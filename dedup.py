@@ -0,0 +1,386 @@
+# dedup.py - Exact and near-duplicate detection across the training corpus
+#
+# Exact duplicates are found by hashing the normalized instruction + response.
+# Near duplicates use MinHash signatures over word 3-grams with LSH banding;
+# candidate pairs from a shared band are confirmed by estimated Jaccard
+# similarity and clustered with union-find, keeping the earliest example.
+
+import os
+import re
+import json
+import zlib
+import pickle
+import hashlib
+import threading
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from dataset_builder import CACHE_DIR_NAME, to_training_example, read_snapshot, write_snapshot
+
+NUM_PERM = 128
+NUM_BANDS = 16          # 16 bands x 8 rows: candidate threshold around 0.7 Jaccard
+NEAR_THRESHOLD = 0.8    # estimated Jaccard needed to call a candidate a duplicate
+SHINGLE_SIZE = 3
+SEED = 1
+
+INDEX_FILENAME = "dedup_index.pkl"
+
+# Rows per worker task when computing signatures for the pre-training pass
+SIGNATURE_CHUNK_SIZE = 5000
+
+_TOKEN_RE = re.compile(r"\w+")
+_SHIFT = np.uint64(32)
+
+
+def normalize(text):
+    """Lowercase and collapse whitespace so formatting-only edits compare equal"""
+    return " ".join(text.lower().split())
+
+
+def exact_hash(instruction, response):
+    """Key identifying an instruction/response pair up to normalization"""
+    joined = normalize(instruction) + "\0" + normalize(response)
+    return hashlib.blake2b(joined.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _permutations(num_perm=NUM_PERM, seed=SEED):
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, 2**32, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.randint(0, 2**32, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def minhash_signature(text, a, b):
+    """
+    MinHash signature of a text's word 3-gram shingles
+
+    Uses multiply-shift hashing on the CRC32 of each shingle; the uint64
+    arithmetic wraps on purpose.
+
+    :return: uint32 array of length len(a)
+    """
+    tokens = _TOKEN_RE.findall(text.lower())
+    if len(tokens) >= SHINGLE_SIZE:
+        shingles = {" ".join(tokens[i:i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+    else:
+        shingles = {" ".join(tokens)}
+
+    hashes = np.fromiter(
+        (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+        dtype=np.uint64,
+        count=len(shingles)
+    )
+    permuted = (hashes[:, None] * a[None, :] + b[None, :]) >> _SHIFT
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def signatures_for_texts(texts, num_perm=NUM_PERM):
+    """Compute signatures for a list of texts; runs in worker processes"""
+    a, b = _permutations(num_perm)
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint32)
+    for i, text in enumerate(texts):
+        signatures[i] = minhash_signature(text, a, b)
+    return signatures
+
+
+def _pair_text(instruction, response):
+    return instruction + "\n" + response
+
+
+class DedupIndex:
+    def __init__(self, num_perm=NUM_PERM, bands=NUM_BANDS, threshold=NEAR_THRESHOLD):
+        """
+        In-memory duplicate index for O(1) checks at save time
+
+        :param num_perm: MinHash signature length
+        :param bands: Number of LSH bands (num_perm must divide evenly)
+        :param threshold: Estimated Jaccard similarity for a near duplicate
+        """
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be divisible by bands ({bands})")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.path = None
+        self._a, self._b = _permutations(num_perm)
+
+        self.entries = {}                                # key -> (exact hash, signature, source)
+        self.exact = {}                                  # exact hash -> set of keys
+        self.buckets = [{} for _ in range(bands)]        # band bytes -> set of keys
+        self._lock = threading.Lock()
+
+    def signature(self, instruction, response):
+        return minhash_signature(_pair_text(instruction, response), self._a, self._b)
+
+    def _band_keys(self, signature):
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def _lookup(self, exact_key, signature, exclude=None):
+        for key in self.exact.get(exact_key, ()):
+            if key != exclude:
+                return {"kind": "exact", "key": key, "similarity": 1.0}
+
+        candidates = {}
+        for band, band_key in enumerate(self._band_keys(signature)):
+            for candidate in self.buckets[band].get(band_key, ()):
+                if candidate != exclude:
+                    candidates[candidate] = None
+        if not candidates:
+            return None
+
+        # Score every candidate in one pass; crowded buckets (bulk imports of templated data) stay cheap
+        candidates = list(candidates)
+        similarities = np.mean(np.stack([self.entries[key][1] for key in candidates]) == signature, axis=1)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        return {"kind": "near", "key": candidates[best], "similarity": float(similarities[best])}
+
+    def _insert(self, key, exact_key, signature, source):
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (exact_key, signature, source)
+        self.exact.setdefault(exact_key, set()).add(key)
+        for band, band_key in enumerate(self._band_keys(signature)):
+            self.buckets[band].setdefault(band_key, set()).add(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        exact_key, signature, _ = entry
+        self.exact[exact_key].discard(key)
+        if not self.exact[exact_key]:
+            del self.exact[exact_key]
+        for band, band_key in enumerate(self._band_keys(signature)):
+            bucket = self.buckets[band][band_key]
+            bucket.discard(key)
+            if not bucket:
+                del self.buckets[band][band_key]
+        return True
+
+    def check(self, instruction, response):
+        """
+        Look for an existing duplicate of an instruction/response pair
+
+        :return: None, or a dict with 'kind' ('exact' or 'near'), 'key' and 'similarity'
+        """
+        exact_key = exact_hash(instruction, response)
+        signature = self.signature(instruction, response)
+        with self._lock:
+            return self._lookup(exact_key, signature)
+
+    def add(self, key, instruction, response, source="Unknown"):
+        """
+        Index an example and return the duplicate it matched, if any
+
+        :param key: Example identifier (the training data filename)
+        """
+        exact_key = exact_hash(instruction, response)
+        signature = self.signature(instruction, response)
+        with self._lock:
+            duplicate = self._lookup(exact_key, signature, exclude=key)
+            self._insert(key, exact_key, signature, source)
+        return duplicate
+
+    def remove(self, key):
+        """Remove an example from the index; returns False if it was not indexed"""
+        with self._lock:
+            return self._remove(key)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sync(self, training_dir):
+        """
+        Bring the index in line with the JSON files in `training_dir`
+
+        Only files the index has not seen are read.
+
+        :return: (number of files added, number removed)
+        """
+        current = {name for name in os.listdir(training_dir) if name.endswith(".json")}
+        removed = [key for key in self.entries if key not in current]
+        for key in removed:
+            self.remove(key)
+
+        added = 0
+        for name in current.difference(self.entries):
+            try:
+                with open(os.path.join(training_dir, name), "r", encoding="utf8") as f:
+                    data = json.load(f)
+                messages = to_training_example(data)
+            except Exception as e:
+                print(f"Dedup index: skipping {name}: {e}")
+                continue
+            self.add(name, messages[0]["content"], messages[1]["content"], data.get("source", "Unknown"))
+            added += 1
+        return added, len(removed)
+
+    def save(self, path=None):
+        path = path or self.path
+        with self._lock:
+            state = {
+                "params": (self.num_perm, self.bands, self.threshold, SEED),
+                "entries": {key: (ek, sig.tobytes(), src) for key, (ek, sig, src) in self.entries.items()},
+            }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def open(cls, training_dir, **kwargs):
+        """
+        Load the persisted index for a training directory and sync it with the files on disk
+
+        :param training_dir: Training data directory
+        :return: A ready-to-use DedupIndex
+        """
+        index = cls(**kwargs)
+        cache_dir = os.path.join(training_dir, CACHE_DIR_NAME)
+        os.makedirs(cache_dir, exist_ok=True)
+        index.path = os.path.join(cache_dir, INDEX_FILENAME)
+
+        try:
+            with open(index.path, "rb") as f:
+                state = pickle.load(f)
+            if state["params"] == (index.num_perm, index.bands, index.threshold, SEED):
+                for key, (exact_key, signature, source) in state["entries"].items():
+                    index._insert(key, exact_key, np.frombuffer(signature, dtype=np.uint32), source)
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError):
+            pass
+
+        added, removed = index.sync(training_dir)
+        if added or removed:
+            index.save()
+        return index
+
+
+class _UnionFind:
+    def __init__(self, n):
+        self.parent = np.arange(n)
+
+    def find(self, i):
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, i, j):
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i != root_j:
+            # The earliest example stays the cluster representative
+            self.parent[max(root_i, root_j)] = min(root_i, root_j)
+
+
+def find_duplicates(instructions, responses, num_perm=NUM_PERM, bands=NUM_BANDS,
+                    threshold=NEAR_THRESHOLD, workers=None):
+    """
+    Pre-training deduplication pass over a whole corpus
+
+    :param instructions: List of instruction texts
+    :param responses: List of response texts (same length)
+    :param workers: Processes used for MinHash signatures
+    :return: (keep mask, per-row reason array with '', 'exact' or 'near')
+    """
+    n = len(instructions)
+    reasons = np.full(n, "", dtype=object)
+
+    # Exact pass: keep the first occurrence of each normalized pair
+    first_seen = {}
+    candidates = []
+    for i in range(n):
+        key = exact_hash(instructions[i], responses[i])
+        if key in first_seen:
+            reasons[i] = "exact"
+        else:
+            first_seen[key] = i
+            candidates.append(i)
+
+    # Near pass over the exact-unique rows
+    texts = [_pair_text(instructions[i], responses[i]) for i in candidates]
+    chunks = [texts[start:start + SIGNATURE_CHUNK_SIZE] for start in range(0, len(texts), SIGNATURE_CHUNK_SIZE)]
+    if len(chunks) > 1:
+        with ProcessPoolExecutor(
+            max_workers=workers or max(2, (os.cpu_count() or 2) // 2),
+            mp_context=multiprocessing.get_context('spawn')  # Avoid fork issues
+        ) as pool:
+            parts = list(pool.map(signatures_for_texts, chunks, [num_perm] * len(chunks)))
+    else:
+        parts = [signatures_for_texts(chunk, num_perm) for chunk in chunks]
+    signatures = np.concatenate(parts) if parts else np.zeros((0, num_perm), dtype=np.uint32)
+
+    rows = num_perm // bands
+    clusters = _UnionFind(len(candidates))
+    for band in range(bands):
+        band_values = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        band_keys = band_values.view(np.dtype((np.void, rows * 4))).ravel()
+        _, inverse, counts = np.unique(band_keys, return_inverse=True, return_counts=True)
+        shared = np.flatnonzero(counts > 1)
+        if not len(shared):
+            continue
+        order = np.argsort(inverse.ravel(), kind="stable")
+        starts = np.cumsum(counts) - counts
+        for bucket in shared:
+            group = order[starts[bucket]:starts[bucket] + counts[bucket]]
+            # Confirm each member against the earliest one in the bucket
+            similarity = (signatures[group[1:]] == signatures[group[0]]).mean(axis=1)
+            for member in group[1:][similarity >= threshold]:
+                clusters.union(group[0], member)
+
+    for position, row in enumerate(candidates):
+        if clusters.find(position) != position:
+            reasons[row] = "near"
+
+    return reasons == "", reasons
+
+
+def dedup_snapshot(snapshot_path, cache_dir, threshold=NEAR_THRESHOLD, workers=None):
+    """
+    Write a deduplicated copy of a dataset snapshot and report duplicates per source
+
+    The result is cached by snapshot version and threshold, so an unchanged
+    dataset is only deduplicated once.
+
+    :param snapshot_path: Snapshot from `DatasetBuilder.build`
+    :param cache_dir: The builder's cache directory
+    :return: Path to the deduplicated snapshot
+    """
+    dedup_dir = os.path.join(cache_dir, "dedup")
+    os.makedirs(dedup_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(snapshot_path))[0]
+    output_path = os.path.join(dedup_dir, f"{stem}-j{round(threshold * 100)}.arrow")
+    if os.path.exists(output_path):
+        return output_path
+
+    table = read_snapshot(snapshot_path)
+    instructions = pc.struct_field(pc.list_element(table["messages"], 0), "content").to_pylist()
+    responses = pc.struct_field(pc.list_element(table["messages"], 1), "content").to_pylist()
+    keep, reasons = find_duplicates(instructions, responses, threshold=threshold, workers=workers)
+
+    write_snapshot(table.filter(pa.array(keep)), output_path)
+    for name in os.listdir(dedup_dir):
+        if name != os.path.basename(output_path):
+            try:
+                os.remove(os.path.join(dedup_dir, name))
+            except OSError:
+                pass
+
+    sources = table["source"].to_pylist()
+    exact_counts = Counter(src for src, reason in zip(sources, reasons) if reason == "exact")
+    near_counts = Counter(src for src, reason in zip(sources, reasons) if reason == "near")
+    print(f"Deduplication: {len(keep)} examples -> {int(keep.sum())} kept "
+          f"({sum(exact_counts.values())} exact, {sum(near_counts.values())} near duplicates removed)")
+    for source in sorted(set(exact_counts) | set(near_counts)):
+        print(f"  {source:<24} exact: {exact_counts[source]:>7}  near: {near_counts[source]:>7}")
+
+    return output_path
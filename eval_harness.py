@@ -0,0 +1,449 @@
+# eval_harness.py - Quality vs speed of quantization and decoding profiles
+#
+# Takes a held-out slice of training_data (chosen by a hash of each file
+# name, so the same examples are held out on every run and
+# `finetune_model.py --hold-out` can leave them out of training) and runs it
+# through every combination of quantization profile (how the weights are
+# loaded) and decoding profile (how tokens are chosen). Each quantization
+# profile is evaluated in its own fresh process; with --workers N, N of them
+# run at once, each pinned to its own share of the CPU cores.
+#
+# Per profile it measures
+#   - perplexity of the reference responses (depends on quantization only)
+#   - the share of generations whose code passes the syntax check used for best-of-n
+#   - per-request latency (p50/p90) and decode throughput
+# and prints a table that marks the Pareto-optimal profiles: those no other
+# profile beats on perplexity, syntax validity and latency at once.
+#
+# Usage:
+#   python eval_harness.py --model-name PATH                          # every profile this host supports
+#   python eval_harness.py --quantization fp32 dynamic-int8 onnx-int8 --decoding greedy sample
+#   python eval_harness.py --max-examples 20 --max-new-tokens 128 --workers 2
+
+import os
+import json
+import time
+import math
+import hashlib
+import argparse
+import statistics
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import psutil
+import torch
+import pyarrow as pa
+
+from dataset_builder import to_training_example, format_conversation, read_snapshot, write_snapshot
+from code_validation import check_code
+from replica_pool import split_cores
+
+MODEL_NAME = "meta-llama/CodeLlama-13b-Instruct-hf"
+TRAINING_DIR = "training_data"
+CACHE_DIR = "models"
+RESULTS_DIR = "eval_results"
+
+# Share of training files held out for evaluation
+HOLDOUT_FRACTION = 0.05
+
+# How model_manager.py can load weights (its own fallback chain is nf4 -> fp16 -> int8)
+QUANTIZATION_PROFILES = {
+    "nf4": "4-bit NF4, double quantization (bitsandbytes, GPU)",
+    "fp16": "fp16 with device_map='auto' offload (GPU)",
+    "int8": "LLM.int8 (bitsandbytes, GPU)",
+    "fp32": "fp32 (CPU)",
+    "bf16": "bf16 (CPU)",
+    "dynamic-int8": "torch dynamic int8 Linear layers (CPU)",
+    "onnx-fp32": "ONNX Runtime fp32 (CPU)",
+    "onnx-int8": "ONNX Runtime int8 (CPU, the 'backend': 'onnx' default)",
+}
+GPU_PROFILES = {"nf4", "fp16", "int8"}
+
+# Generation settings of the manager's paths
+DECODING_PROFILES = {
+    # _generate_with_pytorch
+    "beam2-sample": {"do_sample": True, "top_k": 50, "top_p": 0.95, "num_beams": 2, "early_stopping": False},
+    # _generate_with_pytorch_safe
+    "sample": {"do_sample": True},
+    "greedy": {"do_sample": False},
+}
+
+# Prompt + reference tokens scored for perplexity
+MAX_EVAL_TOKENS = 1024
+SEED = 0
+
+
+def is_held_out(filename, fraction=HOLDOUT_FRACTION):
+    """Whether a training file belongs to the evaluation split (stable across runs and machines)"""
+    digest = hashlib.blake2b(filename.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") < fraction * 2 ** 64
+
+
+def load_held_out(training_dir=TRAINING_DIR, fraction=HOLDOUT_FRACTION, max_examples=None):
+    """
+    The held-out examples of a training data directory
+
+    :return: List of dicts with 'file', 'language', 'instruction' and 'response'
+    """
+    examples = []
+    for name in sorted(os.listdir(training_dir)):
+        if not name.endswith(".json") or not is_held_out(name, fraction):
+            continue
+        try:
+            with open(os.path.join(training_dir, name), "r", encoding="utf8") as f:
+                data = json.load(f)
+            messages = to_training_example(data)
+        except Exception as e:
+            print(f"Skipping {name}: {e}")
+            continue
+        examples.append({
+            "file": name,
+            "language": (data.get("language") or "python").lower(),
+            "instruction": messages[0]["content"],
+            "response": messages[1]["content"],
+        })
+        if max_examples and len(examples) == max_examples:
+            break
+    return examples
+
+
+def exclude_held_out(snapshot_path, cache_dir, fraction=HOLDOUT_FRACTION):
+    """
+    Write a copy of a dataset snapshot without the held-out examples
+
+    Cached by snapshot version and fraction, like `dedup_snapshot`.
+
+    :return: Path to the training snapshot
+    """
+    holdout_dir = os.path.join(cache_dir, "holdout")
+    os.makedirs(holdout_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(snapshot_path))[0]
+    output_path = os.path.join(holdout_dir, f"{stem}-h{round(fraction * 1000)}.arrow")
+    if os.path.exists(output_path):
+        return output_path
+
+    table = read_snapshot(snapshot_path)
+    keep = [not is_held_out(name, fraction) for name in table["source_file"].to_pylist()]
+    write_snapshot(table.filter(pa.array(keep)), output_path)
+    for name in os.listdir(holdout_dir):
+        if name != os.path.basename(output_path):
+            try:
+                os.remove(os.path.join(holdout_dir, name))
+            except OSError:
+                pass
+    print(f"Held out {len(keep) - sum(keep)} of {len(keep)} examples for evaluation")
+    return output_path
+
+
+def available_profiles(quantization):
+    """Split quantization profiles into (runnable here, {skipped: reason})"""
+    runnable, skipped = [], {}
+    for profile in quantization:
+        if profile not in QUANTIZATION_PROFILES:
+            skipped[profile] = "unknown profile"
+        elif profile in GPU_PROFILES and not torch.cuda.is_available():
+            skipped[profile] = "needs a CUDA GPU"
+        elif profile.startswith("onnx"):
+            try:
+                import onnxruntime  # noqa: F401
+                runnable.append(profile)
+            except ImportError:
+                skipped[profile] = "needs onnxruntime"
+        else:
+            runnable.append(profile)
+    return runnable, skipped
+
+
+def unsupported_decoding(quantization, decoding):
+    """Why a quantization profile cannot decode as a decoding profile specifies, or None"""
+    if quantization.startswith("onnx") and DECODING_PROFILES[decoding].get("num_beams", 1) > 1:
+        # OnnxCausalLM.generate ignores num_beams, so the row would measure single-beam sampling
+        return "the ONNX backend has no beam search"
+    return None
+
+
+def load_profile_model(profile, model_name, cache_dir=CACHE_DIR, hf_token=None):
+    """Load `model_name` the way a quantization profile does; returns the model in eval mode"""
+    from transformers import AutoModelForCausalLM, BitsAndBytesConfig
+
+    auth_kwargs = {"token": hf_token} if hf_token else {}
+    if profile.startswith("onnx"):
+        from onnx_backend import load_onnx_model
+        return load_onnx_model(model_name, cache_dir, hf_token, quantize=profile == "onnx-int8")
+    if profile == "nf4":
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name, **auth_kwargs, cache_dir=cache_dir, device_map={"": 0}, torch_dtype=torch.float16,
+            quantization_config=BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=torch.float16,
+                                                   bnb_4bit_quant_type="nf4", bnb_4bit_use_double_quant=True)
+        )
+    elif profile == "fp16":
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name, **auth_kwargs, cache_dir=cache_dir, torch_dtype=torch.float16,
+            device_map="auto", offload_folder="offload_folder"
+        )
+    elif profile == "int8":
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name, **auth_kwargs, cache_dir=cache_dir, device_map="auto", torch_dtype=torch.float16,
+            quantization_config=BitsAndBytesConfig(load_in_8bit=True, llm_int8_threshold=6.0)
+        )
+    elif profile == "bf16":
+        model = AutoModelForCausalLM.from_pretrained(model_name, **auth_kwargs, cache_dir=cache_dir,
+                                                     torch_dtype=torch.bfloat16)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_name, **auth_kwargs, cache_dir=cache_dir,
+                                                     torch_dtype=torch.float32)
+        if profile == "dynamic-int8":
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model.eval()
+
+
+def build_prompt(tokenizer, instruction):
+    """The model's chat template when it has one, otherwise the fine-tuning template"""
+    messages = [{"role": "user", "content": instruction}]
+    if getattr(tokenizer, "chat_template", None):
+        return tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+    return format_conversation(messages) + "assistant:"
+
+
+def _logits(model, input_ids):
+    if isinstance(model, torch.nn.Module):
+        with torch.no_grad():
+            return model(input_ids=input_ids.to(model.device)).logits.float().cpu()
+    # OnnxCausalLM
+    positions = torch.arange(input_ids.shape[1]).unsqueeze(0)
+    logits, _ = model.forward(input_ids, torch.ones_like(input_ids), positions)
+    return torch.from_numpy(logits).float()
+
+
+def perplexity(model, tokenizer, examples):
+    """Perplexity of the reference responses given their prompts"""
+    total_nll, total_tokens = 0.0, 0
+    for example in examples:
+        prompt = build_prompt(tokenizer, example["instruction"])
+        prompt_length = len(tokenizer(prompt)["input_ids"])
+        input_ids = tokenizer(prompt + " " + example["response"], return_tensors="pt",
+                              truncation=True, max_length=MAX_EVAL_TOKENS)["input_ids"]
+        if input_ids.shape[1] <= prompt_length:
+            continue
+        logits = _logits(model, input_ids)[0, prompt_length - 1:-1]
+        targets = input_ids[0, prompt_length:]
+        total_nll += torch.nn.functional.cross_entropy(logits, targets, reduction="sum").item()
+        total_tokens += len(targets)
+    return math.exp(total_nll / total_tokens) if total_tokens else float("nan")
+
+
+def _generate(model, tokenizer, prompt, decoding, settings):
+    inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=MAX_EVAL_TOKENS)
+    device = getattr(model, "device", torch.device("cpu"))
+    kwargs = dict(DECODING_PROFILES[decoding], max_new_tokens=settings["max_new_tokens"],
+                  repetition_penalty=settings["repetition_penalty"],
+                  pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id)
+    if kwargs["do_sample"]:
+        kwargs["temperature"] = settings["temperature"]
+    start = time.perf_counter()
+    with torch.no_grad():
+        output = model.generate(input_ids=inputs["input_ids"].to(device),
+                                attention_mask=inputs["attention_mask"].to(device), **kwargs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    seconds = time.perf_counter() - start
+    new_tokens = output[0][inputs["input_ids"].shape[1]:]
+    return tokenizer.decode(new_tokens, skip_special_tokens=True), len(new_tokens), seconds
+
+
+def _peak_memory_gb():
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / 1024 ** 3
+    return psutil.Process().memory_info().rss / 1024 ** 3
+
+
+def evaluate_profiles(quantization, decoding, model_name, examples, settings, cores=None):
+    """
+    Evaluate quantization profiles one after another; executed in a fresh process
+
+    :param cores: CPU cores to pin this process to
+    :return: One result dict per (quantization, decoding) pair
+    """
+    from transformers import AutoTokenizer
+
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+    hf_token = os.environ.get("HUGGING_FACE_HUB_TOKEN")
+    tokenizer = AutoTokenizer.from_pretrained(model_name, cache_dir=settings["cache_dir"],
+                                              **({"token": hf_token} if hf_token else {}))
+
+    results = []
+    for profile in quantization:
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        try:
+            model = load_profile_model(profile, model_name, settings["cache_dir"], hf_token)
+        except Exception as e:
+            print(f"[{profile}] failed to load: {e}")
+            results.append({"quantization": profile, "error": f"load failed: {e}"})
+            continue
+        load_seconds = time.perf_counter() - start
+        profile_perplexity = perplexity(model, tokenizer, examples)
+        print(f"[{profile}] loaded in {load_seconds:.1f}s, perplexity {profile_perplexity:.3f}")
+
+        for decoding_profile in decoding:
+            reason = unsupported_decoding(profile, decoding_profile)
+            if reason:
+                print(f"[{profile} / {decoding_profile}] skipped: {reason}")
+                results.append({"quantization": profile, "decoding": decoding_profile, "error": reason})
+                continue
+            torch.manual_seed(SEED)
+            latencies, tokens, valid = [], 0, 0
+            try:
+                for example in examples:
+                    text, new_tokens, seconds = _generate(
+                        model, tokenizer, build_prompt(tokenizer, example["instruction"]), decoding_profile, settings
+                    )
+                    latencies.append(seconds)
+                    tokens += new_tokens
+                    valid += check_code(text, example["language"])["valid"]
+            except Exception as e:
+                print(f"[{profile} / {decoding_profile}] failed: {e}")
+                results.append({"quantization": profile, "decoding": decoding_profile, "error": str(e)})
+                continue
+            result = {
+                "quantization": profile,
+                "decoding": decoding_profile,
+                "examples": len(examples),
+                "perplexity": profile_perplexity,
+                "syntax_valid": valid / len(examples),
+                "latency_p50": statistics.median(latencies),
+                "latency_p90": sorted(latencies)[int(0.9 * (len(latencies) - 1))],
+                "tokens_per_sec": tokens / sum(latencies) if sum(latencies) else 0.0,
+                "load_seconds": load_seconds,
+                "memory_gb": _peak_memory_gb(),
+                "cores": len(cores) if cores else None,
+            }
+            print(f"[{profile} / {decoding_profile}] syntax valid {result['syntax_valid']:.0%}, "
+                  f"p50 {result['latency_p50']:.2f}s, {result['tokens_per_sec']:.1f} tokens/s")
+            results.append(result)
+        del model
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    return results
+
+
+def pareto_front(results):
+    """
+    Mark results no other result dominates on perplexity (lower), syntax
+    validity (higher) and p50 latency (lower)
+    """
+    scored = [r for r in results if "error" not in r]
+    for result in scored:
+        result["pareto"] = not any(
+            other["perplexity"] <= result["perplexity"]
+            and other["syntax_valid"] >= result["syntax_valid"]
+            and other["latency_p50"] <= result["latency_p50"]
+            and (other["perplexity"], -other["syntax_valid"], other["latency_p50"])
+            != (result["perplexity"], -result["syntax_valid"], result["latency_p50"])
+            for other in scored
+        )
+    return results
+
+
+def print_table(results):
+    header = (f"{'':2}{'quantization':<14}{'decoding':<14}{'perplexity':>11}{'syntax ok':>11}"
+              f"{'p50 s':>8}{'p90 s':>8}{'tok/s':>8}{'mem GB':>8}")
+    print("\n" + header)
+    print("-" * len(header))
+    scored = sorted((r for r in results if "error" not in r), key=lambda r: r["latency_p50"])
+    for r in scored:
+        print(f"{'*' if r['pareto'] else '':2}{r['quantization']:<14}{r['decoding']:<14}{r['perplexity']:>11.3f}"
+              f"{r['syntax_valid']:>10.0%} {r['latency_p50']:>8.2f}{r['latency_p90']:>8.2f}"
+              f"{r['tokens_per_sec']:>8.1f}{r['memory_gb']:>8.2f}")
+    for r in results:
+        if "error" in r:
+            print(f"  {r['quantization']:<14}{r.get('decoding', ''):<14}{r['error']}")
+    print("* Pareto-optimal: no other profile has lower perplexity, more valid code and lower latency")
+
+
+def run_eval(model_name=MODEL_NAME, training_dir=TRAINING_DIR, quantization=None, decoding=None,
+             fraction=HOLDOUT_FRACTION, max_examples=50, workers=1, max_new_tokens=256,
+             temperature=0.2, repetition_penalty=1.1, cache_dir=CACHE_DIR, results_dir=RESULTS_DIR):
+    """
+    Evaluate every quantization x decoding profile on the held-out examples
+
+    :param workers: Quantization profiles evaluated at once, each in its own
+        process pinned to an equal share of the CPU cores
+    :return: List of result dicts (with a 'pareto' flag), also saved to `results_dir`
+    """
+    examples = load_held_out(training_dir, fraction, max_examples)
+    if not examples:
+        raise ValueError(f"No held-out examples in {training_dir} at fraction {fraction}")
+    quantization, skipped = available_profiles(quantization or list(QUANTIZATION_PROFILES))
+    decoding = decoding or list(DECODING_PROFILES)
+    for profile, reason in skipped.items():
+        print(f"Skipping {profile}: {reason}")
+    if not quantization:
+        raise ValueError("No quantization profile can run on this host")
+
+    settings = {"max_new_tokens": max_new_tokens, "temperature": temperature,
+                "repetition_penalty": repetition_penalty, "cache_dir": cache_dir}
+    workers = max(1, min(workers, len(quantization), len(split_cores(1)[0])))
+    core_sets = split_cores(workers)
+    groups = [quantization[i::workers] for i in range(workers)]
+    print(f"Evaluating {len(quantization)} quantization x {len(decoding)} decoding profiles on "
+          f"{len(examples)} held-out examples ({workers} worker{'s' if workers > 1 else ''})")
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:  # Avoid fork issues
+        futures = [
+            pool.submit(evaluate_profiles, group, decoding, model_name, examples, settings,
+                        core_sets[i] if workers > 1 else None)
+            for i, group in enumerate(groups)
+        ]
+        results = [result for future in futures for result in future.result()]
+    results += [{"quantization": profile, "error": reason} for profile, reason in skipped.items()]
+    pareto_front(results)
+    print_table(results)
+
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, f"eval_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(path, "w", encoding="utf8") as f:
+        json.dump({
+            "model": model_name,
+            "examples": [example["file"] for example in examples],
+            "settings": settings,
+            "seconds": time.perf_counter() - start,
+            "results": results,
+        }, f, indent=2)
+    print(f"Results saved to {path}")
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Quality vs speed of quantization and decoding profiles")
+    parser.add_argument("--model-name", default=MODEL_NAME)
+    parser.add_argument("--training-dir", default=TRAINING_DIR)
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="Model cache directory")
+    parser.add_argument("--quantization", nargs="+", choices=list(QUANTIZATION_PROFILES), default=None,
+                        help="Profiles to evaluate (default: all this host supports)")
+    parser.add_argument("--decoding", nargs="+", choices=list(DECODING_PROFILES), default=None)
+    parser.add_argument("--hold-out", type=float, default=HOLDOUT_FRACTION,
+                        help="Share of training files in the evaluation split")
+    parser.add_argument("--max-examples", type=int, default=50)
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--temperature", type=float, default=0.2)
+    parser.add_argument("--repetition-penalty", type=float, default=1.1)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Quantization profiles evaluated in parallel, on disjoint CPU cores")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    run_eval(args.model_name, args.training_dir, args.quantization, args.decoding, args.hold_out,
+             args.max_examples, args.workers, args.max_new_tokens, args.temperature,
+             args.repetition_penalty, args.cache_dir)
+
+
+if __name__ == "__main__":
+    main()
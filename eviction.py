@@ -0,0 +1,112 @@
+# eviction.py - When MultiModelManager releases loaded models
+#
+# Models are evicted (unloaded) by a background check in the manager when
+# either
+#   - they have been idle longer than their TTL, or
+#   - host RAM or GPU memory use is above its watermark (least recently used
+#     first, until back under it)
+# Models held by running requests are never evicted, and models covered by a
+# keep-warm schedule are neither evicted nor left unloaded while the schedule
+# is active. Both can be set per models_config entry:
+#   'idle_ttl': 600                              seconds idle before eviction (0: never)
+#   'keep_warm': 'mon-fri 08:00-18:00'           local-time windows, ';'-separated
+#
+# Usage:
+#   schedule = KeepWarmSchedule("mon-fri 08:00-18:00; sat 10:00-13:00")
+#   schedule.active()              # True during those hours
+#   memory_pressure()              # e.g. "host RAM 93% > 90% watermark", or None
+
+from datetime import datetime
+
+import psutil
+import torch
+
+# Idle time before eviction per performance mode (None: never evicted for idling)
+IDLE_TTL_SECONDS = {
+    "speed": None,
+    "balanced": 30 * 60,
+    "memory": 2 * 60,
+}
+
+# Fraction of host RAM / GPU memory in use above which idle models are evicted
+HOST_MEMORY_WATERMARK = 0.90
+DEVICE_MEMORY_WATERMARK = 0.92
+
+# Seconds between eviction checks
+EVICTION_CHECK_INTERVAL = 30
+
+# Evictions kept for `load_metrics`
+EVICTION_LOG_SIZE = 50
+
+DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+def _parse_time(text):
+    hours, minutes = text.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def _parse_days(text):
+    days = set()
+    for part in text.split(","):
+        if "-" in part:
+            first, last = (DAYS.index(day.strip()[:3]) for day in part.split("-"))
+            days.update((first + i) % 7 for i in range((last - first) % 7 + 1))
+        else:
+            days.add(DAYS.index(part.strip()[:3]))
+    return days
+
+
+class KeepWarmSchedule:
+    def __init__(self, spec):
+        """
+        Weekly windows during which a model stays loaded
+
+        :param spec: ';'-separated windows, each "[days] HH:MM-HH:MM" in local
+            time, e.g. "mon-fri 08:00-18:00; sat 10:00-13:00". Days default to
+            every day; a window may cross midnight ("22:00-02:00").
+        """
+        self.spec = spec
+        self.windows = []
+        for window in spec.lower().split(";"):
+            window = window.strip()
+            if not window:
+                continue
+            *days, hours = window.split()
+            start, end = (_parse_time(t) for t in hours.split("-"))
+            self.windows.append((_parse_days(" ".join(days)) if days else set(range(7)), start, end))
+        if not self.windows:
+            raise ValueError(f"Empty keep-warm schedule: {spec!r}")
+
+    def active(self, now=None):
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        today = now.weekday()
+        for days, start, end in self.windows:
+            if start <= end:
+                if today in days and start <= minute < end:
+                    return True
+            # Overnight window: the evening belongs to its start day, the early hours to the day after
+            elif (today in days and minute >= start) or ((today - 1) % 7 in days and minute < end):
+                return True
+        return False
+
+    def __repr__(self):
+        return f"KeepWarmSchedule({self.spec!r})"
+
+
+def memory_pressure(host_watermark=HOST_MEMORY_WATERMARK, device_watermark=DEVICE_MEMORY_WATERMARK):
+    """
+    Reason to evict for memory, or None when usage is under both watermarks
+
+    GPU usage counts memory reserved by PyTorch's caching allocator.
+    """
+    host = psutil.virtual_memory().percent / 100
+    if host_watermark and host > host_watermark:
+        return f"host RAM {host:.0%} > {host_watermark:.0%} watermark"
+    if device_watermark and torch.cuda.is_available():
+        for i in range(torch.cuda.device_count()):
+            used = torch.cuda.memory_reserved(i) / torch.cuda.get_device_properties(i).total_memory
+            if used > device_watermark:
+                return f"GPU {i} memory {used:.0%} > {device_watermark:.0%} watermark"
+    return None
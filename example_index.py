@@ -0,0 +1,360 @@
+# example_index.py - Similarity search over training example instructions
+#
+# Each instruction is embedded locally (no model, no network) by hashing its
+# words, word bigrams and character trigrams into a fixed-size signed feature
+# vector, L2-normalized and stored as one int8 row of a numpy matrix. Once the
+# index is large enough, rows are grouped into inverted lists around k-means
+# centroids (IVF): a query scores the centroids, then only the rows in the
+# closest few lists. Saves and deletes update the index in place; the
+# centroids are retrained whenever the index has doubled since they were fit.
+# The model manager uses it to put the most similar curated examples in the
+# prompt as few-shot examples.
+#
+# Usage:
+#   index = ExampleIndex.open("training_data")
+#   index.add(filename, instruction, "Python")
+#   index.search("parse a csv file", k=5)           # [(filename, similarity), ...]
+#   index.few_shot("parse a csv file", language="python", token_budget=512)
+
+import os
+import re
+import json
+import zlib
+import threading
+
+import numpy as np
+
+from dataset_builder import CACHE_DIR_NAME, to_training_example
+
+EMBEDDING_DIM = 256
+FEATURE_VERSION = 1     # bump when the features change, so persisted vectors are rebuilt
+
+# Below this many examples every row is scored; above it the IVF lists are used
+MIN_IVF_SIZE = 2048
+# Lists probed per query (more: better recall, slower)
+NPROBE = 8
+KMEANS_ITERATIONS = 8
+# Rows sampled per centroid when fitting k-means
+KMEANS_SAMPLE_PER_LIST = 64
+SEED = 1
+
+# Unit-norm embeddings are stored as int8 at this scale (25 MB per 100k examples)
+QUANT_SCALE = 127
+
+# Few-shot defaults: examples injected, tokens they may take, and how similar they must be
+FEW_SHOT_EXAMPLES = 2
+FEW_SHOT_TOKEN_BUDGET = 512
+FEW_SHOT_MIN_SIMILARITY = 0.3
+CHARS_PER_TOKEN = 4
+
+INDEX_FILENAME = "example_index.npz"
+
+_TOKEN_RE = re.compile(r"\w+")
+
+# Words that say nothing about what code is wanted
+STOPWORDS = frozenset("""
+    a an the and or of to in on for with by from as at is are be it this that these those
+    i me my we you your please can could would should will write create make give show
+    code script function program using use how do does what which some
+""".split())
+
+
+def _features(text):
+    words = [w for w in _TOKEN_RE.findall(text.lower()) if w not in STOPWORDS]
+    features = [(f"w:{w}", 1.0) for w in words]
+    features += [(f"b:{a} {b}", 1.0) for a, b in zip(words, words[1:])]
+    for w in words:
+        padded = f"#{w}#"
+        features += [(f"c:{padded[i:i + 3]}", 0.5) for i in range(len(padded) - 2)]
+    return features
+
+
+def embed(text, dim=EMBEDDING_DIM):
+    """
+    Hashed-feature embedding of a text
+
+    :return: float32 vector of length `dim` with unit norm (all zeros for an empty text)
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature, weight in _features(text):
+        h = zlib.crc32(feature.encode("utf-8"))
+        # The top hash bit picks the sign, so collisions tend to cancel out
+        vector[h % dim] += weight if h & 0x80000000 else -weight
+    # Sublinear term frequency, then unit length for cosine similarity
+    vector = np.sign(vector) * np.log1p(np.abs(vector))
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _kmeans(vectors, n_lists, iterations=KMEANS_ITERATIONS, seed=SEED):
+    """Spherical k-means: unit-norm centroids maximizing cosine similarity"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # Empty lists keep their previous centroid
+        filled = norms[:, 0] > 0
+        centroids[filled] = sums[filled] / norms[filled]
+    return centroids
+
+
+class ExampleIndex:
+    def __init__(self, dim=EMBEDDING_DIM, nprobe=NPROBE):
+        """
+        In-memory nearest-neighbour index over example instructions
+
+        :param dim: Embedding size
+        :param nprobe: Inverted lists scored per query once the IVF is built
+        """
+        self.dim = dim
+        self.nprobe = nprobe
+        self.path = None
+        self.training_dir = None
+
+        self.vectors = np.zeros((0, dim), dtype=np.int8)      # row -> quantized embedding (grown by doubling)
+        self.lang = np.zeros(0, dtype=np.int16)                # row -> index into self.languages
+        self.assign = np.zeros(0, dtype=np.int32)              # row -> inverted list (-1 before the IVF exists)
+        self.keys = []                                         # row -> key
+        self.rows = {}                                         # key -> row
+        self.languages = []
+        self.centroids = None
+        self.trained_size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _language_code(self, language):
+        language = (language or "").lower()
+        if language not in self.languages:
+            self.languages.append(language)
+        return self.languages.index(language)
+
+    def _append(self, key, vector, language_code):
+        row = len(self.keys)
+        if row == len(self.vectors):
+            capacity = max(1024, 2 * row)
+            self.vectors = np.resize(self.vectors, (capacity, self.dim))
+            self.lang = np.resize(self.lang, capacity)
+            self.assign = np.resize(self.assign, capacity)
+        self.vectors[row] = np.round(vector * QUANT_SCALE)
+        self.lang[row] = language_code
+        self.assign[row] = -1 if self.centroids is None else int(np.argmax(self.centroids @ vector))
+        self.keys.append(key)
+        self.rows[key] = row
+
+    def _remove(self, key):
+        row = self.rows.pop(key, None)
+        if row is None:
+            return False
+        # Move the last row into the gap so the matrix stays dense
+        last = len(self.keys) - 1
+        if row != last:
+            moved = self.keys[last]
+            self.vectors[row] = self.vectors[last]
+            self.lang[row] = self.lang[last]
+            self.assign[row] = self.assign[last]
+            self.keys[row] = moved
+            self.rows[moved] = row
+        self.keys.pop()
+        return True
+
+    def _train(self):
+        """Fit the IVF centroids and reassign every row to its closest one"""
+        size = len(self.keys)
+        n_lists = max(16, int(np.sqrt(size)))
+        vectors = self.vectors[:size].astype(np.float32) / QUANT_SCALE
+        rng = np.random.default_rng(SEED)
+        sample = vectors[rng.choice(size, min(size, n_lists * KMEANS_SAMPLE_PER_LIST), replace=False)]
+        self.centroids = _kmeans(sample, n_lists)
+        assign = np.empty(size, dtype=np.int32)
+        for start in range(0, size, 16384):
+            assign[start:start + 16384] = np.argmax(vectors[start:start + 16384] @ self.centroids.T, axis=1)
+        self.assign[:size] = assign
+        self.trained_size = size
+
+    def _maybe_train(self):
+        size = len(self.keys)
+        if size >= MIN_IVF_SIZE and size >= 2 * self.trained_size:
+            self._train()
+
+    def add(self, key, instruction, language=None):
+        """
+        Index (or re-index) an example
+
+        :param key: Example identifier (the training data filename)
+        :param instruction: Text the example is retrieved by
+        :param language: Language it is retrieved for, e.g. 'Python'
+        """
+        vector = embed(instruction, self.dim)
+        with self._lock:
+            self._remove(key)
+            self._append(key, vector, self._language_code(language))
+            self._maybe_train()
+
+    def add_many(self, examples):
+        """
+        Index a batch of examples under one lock, refitting the IVF at most once
+
+        :param examples: Iterable of (key, instruction, language)
+        """
+        embedded = [(key, embed(instruction, self.dim), language) for key, instruction, language in examples]
+        with self._lock:
+            for key, vector, language in embedded:
+                self._remove(key)
+                self._append(key, vector, self._language_code(language))
+            self._maybe_train()
+
+    def remove(self, key):
+        """Remove an example from the index; returns False if it was not indexed"""
+        with self._lock:
+            return self._remove(key)
+
+    def search(self, query, k=5, language=None):
+        """
+        Most similar indexed instructions
+
+        :param query: Text to match
+        :param k: Number of results
+        :param language: Only return examples for this language
+        :return: List of (key, cosine similarity), most similar first
+        """
+        vector = embed(query, self.dim)
+        if not vector.any():
+            return []
+        with self._lock:
+            size = len(self.keys)
+            mask = np.ones(size, dtype=bool)
+            if self.centroids is not None:
+                probed = np.zeros(len(self.centroids), dtype=bool)
+                probed[np.argsort(self.centroids @ vector)[-self.nprobe:]] = True
+                mask = probed[self.assign[:size]]
+            if language is not None:
+                if language.lower() not in self.languages:
+                    return []
+                mask &= self.lang[:size] == self.languages.index(language.lower())
+            rows = np.flatnonzero(mask)
+            if len(rows) == 0:
+                return []
+            scores = self.vectors[rows].astype(np.float32) @ vector / QUANT_SCALE
+            top = np.argpartition(-scores, min(k, len(rows)) - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(self.keys[rows[i]], float(scores[i])) for i in top]
+
+    def few_shot(self, query, language=None, k=FEW_SHOT_EXAMPLES, token_budget=FEW_SHOT_TOKEN_BUDGET,
+                 count_tokens=None, min_similarity=FEW_SHOT_MIN_SIMILARITY):
+        """
+        The most similar curated examples that fit a token budget
+
+        :param count_tokens: Callable returning the token count of a text
+            (default: estimated from its length)
+        :return: List of dicts with 'key', 'similarity', 'instruction' and
+            'response', most similar first
+        """
+        count_tokens = count_tokens or (lambda text: len(text) // CHARS_PER_TOKEN)
+        examples = []
+        for key, similarity in self.search(query, k=4 * k, language=language):
+            if similarity < min_similarity or len(examples) == k:
+                break
+            example = self.load_example(key)
+            if example is None:
+                continue
+            cost = count_tokens(example["instruction"]) + count_tokens(example["response"])
+            if cost > token_budget:
+                continue
+            token_budget -= cost
+            examples.append(dict(example, key=key, similarity=similarity))
+        return examples
+
+    def load_example(self, key):
+        """Instruction and response of an indexed example, read from the training data directory"""
+        if self.training_dir is None:
+            return None
+        try:
+            with open(os.path.join(self.training_dir, key), "r", encoding="utf8") as f:
+                messages = to_training_example(json.load(f))
+        except Exception as e:
+            print(f"Example index: could not read {key}: {e}")
+            return None
+        return {"instruction": messages[0]["content"], "response": messages[1]["content"]}
+
+    def sync(self, training_dir):
+        """
+        Bring the index in line with the JSON files in `training_dir`
+
+        Only files the index has not seen are read.
+
+        :return: (number of files added, number removed)
+        """
+        current = {name for name in os.listdir(training_dir) if name.endswith(".json")}
+        with self._lock:
+            removed = [key for key in self.keys if key not in current]
+            for key in removed:
+                self._remove(key)
+
+            added = 0
+            for name in current.difference(self.rows):
+                try:
+                    with open(os.path.join(training_dir, name), "r", encoding="utf8") as f:
+                        data = json.load(f)
+                    instruction = to_training_example(data)[0]["content"]
+                except Exception as e:
+                    print(f"Example index: skipping {name}: {e}")
+                    continue
+                self._append(name, embed(instruction, self.dim), self._language_code(data.get("language")))
+                added += 1
+            self._maybe_train()
+        return added, len(removed)
+
+    def save(self, path=None):
+        path = path or self.path
+        with self._lock:
+            size = len(self.keys)
+            state = {
+                "params": np.array([self.dim, FEATURE_VERSION]),
+                "vectors": self.vectors[:size],
+                "lang": self.lang[:size],
+                "keys": np.array(self.keys, dtype=str),
+                "languages": np.array(self.languages, dtype=str),
+            }
+        # Per-process name: API replicas open (and may save) the same index at once
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, **state)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def open(cls, training_dir, **kwargs):
+        """
+        Load the persisted index for a training directory and sync it with the files on disk
+
+        :param training_dir: Training data directory
+        :return: A ready-to-use ExampleIndex
+        """
+        index = cls(**kwargs)
+        index.training_dir = training_dir
+        cache_dir = os.path.join(training_dir, CACHE_DIR_NAME)
+        os.makedirs(cache_dir, exist_ok=True)
+        index.path = os.path.join(cache_dir, INDEX_FILENAME)
+
+        try:
+            with np.load(index.path) as state:
+                if state["params"].tolist() == [index.dim, FEATURE_VERSION]:
+                    index.languages = state["languages"].tolist()
+                    index.keys = state["keys"].tolist()
+                    index.rows = {key: row for row, key in enumerate(index.keys)}
+                    index.vectors = state["vectors"].astype(np.int8)
+                    index.lang = state["lang"].astype(np.int16)
+                    index.assign = np.full(len(index.keys), -1, dtype=np.int32)
+        except (OSError, ValueError, KeyError):
+            pass
+
+        added, removed = index.sync(training_dir)
+        if added or removed:
+            index.save()
+        # Persisted rows load without the IVF; fit it now if the index is big enough
+        if index.centroids is None and len(index) >= MIN_IVF_SIZE:
+            index._train()
+        return index
@@ -1,108 +1,253 @@
 # finetune_model.py
-from transformers import Trainer, TrainingArguments, AutoModelForCausalLM, AutoTokenizer
 import os
-import glob
-import json
+import argparse
+
+import torch
+from transformers import Trainer, TrainingArguments, AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+
+from dataset_builder import DatasetBuilder
+from dedup import dedup_snapshot, NEAR_THRESHOLD
+from batch_autotune import autotune_cached
+from eval_harness import exclude_held_out
+from sequence_packing import DynamicPaddingCollator, PackedCollator, ThroughputCallback
+from token_shards import TokenShardCache, TokenShardDataset, PackedTokenDataset
 
 # Model and data paths
 model_name = "meta-llama/CodeLlama-13b-Instruct-hf"
 training_data_dir = "./training_data"  # Directory containing your JSON files
 output_dir = "./finetuned-model"
 
-# Find all JSON files in the directory
-json_files = glob.glob(os.path.join(training_data_dir, "*.json"))
-print(f"Found {len(json_files)} JSON files in {training_data_dir}")
+# How examples are batched:
+# - max_length: pad every example to max_length (the original behaviour, kept as a baseline)
+# - bucketed:   group examples of similar length and pad to the longest in each batch
+# - packed:     concatenate conversations into full max_length rows
+BATCHING_MODES = ["max_length", "bucketed", "packed"]
+
+# Attention projections of the Llama/CodeLlama architecture
+DEFAULT_LORA_TARGET_MODULES = ["q_proj", "k_proj", "v_proj", "o_proj"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fine-tune CodeLlama on the saved training examples")
+    parser.add_argument("--model-name", default=model_name)
+    parser.add_argument("--training-data-dir", default=training_data_dir)
+    parser.add_argument("--output-dir", default=output_dir)
+    parser.add_argument("--max-length", type=int, default=1024)
+    parser.add_argument("--batching", choices=BATCHING_MODES, default="max_length",
+                        help="Batching strategy (default: %(default)s)")
+    parser.add_argument("--num-proc", type=int, default=None,
+                        help="Tokenization worker processes (default: half the CPU cores)")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="Train on exact and near-duplicate examples instead of removing them")
+    parser.add_argument("--dedup-threshold", type=float, default=NEAR_THRESHOLD,
+                        help="Estimated Jaccard similarity above which examples are near duplicates")
+    parser.add_argument("--hold-out", type=float, default=0.0,
+                        help="Share of examples kept out of training for eval_harness.py (e.g. 0.05)")
+    parser.add_argument("--learning-rate", type=float, default=None,
+                        help="Defaults to 2e-5 for full fine-tuning and 2e-4 with --lora")
+    parser.add_argument("--gradient-checkpointing", action="store_true",
+                        help="Recompute activations in the backward pass to save memory")
+
+    batching = parser.add_argument_group("Batch size")
+    batching.add_argument("--target-batch-size", type=int, default=16,
+                          help="Global batch size (micro-batch x accumulation steps)")
+    batching.add_argument("--autotune", action="store_true",
+                          help="Probe the largest micro-batch that fits, with and without gradient "
+                               "checkpointing (only with it under --gradient-checkpointing), and reuse "
+                               "the result on later runs")
+    batching.add_argument("--retune", action="store_true",
+                          help="Ignore the cached autotune result and probe again (implies --autotune)")
+
+    lora = parser.add_argument_group("LoRA")
+    lora.add_argument("--lora", action="store_true",
+                      help="Train low-rank adapters on a frozen base model and save only the adapter")
+    lora.add_argument("--lora-rank", type=int, default=16)
+    lora.add_argument("--lora-alpha", type=int, default=32)
+    lora.add_argument("--lora-dropout", type=float, default=0.05)
+    lora.add_argument("--lora-target-modules", nargs="+", default=DEFAULT_LORA_TARGET_MODULES)
+    lora.add_argument("--quantize", choices=["none", "4bit", "8bit"], default="none",
+                      help="Load the frozen base in 4-bit NF4 (QLoRA) or int8; requires --lora")
+    args = parser.parse_args()
+
+    if args.quantize != "none" and not args.lora:
+        parser.error("--quantize only makes sense with --lora (quantized weights cannot be trained directly)")
+    return args
 
-# Combine all JSON files into a single JSONL file for training
-temp_jsonl_file = os.path.join(training_data_dir, "combined_training_data.jsonl")
 
-with open(temp_jsonl_file, "w", encoding="utf-8") as outfile:
-    for json_file in json_files:
+def load_base_model(model_name, quantize="none"):
+    """
+    Load the base model for training, optionally quantized for QLoRA
+
+    :param model_name: Hugging Face model name or local path
+    :param quantize: 'none', '4bit' or '8bit'
+    :return: The loaded model
+    """
+    if quantize == "4bit":
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_use_double_quant=True
+        )
+    elif quantize == "8bit":
+        quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+    else:
+        return AutoModelForCausalLM.from_pretrained(model_name)
+
+    return AutoModelForCausalLM.from_pretrained(
+        model_name,
+        quantization_config=quantization_config,
+        device_map={"": 0},
+        torch_dtype=torch.float16,
+    )
+
+
+def prepare_model_for_training(model, lora=False, lora_rank=16, lora_alpha=32, lora_dropout=0.05,
+                               lora_target_modules=None, gradient_checkpointing=False):
+    """
+    Enable gradient checkpointing and wrap the model with LoRA adapters if requested
+
+    :return: The model to hand to the Trainer
+    """
+    quantized = getattr(model, "is_loaded_in_4bit", False) or getattr(model, "is_loaded_in_8bit", False)
+
+    if lora:
         try:
-            with open(json_file, "r", encoding="utf-8") as infile:
-                data = json.load(infile)
-                
-                # Process the data based on your JSON structure
-                # Example: Convert comparison data to training format
-                if "source" in data and data["source"] == "AI_Comparison":
-                    # Choose which response to use (other_ai_response is often better)
-                    # You might want to implement logic to decide which response to use
-                    training_example = {
-                        "messages": [
-                            {"role": "user", "content": data["instruction"]},
-                            {"role": "assistant", "content": data["other_ai_response"]}
-                        ]
-                    }
-                else:
-                    # Regular training examples
-                    training_example = {
-                        "messages": [
-                            {"role": "user", "content": data["instruction"]},
-                            {"role": "assistant", "content": data["response"]}
-                        ]
-                    }
-                
-                # Write as JSONL (one JSON object per line)
-                outfile.write(json.dumps(training_example) + "\n")
-                print(f"Processed: {json_file}")
-        except Exception as e:
-            print(f"Error processing {json_file}: {e}")
-
-# Load model and tokenizer
-model = AutoModelForCausalLM.from_pretrained(model_name)
-tokenizer = AutoTokenizer.from_pretrained(model_name)
-
-# Define training arguments
-training_args = TrainingArguments(
-    output_dir=output_dir,
-    per_device_train_batch_size=4,
-    gradient_accumulation_steps=4,
-    num_train_epochs=3,
-    learning_rate=2e-5,
-    save_strategy="epoch",
-    logging_dir="./logs",
-    logging_steps=10,
-    fp16=True,
-    save_total_limit=2,
-)
-
-# Load the combined JSONL dataset
-from datasets import load_dataset
-train_dataset = load_dataset("json", data_files=temp_jsonl_file)["train"]
-print(f"Dataset loaded with {len(train_dataset)} examples")
-
-# Tokenize the dataset
-def tokenize_function(examples):
-    # This processes the messages format from the JSONL file
-    prompts = []
-    for message_list in examples["messages"]:
-        # Create prompt format: "user: ... assistant: ..."
-        formatted_text = ""
-        for message in message_list:
-            role = message["role"]
-            content = message["content"]
-            formatted_text += f"{role}: {content}\n"
-        prompts.append(formatted_text)
-    
-    return tokenizer(prompts, truncation=True, padding="max_length", max_length=1024)
-
-# Apply tokenization
-tokenized_dataset = train_dataset.map(tokenize_function, batched=True)
-
-# Initialize the Trainer
-trainer = Trainer(
-    model=model,
-    args=training_args,
-    train_dataset=tokenized_dataset,
-    tokenizer=tokenizer,
-)
-
-# Start training
-trainer.train()
-
-# Save the final model
-model.save_pretrained(output_dir)
-tokenizer.save_pretrained(output_dir)
-
-# Optionally, clean up the temporary JSONL file
-# os.remove(temp_jsonl_file)
\ No newline at end of file
+            from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
+        except ImportError:
+            raise ImportError("LoRA fine-tuning requires the 'peft' package: pip install peft")
+
+        if quantized:
+            # Casts norms to fp32 and enables input grads so checkpointing works on a frozen base
+            model = prepare_model_for_kbit_training(model, use_gradient_checkpointing=gradient_checkpointing)
+
+        lora_config = LoraConfig(
+            r=lora_rank,
+            lora_alpha=lora_alpha,
+            lora_dropout=lora_dropout,
+            target_modules=lora_target_modules or DEFAULT_LORA_TARGET_MODULES,
+            bias="none",
+            task_type="CAUSAL_LM",
+        )
+        model = get_peft_model(model, lora_config)
+        model.print_trainable_parameters()
+
+    if gradient_checkpointing:
+        # Non-reentrant checkpointing works with a frozen embedding layer
+        model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+    # Training never reuses the KV cache
+    model.config.use_cache = False
+
+    return model
+
+
+def main():
+    args = parse_args()
+
+    # Incrementally convert new or changed JSON files into a versioned Arrow snapshot.
+    # Kept under main() because the builder's process pool re-imports this module.
+    dataset_builder = DatasetBuilder(args.training_data_dir)
+    snapshot_path = dataset_builder.build()
+    if not args.no_dedup:
+        snapshot_path = dedup_snapshot(
+            snapshot_path, dataset_builder.cache_dir, threshold=args.dedup_threshold, workers=args.num_proc
+        )
+    if args.hold_out:
+        snapshot_path = exclude_held_out(snapshot_path, dataset_builder.cache_dir, args.hold_out)
+
+    # Load model and tokenizer
+    model = load_base_model(args.model_name, args.quantize)
+    model = prepare_model_for_training(
+        model,
+        lora=args.lora,
+        lora_rank=args.lora_rank,
+        lora_alpha=args.lora_alpha,
+        lora_dropout=args.lora_dropout,
+        lora_target_modules=args.lora_target_modules,
+        gradient_checkpointing=args.gradient_checkpointing,
+    )
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+
+    # CodeLlama ships without a pad token
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    # Pick micro-batch and accumulation steps for the target global batch size
+    micro_batch_size = 4
+    gradient_accumulation_steps = max(1, args.target_batch_size // micro_batch_size)
+    if args.autotune or args.retune:
+        model.to("cuda" if torch.cuda.is_available() else "cpu")
+        tuned = autotune_cached(
+            model,
+            args.model_name,
+            args.max_length,
+            args.target_batch_size,
+            retune=args.retune,
+            gradient_checkpointing=args.gradient_checkpointing,
+            lora=args.lora and (args.lora_rank, sorted(args.lora_target_modules)),
+            quantize=args.quantize,
+            batching=args.batching,
+        )
+        micro_batch_size = tuned["micro_batch_size"]
+        gradient_accumulation_steps = tuned["gradient_accumulation_steps"]
+
+    # Define training arguments
+    training_args = TrainingArguments(
+        output_dir=args.output_dir,
+        per_device_train_batch_size=micro_batch_size,
+        gradient_accumulation_steps=gradient_accumulation_steps,
+        num_train_epochs=3,
+        learning_rate=args.learning_rate or (2e-4 if args.lora else 2e-5),
+        save_strategy="epoch",
+        logging_dir="./logs",
+        logging_steps=10,
+        fp16=True,
+        save_total_limit=2,
+        group_by_length=args.batching == "bucketed",
+    )
+
+    # Tokenize into memory-mapped shards; re-runs with the same tokenizer,
+    # template, max length and dataset version skip tokenization entirely
+    shard_cache = TokenShardCache(
+        os.path.join(dataset_builder.cache_dir, "tokens"),
+        tokenizer,
+        max_length=args.max_length,
+        num_proc=args.num_proc,
+    )
+    train_dataset = TokenShardDataset(shard_cache.build(snapshot_path))
+    print(f"Dataset loaded with {len(train_dataset)} examples")
+
+    if args.batching == "packed":
+        train_dataset = PackedTokenDataset(train_dataset, args.max_length, tokenizer.eos_token_id)
+        print(f"Packed into {len(train_dataset)} rows of up to {args.max_length} tokens")
+        data_collator = PackedCollator(
+            tokenizer.pad_token_id,
+            attn_implementation=getattr(model.config, "_attn_implementation", None),
+            mask_dtype=model.dtype,
+        )
+    else:
+        data_collator = DynamicPaddingCollator(
+            tokenizer.pad_token_id,
+            pad_to_length=args.max_length if args.batching == "max_length" else None,
+        )
+
+    # Initialize the Trainer
+    trainer = Trainer(
+        model=model,
+        args=training_args,
+        train_dataset=train_dataset,
+        tokenizer=tokenizer,
+        data_collator=data_collator,
+        callbacks=[ThroughputCallback(data_collator.stats)],
+    )
+
+    # Start training
+    trainer.train()
+
+    # Save the final model (only the adapter weights when training with LoRA)
+    model.save_pretrained(args.output_dir)
+    tokenizer.save_pretrained(args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+# language_detection.py - Keyword-based routing of prompts to a language model
+#
+# Kept free of torch and transformers so front ends, routers and bulk tools
+# can detect languages without loading the model stack.
+#
+# Usage:
+#   detect_language("Get-ChildItem recursively in PowerShell")   # 'powershell'
+
+# Prompts mentioning any of these are routed to the PowerShell model
+POWERSHELL_KEYWORDS = ['get-', 'set-', 'new-', 'remove-', 'invoke-', 
+                       'windows', 'azure', 'active directory', 
+                       'powershell', 'cmdlet']
+
+
+def detect_language(prompt):
+    """
+    Detect programming language from the prompt
+    """
+    # Simple language detection based on keywords
+    prompt_lower = prompt.lower()
+    
+    # PowerShell detection
+    if any(keyword in prompt_lower for keyword in POWERSHELL_KEYWORDS):
+        return 'powershell'
+    
+    # Default to Python
+    return 'python'
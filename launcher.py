@@ -10,6 +10,11 @@ from threading import Thread
 
 # Import custom modules
 from model_manager import MultiModelManager
+from dedup import DedupIndex
+from example_index import ExampleIndex
+from request_queue import RequestQueue, QueueFull, estimate_cost
+from cancellation import CancellationToken
+from session_store import SessionStore
 from theme import create_theme  # Import theme configuration
 from theme import get_logo_with_dimensions
 
@@ -18,6 +23,11 @@ CACHE_DIR = "models"
 TRAINING_DIR = "training_data"
 CHAT_HISTORY_DIR = "chat_history"
 
+# Admission control for generation requests from the UI
+MAX_CONCURRENT_GENERATIONS = 1
+MAX_QUEUED_GENERATIONS = 16
+MAX_REQUESTS_PER_SESSION = 2
+
 # Import application settings from theme
 from theme import APP_NAME, APP_TAGLINE, APP_LOGO, PRIMARY_COLOR, SECONDARY_COLOR, AVATAR_EMOJI
 
@@ -321,49 +331,137 @@ class MultiLanguageCodeBuddy:
             }
         }
         
+        # Load tests: serve a deterministic fake model instead (see stub_backend.py)
+        if os.environ.get("CODEBUDDY_STUB_BACKEND"):
+            from stub_backend import stub_models_config
+            for language, config in stub_models_config(tuple(self.models_config)).items():
+                self.models_config[language].update(config)
+        
         # Initialize model manager
         self.model_manager = MultiModelManager(self.models_config, cache_dir=CACHE_DIR)
         
         # Store the auth token for later use
         self.model_manager.set_auth_token(hf_token)
         
-        # Status message for model loading state
-        self.status_message = ""
+        # Duplicate index over the training data, checked on every save
+        self.dedup_index = DedupIndex.open(TRAINING_DIR)
+        
+        # Similarity index over the training data, for few-shot prompts
+        self.example_index = ExampleIndex.open(TRAINING_DIR)
+        self.model_manager.example_index = self.example_index
+        
+        # Every generation waits here for a slot, fairly across browser sessions
+        self.request_queue = RequestQueue(
+            max_concurrency=MAX_CONCURRENT_GENERATIONS,
+            max_depth=MAX_QUEUED_GENERATIONS,
+            max_per_session=MAX_REQUESTS_PER_SESSION
+        )
+        
+        # Cancellation token of each browser session's current generation
+        self.active_generations = {}
+        
+        # Chat turns and token-ID caches persisted per session, so a restart or reconnect resumes them
+        self.session_store = SessionStore(CHAT_HISTORY_DIR)
+        Thread(target=self.session_store.compact, daemon=True).start()
 
     ### Core Functions
 
-    def generate_code(self, prompt, chat_history=None, language=None, temperature=0.2, max_new_tokens=1024, repetition_penalty=1.1):
-        """Generate code based on prompt and chat history, lazily loading models as needed"""
-        self.status_message = "Detecting language..."
-        yield self.status_message
+    def start_generation(self, session_id):
+        """Register a new generation for a session, cancelling the one it replaces"""
+        cancel_token = CancellationToken()
+        previous = self.active_generations.get(session_id)
+        self.active_generations[session_id] = cancel_token
+        if previous is not None:
+            previous.cancel("superseded by a new message")
+        return cancel_token
+    
+    def finish_generation(self, session_id, cancel_token):
+        if self.active_generations.get(session_id) is cancel_token:
+            del self.active_generations[session_id]
+    
+    def cancel_generation(self, session_id, reason):
+        """Stop a session's in-flight generation (if any) at its next decoding step"""
+        cancel_token = self.active_generations.pop(session_id, None)
+        if cancel_token is not None:
+            cancel_token.cancel(reason)
+            print(f"Cancelled generation: {reason}")
+    
+    def history_key(self, request):
+        """
+        Chat session a browser request belongs to
         
-        # Detect language if not specified
-        if language is None or language == "Auto Detect":
-            language = self.model_manager.detect_language(prompt)
-        else:
-            language = language.lower()
-            
-        # Update status to indicate model loading if needed
-        if not self.model_manager.is_model_loaded(language):
-            self.status_message = f"Loading {language.capitalize()} model. This may take a moment..."
-            yield self.status_message
+        `?session=<name>` in the URL survives reloads and restarts; otherwise
+        the tab's Gradio session hash is used.
+        """
+        if request is None:
+            return None
+        params = getattr(request, "query_params", None) or {}
+        return params.get("session") or request.session_hash
+    
+    def generate_code(self, prompt, chat_history=None, language=None, temperature=0.2, max_new_tokens=1024, repetition_penalty=1.1,
+                      session_id=None, cancel_token=None, token_cache=None, best_of=1, few_shot=0):
+        """
+        Generate code based on prompt and chat history, lazily loading models as needed
+        
+        Sessions generate concurrently, so status is yielded per call rather than kept on the launcher.
         
-        # Generate code using the appropriate model
-        self.status_message = f"Generating {language.capitalize()} code..."
-        yield self.status_message
+        :yield: ("status", message) while queued or loading, then ("code", formatted response)
+        """
+        # Wait for an inference slot; reject straight away when the queue is full
+        try:
+            ticket = self.request_queue.submit(session_id, estimate_cost(prompt, max_new_tokens * best_of, chat_history))
+        except QueueFull as e:
+            yield "status", f"{e}. Please try again in about {e.retry_after}s."
+            return
         
-        # Process the response
-        for response in self.model_manager.generate_code(
-            prompt,
-            chat_history=chat_history, 
-            language=language,
-            temperature=temperature,
-            max_new_tokens=max_new_tokens,
-            repetition_penalty=repetition_penalty
-        ):
-            # Format the code with appropriate syntax highlighting
-            formatted_response = self.model_manager.format_code(response, language)
-            yield formatted_response
+        finished = False
+        try:
+            while not ticket.wait(timeout=1.0):
+                if cancel_token is not None and cancel_token.cancelled:
+                    return
+                yield "status", (f"Queued: position {self.request_queue.position(ticket)}, "
+                                 f"waiting {ticket.wait_time:.0f}s...")
+            
+            yield "status", "Detecting language..."
+            
+            # Detect language if not specified
+            if language is None or language == "Auto Detect":
+                language = self.model_manager.detect_language(prompt)
+            else:
+                language = language.lower()
+                
+            # Update status to indicate model loading if needed
+            if not self.model_manager.is_model_loaded(language):
+                yield "status", f"Loading {language.capitalize()} model. This may take a moment..."
+            
+            # Generate code using the appropriate model
+            status = f"Generating {language.capitalize()} code..."
+            if ticket.wait_time >= 1.0:
+                status += f" (queued {ticket.wait_time:.0f}s)"
+            yield "status", status
+            
+            # Process the response
+            for response in self.model_manager.generate_code(
+                prompt,
+                chat_history=chat_history, 
+                language=language,
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+                repetition_penalty=repetition_penalty,
+                cancel_token=cancel_token,
+                token_cache=token_cache,
+                best_of=best_of,
+                few_shot=few_shot
+            ):
+                # Format the code with appropriate syntax highlighting
+                formatted_response = self.model_manager.format_code(response, language)
+                yield "code", formatted_response
+            finished = True
+        finally:
+            # Also runs when the UI abandons the generator: stop the model and free the slot
+            if cancel_token is not None and not finished:
+                cancel_token.cancel("abandoned by the UI")
+            self.request_queue.release(ticket)
 
     ### Training Data Management
 
@@ -372,6 +470,11 @@ class MultiLanguageCodeBuddy:
         if not task or not solution:
             return "Missing task or solution"
         
+        # Skip exact duplicates (e.g. repeated like/dislike clicks)
+        duplicate = self.dedup_index.check(task, solution)
+        if duplicate and duplicate["kind"] == "exact":
+            return f"Skipped: identical to existing example {duplicate['key']}"
+        
         # Detect language
         language = self.model_manager.detect_language(task)
         language_name = language.capitalize()
@@ -392,8 +495,10 @@ class MultiLanguageCodeBuddy:
         try:
             with open(filepath, 'w', encoding='utf8') as f:
                 json.dump(data, f, indent=2)
-                
-            return f"Saved {language_name} example to {filepath}"
+            
+            self.dedup_index.add(filename, task, solution, source)
+            self.example_index.add(filename, task, language_name)
+            return f"Saved {language_name} example to {filepath}{self._near_duplicate_note(duplicate)}"
         except Exception as e:
             return f"Error saving example: {str(e)}"
 
@@ -402,6 +507,11 @@ class MultiLanguageCodeBuddy:
         if not question or not codebuddy_response or not other_ai_response:
             return "Missing question or one of the responses"
         
+        # Comparisons train on the other AI's response, so that is what is deduplicated
+        duplicate = self.dedup_index.check(question, other_ai_response)
+        if duplicate and duplicate["kind"] == "exact":
+            return f"Skipped: identical to existing example {duplicate['key']}"
+        
         # Detect language if not specified
         if not language or language == "Auto Detect":
             language = self.model_manager.detect_language(question)
@@ -427,11 +537,19 @@ class MultiLanguageCodeBuddy:
         try:
             with open(filepath, 'w', encoding='utf8') as f:
                 json.dump(data, f, indent=2)
-                
-            return f"Saved comparison example to {filepath}"
+            
+            self.dedup_index.add(filename, question, other_ai_response, "AI_Comparison")
+            self.example_index.add(filename, question, language_name)
+            return f"Saved comparison example to {filepath}{self._near_duplicate_note(duplicate)}"
         except Exception as e:
             return f"Error saving comparison example: {str(e)}"
 
+    def _near_duplicate_note(self, duplicate):
+        """Suffix for save status messages when a near-duplicate already exists"""
+        if duplicate and duplicate["kind"] == "near":
+            return f" (near-duplicate of {duplicate['key']}, {duplicate['similarity']:.0%} similar)"
+        return ""
+
     def save_positive_feedback(self, chat_history):
         """Save positive feedback for the last response"""
         if not chat_history:
@@ -580,6 +698,8 @@ class MultiLanguageCodeBuddy:
         
         try:
             os.remove(filepath)
+            self.dedup_index.remove(filename)
+            self.example_index.remove(filename)
             return f"Deleted example: {filename}", self.refresh_training_examples()
         except Exception as e:
             return f"Error deleting example: {str(e)}", []
@@ -714,6 +834,18 @@ class MultiLanguageCodeBuddy:
                                     label="Max Tokens",
                                     elem_classes="modern-slider"
                                 )
+                            with gr.Row():
+                                best_of = gr.Slider(
+                                    minimum=1, maximum=8, value=1, step=1,
+                                    label="Best of (sample N answers at once, keep the one whose code parses)",
+                                    elem_classes="modern-slider"
+                                )
+                            with gr.Row():
+                                few_shot = gr.Slider(
+                                    minimum=0, maximum=4, value=0, step=1,
+                                    label="Few-shot examples (similar saved training examples added to the prompt)",
+                                    elem_classes="modern-slider"
+                                )
                                 
                             # Action buttons (already present)
                             with gr.Row(elem_classes="action-buttons"):
@@ -890,7 +1022,11 @@ class MultiLanguageCodeBuddy:
                 return f"**Current Language**: {choice}"
             
             # Clear conversation handler
-            def clear_all():
+            def clear_all(request: gr.Request = None):
+                self.cancel_generation(request.session_hash if request else None, "chat cleared")
+                history_id = self.history_key(request)
+                if history_id:
+                    self.session_store.clear(history_id)
                 return [], gr.update(value="Conversation cleared", visible=True), gr.update(value="", language="python")
             
             # Save current response function
@@ -926,10 +1062,17 @@ class MultiLanguageCodeBuddy:
                     gr.update(value="Copied from chat history!", visible=True)
                 )
             # Modified respond function to handle the new layout
-            def respond(message, chat_history, lang_choice, temp, max_len):
+            def respond(message, chat_history, lang_choice, temp, max_len, best_of_n=1, few_shot_n=0,
+                        request: gr.Request = None):
                 if not message.strip():
                     return "", chat_history, gr.update(value="Empty message", visible=True), gr.update(value="", language="python")
                 
+                # An empty chat after a reload or restart picks up the stored session
+                history_id = self.history_key(request)
+                session = self.session_store.get(history_id) if history_id else None
+                if not chat_history and session is not None:
+                    chat_history = session.history()
+                
                 # Convert chat_history to new message format if it's not already
                 if chat_history and isinstance(chat_history[0], list):
                     chat_history = [
@@ -942,6 +1085,8 @@ class MultiLanguageCodeBuddy:
                     "role": "user", 
                     "content": message
                 })
+                if session is not None:
+                    self.session_store.append(history_id, "user", message)
                 
                 # Yield chat_history to update UI with user message first
                 yield "", chat_history, gr.update(value="Processing your request...", visible=True), gr.update(value="", language="python")
@@ -969,34 +1114,50 @@ class MultiLanguageCodeBuddy:
                 # Use generator to stream responses
                 bot_response = ""
                 code_content = ""
-                for response in self.generate_code(
-                    message,
-                    chat_history=chat_history,
-                    language=selected_language,
-                    temperature=temp, 
-                    max_new_tokens=max_len
-                ):
-                    # If the response is a status message, update status
-                    if response == self.status_message:
-                        yield "", chat_history, gr.update(value=response, visible=True), gr.update(value="", language=display_language)
-                        continue
+                # A new message from this session, or clearing the chat, cancels this one
+                session_id = request.session_hash if request else None
+                cancel_token = self.start_generation(session_id)
+                try:
+                    for kind, response in self.generate_code(
+                        message,
+                        chat_history=chat_history,
+                        language=selected_language,
+                        temperature=temp, 
+                        max_new_tokens=max_len,
+                        best_of=int(best_of_n),
+                        few_shot=int(few_shot_n),
+                        session_id=session_id,
+                        cancel_token=cancel_token,
+                        token_cache=session.token_cache if session is not None else None
+                    ):
+                        # If the response is a status message, update status
+                        if kind == "status":
+                            yield "", chat_history, gr.update(value=response, visible=True), gr.update(value="", language=display_language)
+                            continue
                     
-                    # Otherwise, it's generated code - extract actual code from markdown
-                    bot_response = response
+                        # Otherwise, it's generated code - extract actual code from markdown
+                        bot_response = response
                     
-                    # Extract code from markdown code blocks
-                    code_match = re.search(r'```(?:\w+)?\s*\n([\s\S]*?)\n```', response)
-                    if code_match:
-                        code_content = code_match.group(1).strip()
-                        # Update detected language from the code block if present
-                        lang_match = re.search(r'```(\w+)', response)
-                        if lang_match:
-                            detected_lang = lang_match.group(1).lower()
-                            # Map PowerShell to bash for display purposes
-                            if detected_lang == "powershell":
-                                display_language = "bash"
-                            else:
-                                display_language = detected_lang
+                        # Extract code from markdown code blocks
+                        code_match = re.search(r'```(?:\w+)?\s*\n([\s\S]*?)\n```', response)
+                        if code_match:
+                            code_content = code_match.group(1).strip()
+                            # Update detected language from the code block if present
+                            lang_match = re.search(r'```(\w+)', response)
+                            if lang_match:
+                                detected_lang = lang_match.group(1).lower()
+                                # Map PowerShell to bash for display purposes
+                                if detected_lang == "powershell":
+                                    display_language = "bash"
+                                else:
+                                    display_language = detected_lang
+                
+                finally:
+                    self.finish_generation(session_id, cancel_token)
+                
+                if cancel_token.cancelled:
+                    # Whatever cancelled this request now owns the chat display
+                    return
                 
                 # MODIFIED: Extract explanation text before and after the code block
                 explanation_before = ""
@@ -1032,6 +1193,9 @@ class MultiLanguageCodeBuddy:
                     "role": "assistant", 
                     "content": chat_response  # Only explanation text, no code
                 })
+                if session is not None:
+                    self.session_store.append(history_id, "assistant", chat_response)
+                    self.session_store.save_tokens(history_id)
                 
                 # Get the language that was actually used if not detected earlier
                 if not selected_language:
@@ -1129,16 +1293,18 @@ class MultiLanguageCodeBuddy:
             # Stream responses to show generation progress
             submit_btn.click(
                 fn=respond,
-                inputs=[user_input, chatbot, language_selector, temperature, max_tokens],
+                inputs=[user_input, chatbot, language_selector, temperature, max_tokens, best_of, few_shot],
                 outputs=[user_input, chatbot, status_text, code_display],
-                queue=True
+                queue=True,
+                concurrency_limit=None  # admission is handled by self.request_queue
             )
 
             user_input.submit(
                 fn=respond,
-                inputs=[user_input, chatbot, language_selector, temperature, max_tokens],
+                inputs=[user_input, chatbot, language_selector, temperature, max_tokens, best_of, few_shot],
                 outputs=[user_input, chatbot, status_text, code_display],
-                queue=True
+                queue=True,
+                concurrency_limit=None  # admission is handled by self.request_queue
             )
             
             # Connect the AI comparison tab buttons
@@ -1202,6 +1368,19 @@ class MultiLanguageCodeBuddy:
             # Initial load of training examples
             training_examples_list.value = self.refresh_training_examples()
         
+            # Closing the tab stops that session's generation
+            def on_unload(request: gr.Request):
+                self.cancel_generation(request.session_hash, "tab closed")
+            
+            interface.unload(on_unload)
+            
+            # Reopening a `?session=` link shows that conversation again
+            def restore_session(request: gr.Request):
+                history_id = self.history_key(request)
+                return self.session_store.get(history_id).history() if history_id else []
+            
+            interface.load(restore_session, inputs=None, outputs=[chatbot])
+        
         return interface
    
 # Main entry point
@@ -1210,7 +1389,7 @@ if __name__ == "__main__":
     
     # Get Hugging Face token if needed
     hf_token = os.environ.get("HUGGING_FACE_HUB_TOKEN")
-    if not hf_token:
+    if not hf_token and not os.environ.get("CODEBUDDY_STUB_BACKEND"):
         import getpass
         print("\nYou need a Hugging Face token to access the models.")
         print("Get your token at: https://huggingface.co/settings/tokens")
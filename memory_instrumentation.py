@@ -0,0 +1,193 @@
+# memory_instrumentation.py - Opt-in memory profiling for model loading and generation
+#
+# The default cleanup path (`release_memory`) is a single garbage collection
+# plus returning cached CUDA blocks. Everything else here costs nothing until
+# a MemoryProfiler is asked to record:
+#   - CUDA allocator history for the next N requests, exported as a snapshot
+#     for https://pytorch.org/memory_viz
+#   - tracemalloc statistics of the top Python allocators
+#   - host RSS and per-device allocated/reserved/peak memory
+
+import os
+import gc
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+import psutil
+import torch
+
+# Default directory for exported snapshots
+PROFILE_DIR = "memory_profiles"
+
+# Allocator events kept while recording CUDA history
+ALLOCATOR_HISTORY_ENTRIES = 100000
+
+# Python stack depth kept per allocation while tracing
+TRACEMALLOC_FRAMES = 25
+
+TOP_ALLOCATORS = 10
+
+
+def release_memory():
+    """Cheap cleanup after freeing a model: one GC pass and return cached CUDA blocks"""
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def host_memory_summary():
+    process = psutil.Process()
+    system = psutil.virtual_memory()
+    return {
+        "rss_mb": round(process.memory_info().rss / (1024**2), 1),
+        "system_used_gb": round(system.used / (1024**3), 2),
+        "system_total_gb": round(system.total / (1024**3), 2),
+    }
+
+
+def device_memory_summary():
+    if not torch.cuda.is_available():
+        return []
+    return [
+        {
+            "device": i,
+            "allocated_mb": round(torch.cuda.memory_allocated(i) / (1024**2), 1),
+            "reserved_mb": round(torch.cuda.memory_reserved(i) / (1024**2), 1),
+            "peak_allocated_mb": round(torch.cuda.max_memory_allocated(i) / (1024**2), 1),
+            "total_mb": round(torch.cuda.get_device_properties(i).total_memory / (1024**2), 1),
+        }
+        for i in range(torch.cuda.device_count())
+    ]
+
+
+def python_top_allocators(limit=TOP_ALLOCATORS):
+    """Source lines holding the most traced Python memory (empty unless tracemalloc is running)"""
+    if not tracemalloc.is_tracing():
+        return []
+    statistics = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ]).statistics("lineno")
+    return [
+        {
+            "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            "size_kb": round(stat.size / 1024, 1),
+            "count": stat.count,
+        }
+        for stat in statistics[:limit]
+    ]
+
+
+class MemoryProfiler:
+    def __init__(self, output_dir=PROFILE_DIR):
+        """
+        On-demand memory recording around requests
+
+        :param output_dir: Where snapshots are written when no path is given
+        """
+        self.output_dir = output_dir
+        self.lock = threading.Lock()
+        self.recording_cuda = False
+        self.tracing_python = False
+        self.requests_left = 0
+        self.request_peaks = []  # (label, peak allocated MB) per recorded request
+        self.last_snapshot = None
+
+    @property
+    def enabled(self):
+        return self.recording_cuda or self.tracing_python
+
+    def record_requests(self, num_requests, trace_python=False):
+        """
+        Record allocator history for the next `num_requests` requests, then export a snapshot
+
+        :param num_requests: Requests to record
+        :param trace_python: Also trace Python allocations with tracemalloc
+        """
+        with self.lock:
+            if torch.cuda.is_available() and not self.recording_cuda:
+                torch.cuda.memory._record_memory_history(max_entries=ALLOCATOR_HISTORY_ENTRIES)
+                self.recording_cuda = True
+            if trace_python and not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+                self.tracing_python = True
+            self.requests_left = num_requests
+            self.request_peaks = []
+        print(f"Recording memory for the next {num_requests} requests"
+              f"{' (CUDA allocator history)' if self.recording_cuda else ''}"
+              f"{' (Python allocations)' if self.tracing_python else ''}")
+
+    def stop(self):
+        with self.lock:
+            if self.recording_cuda:
+                torch.cuda.memory._record_memory_history(enabled=None)
+                self.recording_cuda = False
+            if self.tracing_python:
+                tracemalloc.stop()
+                self.tracing_python = False
+            self.requests_left = 0
+
+    def export_snapshot(self, path=None):
+        """
+        Write the recorded CUDA allocator history to `path`
+
+        :return: Path written, or None when no CUDA history is being recorded
+        """
+        if not self.recording_cuda:
+            return None
+        if path is None:
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = os.path.join(self.output_dir, f"cuda-memory-{time.strftime('%Y%m%d-%H%M%S')}.pickle")
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        torch.cuda.memory._dump_snapshot(path)
+        self.last_snapshot = path
+        print(f"Memory snapshot written to {path} (open it at https://pytorch.org/memory_viz)")
+        return path
+
+    @contextmanager
+    def track_request(self, label=None):
+        """
+        Wrap one request; a no-op unless recording
+
+        Records the request's peak device memory and, when the recording
+        window ends, exports a snapshot and stops recording.
+        """
+        if not self.requests_left:
+            yield
+            return
+
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        try:
+            yield
+        finally:
+            peak = torch.cuda.max_memory_allocated() / (1024**2) if torch.cuda.is_available() else None
+            with self.lock:
+                self.request_peaks.append((label, round(peak, 1) if peak is not None else None))
+                self.requests_left = max(0, self.requests_left - 1)
+                window_done = self.requests_left == 0
+            if window_done:
+                self.export_snapshot()
+                top = python_top_allocators()
+                if top:
+                    print("Top Python allocators:")
+                    for entry in top:
+                        print(f"  {entry['size_kb']:>10.1f} KB  {entry['count']:>8}  {entry['location']}")
+                self.stop()
+
+    def summary(self, top=TOP_ALLOCATORS):
+        """Host, device and (if traced) Python memory, plus the state of any recording"""
+        return {
+            "host": host_memory_summary(),
+            "devices": device_memory_summary(),
+            "python_top_allocators": python_top_allocators(top),
+            "recording": {
+                "cuda_history": self.recording_cuda,
+                "python": self.tracing_python,
+                "requests_left": self.requests_left,
+                "request_peaks_mb": self.request_peaks,
+                "last_snapshot": self.last_snapshot,
+            },
+        }
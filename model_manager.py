@@ -1,28 +1,104 @@
 # model_manager.py - Optimized for Ryzen 7800X3D CPU and RTX 4070 GPU with focus on CodeLlama-13B-Instruct
 
 import os
-import gc
+import time
 import torch
 import psutil
 import numpy as np
 from threading import Thread
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
 import multiprocessing
+import threading
+from contextlib import contextmanager, ExitStack
 
 from transformers import (
     AutoTokenizer, 
     AutoModelForCausalLM, 
-    BitsAndBytesConfig
+    BitsAndBytesConfig,
+    StoppingCriteriaList,
+    LogitsProcessor,
+    LogitsProcessorList
 )
 
+from cancellation import CancellationToken, CancellationCriteria
+from memory_instrumentation import MemoryProfiler, release_memory
+from compiled_generation import CompiledGenerator
+from cpu_calibration import calibrate_cached, load_calibration, cpu_model_name
+from code_validation import check_code
+from language_detection import detect_language
+from example_index import FEW_SHOT_TOKEN_BUDGET
+from session_store import encode_with_cache
+from eviction import (KeepWarmSchedule, memory_pressure, IDLE_TTL_SECONDS, HOST_MEMORY_WATERMARK,
+                      DEVICE_MEMORY_WATERMARK, EVICTION_CHECK_INTERVAL, EVICTION_LOG_SIZE)
+
+# Best-of-n sampling: most candidates per request, and the lowest temperature
+# that still gives candidates worth choosing between
+MAX_BEST_OF = 8
+BEST_OF_MIN_TEMPERATURE = 0.2
+
+# Most curated examples injected into one prompt (see example_index.py)
+MAX_FEW_SHOT = 4
+
+
+class TokenLogProbs(LogitsProcessor):
+    def __init__(self, eos_token_id):
+        """
+        Sum each row's log-probability of the tokens it generates, up to and including EOS
+        
+        Only the previous step's distribution is kept, unlike `output_scores`,
+        which holds a vocabulary-sized tensor for every step.
+        
+        :param eos_token_id: Token (or list of tokens) that ends a row
+        """
+        eos = eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id]
+        self.eos_token_ids = [token for token in eos if token is not None]
+        self.previous = None
+        self.total = None
+        self.count = None
+        self.finished = None
+    
+    def _consume(self, tokens):
+        logprobs = self.previous.gather(1, tokens[:, None].to(self.previous.device)).squeeze(1)
+        active = ~self.finished
+        self.total += torch.where(active, logprobs, torch.zeros_like(logprobs))
+        self.count += active.long()
+        for eos in self.eos_token_ids:
+            self.finished |= tokens.to(self.finished.device) == eos
+        self.previous = None
+    
+    def __call__(self, input_ids, scores):
+        if self.total is None:
+            self.total = torch.zeros(scores.shape[0], device=scores.device)
+            self.count = torch.zeros(scores.shape[0], dtype=torch.long, device=scores.device)
+            self.finished = torch.zeros(scores.shape[0], dtype=torch.bool, device=scores.device)
+        elif self.previous is not None:
+            self._consume(input_ids[:, -1])
+        self.previous = torch.log_softmax(scores.float(), dim=-1)
+        return scores
+    
+    def mean(self, sequences):
+        """Mean log-probability per row of `sequences` (the output of `generate`); zeros if never called"""
+        if self.total is None:
+            return torch.zeros(sequences.shape[0])
+        if self.previous is not None:
+            self._consume(sequences[:, -1])
+        return (self.total / self.count.clamp(min=1)).cpu()
+
+
 class MultiModelManager:
-    def __init__(self, models_config, cache_dir="models"):
+    def __init__(self, models_config, cache_dir="models", cpu_calibration=None):
         """
         Initialize the model manager optimized for 7800X3D and RTX 4070
         with focus on CodeLlama-13B-Instruct model
         
         :param models_config: Dictionary of model configurations
         :param cache_dir: Directory to cache model files
+        :param cpu_calibration: Thread settings source (see cpu_calibration.py):
+            'auto' applies this host's cached calibration for the served model,
+            calibrating with that model on the first start of a CPU-only host;
+            'cached' only applies a cached one; 'off' uses the built-in defaults.
+            Defaults to $CODEBUDDY_CPU_CALIBRATION or 'auto'.
         """
         self.models_config = {
             'python': {
@@ -36,11 +112,70 @@ class MultiModelManager:
                 'supports_chat': True
             }
         }
+        # Entries passed in override or extend the defaults above. An entry may
+        # reference a LoRA adapter on top of its base model:
+        #   'adapter_path': directory saved by `finetune_model.py --lora`
+        #   'adapter_name': name to register it under (defaults to the language)
+        # or serve it through ONNX Runtime on CPU (see onnx_backend.py):
+        #   'backend': 'onnx'
+        #   'onnx_int8': False to skip int8 quantization (default True)
+        # or replace it with a deterministic fake for load tests (see stub_backend.py):
+        #   'backend': 'stub'
+        # Any entry may also set when its model is evicted (see eviction.py):
+        #   'idle_ttl': seconds idle before it is unloaded (default from the performance mode)
+        #   'keep_warm': e.g. 'mon-fri 08:00-18:00' to keep it loaded during those hours
+        for language, config in (models_config or {}).items():
+            self.models_config.setdefault(language.lower(), {}).update(config)
+        
         self.cache_dir = cache_dir
         self.loaded_models = {}
         self.loaded_tokenizers = {}
         
+        # One copy of each base model, shared by every language that uses it
+        self.base_models = {}
+        # Per base model: LRU of resident adapters (adapter name -> path)
+        self.loaded_adapters = {}
+        self.max_loaded_adapters = 8
+        
+        # Single-flight loading: one in-flight load (a Future) per base model that
+        # concurrent callers wait on, and per base model the number of requests
+        # holding it (see use_model); a held base is only released when the last
+        # holder finishes
+        self.load_lock = threading.Lock()
+        self.setup_lock = threading.Lock()
+        self.loading = {}
+        self.model_refs = {}
+        self.pending_unloads = set()
+        self.load_stats = {"loads": 0, "deduplicated": 0, "failed": 0, "deferred_unloads": 0,
+                           "evictions": 0, "reloads_after_eviction": 0}
+        
+        # Eviction policy: idle TTL (per performance mode unless an entry sets
+        # 'idle_ttl'), memory watermarks and keep-warm schedules, applied by a
+        # background check every EVICTION_CHECK_INTERVAL seconds
+        self.idle_ttl = IDLE_TTL_SECONDS["balanced"]
+        self.host_memory_watermark = HOST_MEMORY_WATERMARK
+        self.device_memory_watermark = DEVICE_MEMORY_WATERMARK
+        self.keep_warm = {
+            language: KeepWarmSchedule(config['keep_warm'])
+            for language, config in self.models_config.items() if config.get('keep_warm')
+        }
+        self.last_used = {}
+        # Base key -> (time, reason) of its last eviction, until it is loaded again
+        self.evicted = {}
+        self.eviction_log = deque(maxlen=EVICTION_LOG_SIZE)
+        
+        # Per base model: compiled decoder with a static KV cache (see set_compile_mode)
+        self.compiled_generators = {}
+        self.compile_generation = False
+        
+        # Opt-in allocator/tracemalloc recording, see memory_instrumentation.py
+        self.memory_profiler = MemoryProfiler()
+        
+        # Optional ExampleIndex over the training data, for few-shot prompts (set by the caller)
+        self.example_index = None
+        
         # Detect CPU topology and configure for optimal performance
+        self.cpu_calibration = cpu_calibration or os.environ.get("CODEBUDDY_CPU_CALIBRATION", "auto")
         self.cpu_info = self._get_cpu_info()
         self._configure_cpu()
         
@@ -58,6 +193,10 @@ class MultiModelManager:
         
         # Print system information
         self._print_system_info()
+        
+        # Evict idle models and keep scheduled ones warm in the background
+        self.eviction_stop = threading.Event()
+        Thread(target=self._eviction_loop, daemon=True).start()
 
     def _get_cpu_info(self):
         """
@@ -71,14 +210,8 @@ class MultiModelManager:
         }
         
         # Try to identify if this is a 7800X3D specifically
-        try:
-            import cpuinfo
-            detailed_info = cpuinfo.get_cpu_info()
-            cpu_info['model_name'] = detailed_info.get('brand_raw', 'Unknown')
-            cpu_info['is_7800x3d'] = '7800X3D' in cpu_info['model_name']
-        except:
-            cpu_info['model_name'] = 'AMD Ryzen CPU (details unavailable)'
-            cpu_info['is_7800x3d'] = True  # Assume true based on user input
+        cpu_info['model_name'] = cpu_model_name()
+        cpu_info['is_7800x3d'] = '7800X3D' in cpu_info['model_name']
             
         return cpu_info
 
@@ -87,11 +220,22 @@ class MultiModelManager:
         Configure for optimal performance on Ryzen 7800X3D
         """
         # Determine optimal worker counts based on CPU
-        physical_cores = self.cpu_info['cores_physical']
-        logical_cores = self.cpu_info['cores_logical']
+        logical_cores = self.cpu_info['cores_logical'] or 1
+        physical_cores = self.cpu_info['cores_physical'] or logical_cores
+        
+        # Measured settings for this CPU model and core count win over the guesses below
+        calibration = self._load_cpu_calibration()
+        if calibration:
+            print(f"Applying CPU calibration from {calibration['measured_at']}: "
+                  f"{calibration['intra_op_threads']} intra-op / {calibration['interop_threads']} inter-op threads, "
+                  f"{calibration['tokenizer_threads']} tokenizer threads")
+            self.inference_thread_count = calibration['intra_op_threads']
+            self.tokenization_thread_count = calibration['tokenizer_threads']
+            torch.set_num_threads(calibration['intra_op_threads'])
+            self._set_interop_threads(calibration['interop_threads'])
         
         # For 7800X3D (8 cores, 16 threads)
-        if self.cpu_info.get('is_7800x3d', False):
+        elif self.cpu_info.get('is_7800x3d', False):
             # Use specific optimizations for 7800X3D with its 3D V-Cache
             print("Optimizing for AMD Ryzen 7800X3D with 3D V-Cache...")
             
@@ -101,11 +245,11 @@ class MultiModelManager:
             
             # Set optimal PyTorch thread settings for 7800X3D
             torch.set_num_threads(physical_cores)
-            torch.set_num_interop_threads(2)  # Lower interop threads for 7800X3D's architecture
+            self._set_interop_threads(2)  # Lower interop threads for 7800X3D's architecture
         else:
             # Generic CPU configuration
-            self.inference_thread_count = max(2, physical_cores - 2)  # Reserve some cores
-            self.tokenization_thread_count = logical_cores // 2
+            self.inference_thread_count = max(1, physical_cores - 2)  # Reserve some cores
+            self.tokenization_thread_count = max(1, logical_cores // 2)
             
             # Default PyTorch threading
             torch.set_num_threads(physical_cores)
@@ -116,6 +260,34 @@ class MultiModelManager:
         except:
             pass
 
+    def _calibration_model(self):
+        """The PyTorch model most languages are served with, which thread settings are calibrated for"""
+        names = [config['model_name'] for config in self.models_config.values()
+                 if config.get('backend') not in ('onnx', 'stub') and config.get('model_name')]
+        if not names:
+            return None
+        return max(names, key=names.count)
+    
+    def _load_cpu_calibration(self):
+        """This host's calibrated thread settings per `self.cpu_calibration`, or None"""
+        model_name = self._calibration_model()
+        if self.cpu_calibration == "off" or model_name is None:
+            return None
+        try:
+            if self.cpu_calibration == "auto" and not torch.cuda.is_available():
+                return calibrate_cached(model_name, cache_dir=self.cache_dir)
+            return load_calibration(model_name)
+        except Exception as e:
+            print(f"CPU calibration unavailable, using default thread settings: {e}")
+            return None
+    
+    def _set_interop_threads(self, count):
+        try:
+            torch.set_num_interop_threads(count)
+        except RuntimeError:
+            # Only settable before the first inter-op parallel work in this process
+            print(f"Inter-op threads already fixed at {torch.get_num_interop_threads()}, not changing to {count}")
+    
     def _setup_thread_pools(self):
         """
         Create optimized thread pools for parallel processing
@@ -128,10 +300,20 @@ class MultiModelManager:
         
         # Process pool for CPU-intensive tasks
         # Using fewer workers to avoid oversubscription
+        self.cpu_pool_workers = max(2, (self.cpu_info['cores_physical'] or 1) // 2)
         self.cpu_pool = ProcessPoolExecutor(
-            max_workers=max(2, self.cpu_info['cores_physical'] // 2),
+            max_workers=self.cpu_pool_workers,
             mp_context=multiprocessing.get_context('spawn')  # Avoid fork issues
         )
+        self.cpu_pool_warm = False
+    
+    def _warm_cpu_pool(self):
+        """Start every `cpu_pool` worker on first use, so later syntax checks do not wait for spawns"""
+        if self.cpu_pool_warm:
+            return
+        self.cpu_pool_warm = True
+        for _ in range(self.cpu_pool_workers):
+            self.cpu_pool.submit(check_code, "", "python")
 
     def _configure_gpu(self):
         """
@@ -260,10 +442,56 @@ class MultiModelManager:
             mode = 'balanced'
             
         self.performance_mode = mode
-        print(f"Performance mode set to: {mode}")
+        self.idle_ttl = IDLE_TTL_SECONDS[mode]
+        print(f"Performance mode set to: {mode}" +
+              (f" (idle models unloaded after {self.idle_ttl}s)" if self.idle_ttl else ""))
         
         return mode
     
+    def set_compile_mode(self, enabled):
+        """
+        Decode through torch.compile with a static KV cache
+        
+        Compiles and warms every loaded base model now and each one loaded
+        later. Requests that cannot use it (adapters, batches, very long
+        prompts) still generate eagerly.
+        
+        :param enabled: True to compile, False to return to eager generation
+        """
+        self.compile_generation = enabled
+        if not enabled:
+            self.compiled_generators.clear()
+        else:
+            for model_name in list(self.base_models):
+                self._setup_compiled_generation(model_name)
+        print(f"Compiled generation {'enabled' if enabled else 'disabled'}")
+        return enabled
+    
+    def _setup_compiled_generation(self, model_name):
+        """Build and warm the compiled generator for a loaded base model"""
+        if model_name in self.compiled_generators:
+            return
+        model, tokenizer = self.base_models[model_name]
+        if hasattr(model, 'peft_config'):
+            print(f"Skipping compiled generation for {model_name}: adapters are attached")
+            return
+        if not isinstance(model, torch.nn.Module):
+            return
+        try:
+            generator = CompiledGenerator(model, pad_token_id=tokenizer.pad_token_id)
+            generator.warm_up()
+            self.compiled_generators[model_name] = generator
+        except Exception as e:
+            print(f"Compiled generation unavailable for {model_name}, using eager: {e}")
+    
+    def _generate_fn(self, model, adapter_kwargs=None):
+        """`generate` for this model: the compiled one when available, otherwise eager"""
+        if not adapter_kwargs:
+            for model_name, (base_model, _) in self.base_models.items():
+                if base_model is model and model_name in self.compiled_generators:
+                    return self.compiled_generators[model_name].generate
+        return model.generate
+    
     def _parallel_tokenize(self, tokenizer, prompt, **kwargs):
         """
         Tokenize input in a separate thread to leverage multi-core CPU
@@ -274,33 +502,290 @@ class MultiModelManager:
         """
         Lazy load a model with enhanced memory management
         
+        Languages that share a base model share one copy of it; languages
+        with an 'adapter_path' get their LoRA adapter loaded onto that base.
+        Thread-safe: concurrent first requests for a base model wait on the
+        same load instead of starting their own (counted in `load_metrics`).
+        
         :param language: Language of the model to load
         :param hf_token: Hugging Face authentication token
         :return: Loaded model and tokenizer
         """
+        model_config = self.models_config.get(language.lower())
+        if not model_config:
+            raise ValueError(f"No model configuration found for language: {language}")
+        model_name = model_config['model_name']
+        base_key = self._base_key(model_config)
+        
+        # Held while loading, so the base cannot be released before it is registered
+        self._acquire(base_key)
+        try:
+            with self.load_lock:
+                # Check if model is already loaded
+                if language in self.loaded_models:
+                    self._touch_adapter(language)
+                    return self.loaded_models[language], self.loaded_tokenizers[language]
+                
+                future = self.loading.get(base_key)
+                owner = future is None and base_key not in self.base_models
+                if owner:
+                    future = self.loading[base_key] = Future()
+                    self.load_stats["loads"] += 1
+                    evicted = self.evicted.pop(base_key, None)
+                    if evicted:
+                        self.load_stats["reloads_after_eviction"] += 1
+                        print(f"Reloading {base_key}, evicted {time.time() - evicted[0]:.0f}s ago ({evicted[1]})")
+                elif future is not None:
+                    self.load_stats["deduplicated"] += 1
+            
+            if owner:
+                self._load_base(language, base_key, model_name, model_config, hf_token, future)
+            elif future is not None:
+                print(f"Waiting for the load of {base_key} already in progress ({language})")
+                future.result()  # Raises the loader's error, if it failed
+            else:
+                print(f"Reusing loaded base model {base_key} for {language}")
+            
+            # Adapters and compiled decoders modify the shared base: one language at a time
+            with self.setup_lock:
+                if language not in self.loaded_models:
+                    if model_config.get('adapter_path'):
+                        self._load_adapter(language, model_name, model_config)
+                    elif self.compile_generation and base_key == model_name:
+                        self._setup_compiled_generation(model_name)
+                    
+                    with self.load_lock:
+                        model, tokenizer = self.base_models[base_key]
+                        self.loaded_models[language] = model
+                        self.loaded_tokenizers[language] = tokenizer
+                        self.pending_unloads.discard(base_key)
+                return self.loaded_models[language], self.loaded_tokenizers[language]
+        finally:
+            self._release(base_key)
+    
+    def _load_base(self, language, base_key, model_name, model_config, hf_token, future):
+        """Load a base model as the single owner of its load, resolving `future` for the callers waiting on it"""
+        try:
+            if model_config.get('backend') == 'onnx':
+                loaded = self._load_onnx_model(language, model_name, model_config, hf_token)
+            elif model_config.get('backend') == 'stub':
+                from stub_backend import load_stub_model
+                print(f"\nLoading {language} stub model...")
+                loaded = load_stub_model(model_config)
+            else:
+                loaded = self._load_base_model(language, model_name, hf_token)
+        except BaseException as e:
+            with self.load_lock:
+                del self.loading[base_key]
+                self.load_stats["failed"] += 1
+            future.set_exception(e)
+            raise
+        with self.load_lock:
+            self.base_models[base_key] = loaded
+            self.last_used[base_key] = time.time()
+            del self.loading[base_key]
+        future.set_result(loaded)
+    
+    def _acquire(self, base_key):
+        with self.load_lock:
+            self.model_refs[base_key] = self.model_refs.get(base_key, 0) + 1
+    
+    def _release(self, base_key):
+        """Drop one hold on a base model, finishing an unload deferred while it was held"""
+        with self.load_lock:
+            self.last_used[base_key] = time.time()
+            refs = self.model_refs.get(base_key, 0) - 1
+            if refs > 0:
+                self.model_refs[base_key] = refs
+                return
+            self.model_refs.pop(base_key, None)
+            if base_key not in self.pending_unloads:
+                return
+            self.pending_unloads.discard(base_key)
+            if self._base_in_use(base_key) or base_key not in self.base_models:
+                return
+            released = self._pop_base(base_key)
+        print(f"Releasing {base_key} now that its last request finished")
+        self._free_base(released)
+    
+    @contextmanager
+    def use_model(self, language):
+        """
+        Load a language's model and hold it for the duration of the block
+        
+        Unloading a held model is deferred until every holder has finished.
+        
+        :yield: (model, tokenizer)
+        """
+        base_key = self._base_key(self.models_config.get(language.lower(), {}))
+        self._acquire(base_key)
+        try:
+            yield self.load_model(language)
+        finally:
+            self._release(base_key)
+    
+    def load_metrics(self):
+        """
+        Load counters: loads started, callers deduplicated onto an in-flight
+        load, failures, deferred unloads, evictions and reloads after eviction
+        """
+        with self.load_lock:
+            return dict(self.load_stats, in_flight=sorted(self.loading),
+                        held={key: refs for key, refs in self.model_refs.items() if refs},
+                        recent_evictions=list(self.eviction_log)[-10:])
+    
+    def _languages_of(self, base_key):
+        return [lang for lang, config in self.models_config.items() if self._base_key(config) == base_key]
+    
+    def _idle_ttl(self, languages):
+        """Idle TTL of a base model: the longest one its languages set, else the performance mode's"""
+        ttls = [self.models_config[lang]['idle_ttl'] for lang in languages if 'idle_ttl' in self.models_config[lang]]
+        if ttls:
+            return None if not all(ttls) else max(ttls)
+        return self.idle_ttl
+    
+    def _kept_warm(self, languages):
+        return any(lang in self.keep_warm and self.keep_warm[lang].active() for lang in languages)
+    
+    def evict_idle(self, now=None):
+        """
+        One eviction pass over the loaded base models
+        
+        Evicts models idle past their TTL, then, while host or GPU memory is
+        above its watermark, the least recently used remaining ones. Models
+        held by a request or kept warm by their schedule are skipped.
+        
+        :return: List of (base key, reason) evicted
+        """
+        now = now or time.time()
+        with self.load_lock:
+            candidates = sorted(
+                (self.last_used.get(base_key, now), base_key)
+                for base_key in self.base_models
+                if not self.model_refs.get(base_key) and base_key not in self.loading
+            )
+        
+        evicted = []
+        remaining = []
+        for last_used, base_key in candidates:
+            languages = self._languages_of(base_key)
+            if self._kept_warm(languages):
+                continue
+            ttl = self._idle_ttl(languages)
+            reason = f"idle {now - last_used:.0f}s > {ttl}s TTL"
+            if ttl and now - last_used > ttl and self._evict(base_key, reason):
+                evicted.append((base_key, reason))
+            else:
+                remaining.append(base_key)
+        
+        # Least recently used first, until memory is back under the watermarks
+        for base_key in remaining:
+            reason = memory_pressure(self.host_memory_watermark, self.device_memory_watermark)
+            if reason is None:
+                break
+            if self._evict(base_key, reason):
+                evicted.append((base_key, reason))
+        return evicted
+    
+    def _evict(self, base_key, reason):
+        """Unload a base model and every language on it, unless a request picked it up meanwhile"""
+        with self.load_lock:
+            if self.model_refs.get(base_key) or base_key not in self.base_models:
+                return False
+            for lang in list(self.loaded_models):
+                if self._base_key(self.models_config.get(lang, {})) == base_key:
+                    del self.loaded_models[lang]
+                    del self.loaded_tokenizers[lang]
+            released = self._pop_base(base_key)
+            self.pending_unloads.discard(base_key)
+            self.evicted[base_key] = (time.time(), reason)
+            self.eviction_log.append({"model": base_key, "reason": reason, "time": time.time()})
+            self.load_stats["evictions"] += 1
+        print(f"Evicted {base_key}: {reason}")
+        self._free_base(released)
+        return True
+    
+    def _warm_scheduled(self):
+        """Load models whose keep-warm window is active"""
+        for language, schedule in self.keep_warm.items():
+            if language not in self.loaded_models and schedule.active():
+                print(f"Keep-warm schedule '{schedule.spec}' is active, loading {language} model")
+                self.load_model(language)
+    
+    def _eviction_loop(self):
+        while not self.eviction_stop.wait(EVICTION_CHECK_INTERVAL):
+            try:
+                self._warm_scheduled()
+                self.evict_idle()
+            except Exception as e:
+                print(f"Eviction check failed: {e}")
+
+    def _base_key(self, model_config):
+        """Key of a config's entry in `base_models`; copies of a model on different backends are kept apart"""
+        model_name = model_config.get('model_name')
+        backend = model_config.get('backend', 'pytorch')
+        if backend != 'pytorch':
+            return f"{model_name} [{backend}]"
+        return model_name
+    
+    def _load_onnx_model(self, language, model_name, model_config, hf_token=None):
+        """
+        Export (once, cached under cache_dir/onnx) and open a model with ONNX Runtime
+        
+        :return: (OnnxCausalLM, tokenizer)
+        """
+        from onnx_backend import load_onnx_model
+        
+        if model_config.get('adapter_path'):
+            raise ValueError(f"{language}: LoRA adapters are not supported with the ONNX backend")
+        
+        if hf_token is None:
+            hf_token = self.hf_token
+        auth_kwargs = {'token': hf_token} if hf_token else {}
+        
+        print(f"\nLoading {language} model with ONNX Runtime: {model_name}...")
+        tokenizer_future = self.tokenizer_pool.submit(
+            AutoTokenizer.from_pretrained,
+            model_name,
+            **auth_kwargs,
+            cache_dir=self.cache_dir,
+            padding_side='left',
+            truncation_side='left',
+            use_fast=True
+        )
+        model = load_onnx_model(model_name, self.cache_dir, hf_token, quantize=model_config.get('onnx_int8', True))
+        tokenizer = tokenizer_future.result()
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+            tokenizer.pad_token_id = tokenizer.eos_token_id
+        model.config.pad_token_id = tokenizer.pad_token_id
+        
+        self._print_memory_usage()
+        print(f"{language} model loaded successfully (ONNX Runtime).")
+        return model, tokenizer
+    
+    def _load_base_model(self, language, model_name, hf_token=None):
+        """
+        Load a base model and its tokenizer, falling back from 4-bit to fp16 to 8-bit
+        
+        :return: (model, tokenizer)
+        """
         # Import necessary libraries here to ensure they're available
         from transformers import BitsAndBytesConfig
         
         # Use instance token if not provided
         if hf_token is None:
             hf_token = self.hf_token
-            
-        # Check if model is already loaded
-        if language in self.loaded_models:
-            return self.loaded_models[language], self.loaded_tokenizers[language]
         
-        # Get model configuration
-        model_config = self.models_config.get(language.lower())
-        if not model_config:
-            raise ValueError(f"No model configuration found for language: {language}")
-        
-        model_name = model_config['model_name']
         print(f"\nLoading {language} model: {model_name}...")
         
         # Check if we need to unload other models to make room
         if torch.cuda.is_available():
-            # Check if we have other models loaded
-            other_languages = [lang for lang in self.loaded_models.keys() if lang != language]
+            # Check if we have models loaded on a different base
+            other_languages = [
+                lang for lang in self.loaded_models.keys()
+                if self.models_config.get(lang, {}).get('model_name') != model_name
+            ]
             if other_languages:
                 print(f"Unloading other models to make room for {language} model...")
                 for other_lang in other_languages:
@@ -410,16 +895,88 @@ class MultiModelManager:
         except:
             pass
         
-        # Store loaded models
-        self.loaded_models[language] = model
-        self.loaded_tokenizers[language] = tokenizer
-        
         # Print memory usage after loading
         self._print_memory_usage()
         
         print(f"{language} model loaded successfully.")
         return model, tokenizer
 
+    def _load_adapter(self, language, model_name, model_config):
+        """
+        Make a language's LoRA adapter resident on its shared base model
+        
+        Adapters are kept in an LRU per base model; loading one from disk takes
+        milliseconds and switching between resident adapters costs nothing,
+        since the adapter is chosen per request in `_adapter_kwargs`.
+        """
+        try:
+            from peft import PeftModel
+        except ImportError:
+            raise ImportError("Serving LoRA adapters requires the 'peft' package: pip install peft")
+        
+        adapter_name = model_config.get('adapter_name', language)
+        adapter_path = model_config['adapter_path']
+        adapters = self.loaded_adapters.setdefault(model_name, OrderedDict())
+        if adapter_name in adapters:
+            adapters.move_to_end(adapter_name)
+            return
+        
+        start = time.perf_counter()
+        model, tokenizer = self.base_models[model_name]
+        if isinstance(model, PeftModel):
+            model.load_adapter(adapter_path, adapter_name=adapter_name, is_trainable=False)
+        else:
+            # Wrapping injects LoRA layers into the base in place; every language
+            # on this base now picks its adapter (or none) per request
+            model = PeftModel.from_pretrained(model, adapter_path, adapter_name=adapter_name, is_trainable=False)
+            model.eval()
+            self.base_models[model_name] = (model, tokenizer)
+            # The compiled graph was traced without LoRA layers
+            self.compiled_generators.pop(model_name, None)
+            for lang in list(self.loaded_models):
+                if self.models_config.get(lang, {}).get('model_name') == model_name:
+                    self.loaded_models[lang] = model
+        adapters[adapter_name] = adapter_path
+        print(f"Loaded {language} adapter '{adapter_name}' in {(time.perf_counter() - start) * 1000:.0f} ms")
+        
+        # Evict least recently used adapters beyond the cache size
+        while len(adapters) > self.max_loaded_adapters:
+            evicted, _ = adapters.popitem(last=False)
+            model.delete_adapter(evicted)
+            for lang in list(self.loaded_models):
+                config = self.models_config.get(lang, {})
+                if config.get('model_name') == model_name and config.get('adapter_name', lang) == evicted:
+                    del self.loaded_models[lang]
+                    del self.loaded_tokenizers[lang]
+            print(f"Evicted adapter '{evicted}' (adapter cache holds {self.max_loaded_adapters})")
+
+    def _touch_adapter(self, language):
+        """Mark a language's adapter as recently used"""
+        config = self.models_config.get(language, {})
+        adapters = self.loaded_adapters.get(config.get('model_name'))
+        adapter_name = config.get('adapter_name', language)
+        if adapters and adapter_name in adapters:
+            adapters.move_to_end(adapter_name)
+
+    def _adapter_kwargs(self, model, languages):
+        """
+        Per-row adapter selection for `model.generate`
+        
+        Rows of one batch may use different adapters (or the plain base) as
+        long as they share a base model.
+        
+        :param model: The (possibly adapter-wrapped) base model
+        :param languages: Language of each row in the batch
+        :return: kwargs to pass to `generate`
+        """
+        if not hasattr(model, 'peft_config'):
+            return {}
+        adapter_names = []
+        for language in languages:
+            config = self.models_config.get(language, {})
+            adapter_names.append(config.get('adapter_name', language) if config.get('adapter_path') else "__base__")
+        return {'adapter_names': adapter_names}
+
     def get_available_gpu_memory(self):
         """
         Get the available GPU memory in GB
@@ -446,26 +1003,14 @@ class MultiModelManager:
   
     def _optimize_memory(self):
         """
-        Optimize memory usage with enhanced cleanup
+        Release freed memory after loading, unloading or an OOM split
+
+        Kept cheap: one GC pass and returning cached CUDA blocks. Detailed
+        profiling is opt-in through `self.memory_profiler`.
         """
-        # Force garbage collection multiple times
-        for _ in range(3):
-            gc.collect()
-        
-        # Clear PyTorch CUDA cache if available
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            
-            # Try to trim memory on CUDA if available (newer PyTorch versions)
-            try:
-                torch.cuda.memory._dump_snapshot()
-                torch.cuda.memory.reset_peak_memory_stats()
-                
-                # On newer PyTorch versions, try to use cudart functionality
-                if hasattr(torch.cuda, 'cudart'):
-                    torch.cuda.cudart().cudaDeviceSynchronize()
-            except:
-                pass
+        release_memory()
+        if self.memory_profiler.enabled:
+            self._print_memory_usage()
    
     def _print_memory_usage(self):
         """
@@ -484,38 +1029,66 @@ class MultiModelManager:
     def unload_model(self, language):
         """
         Unload a model to free up memory with enhanced cleanup
+        
+        The shared base model is only released once no loaded language uses it,
+        and not while requests still hold it (see `use_model`): then it is
+        released when the last of them finishes.
         """
-        if language in self.loaded_models:
+        with self.load_lock:
+            if language not in self.loaded_models:
+                return False
             print(f"Unloading {language} model...")
             
-            # Store references to be deleted
-            model_to_unload = self.loaded_models[language]
-            tokenizer_to_unload = self.loaded_tokenizers[language]
-            
             # Remove references from dictionaries
-            if language in self.loaded_models:
-                del self.loaded_models[language]
-            if language in self.loaded_tokenizers:
-                del self.loaded_tokenizers[language]
-            
-            # Explicitly move model to CPU first (helps with memory release)
-            if hasattr(model_to_unload, 'to'):
-                try:
-                    model_to_unload.to('cpu')
-                except:
-                    pass
-            
-            # Delete model and tokenizer references
-            del model_to_unload
-            del tokenizer_to_unload
+            del self.loaded_models[language]
+            del self.loaded_tokenizers[language]
             
-            # Extra aggressive memory cleanup
-            self._optimize_memory()
-            
-            print(f"{language} model unloaded.")
-            return True
+            model_name = self._base_key(self.models_config.get(language, {}))
+            if self._base_in_use(model_name) or model_name not in self.base_models:
+                print(f"{language} model unloaded (base model still in use).")
+                return True
+            if self.model_refs.get(model_name):
+                self.pending_unloads.add(model_name)
+                self.load_stats["deferred_unloads"] += 1
+                print(f"{language} model unloaded; {model_name} is released once its "
+                      f"{self.model_refs[model_name]} running request(s) finish.")
+                return True
+            released = self._pop_base(model_name)
+        
+        self._free_base(released)
+        print(f"{language} model unloaded.")
+        return True
+    
+    def _base_in_use(self, base_key):
+        """Whether any loaded language is served by this base model (call with load_lock held)"""
+        return any(
+            self._base_key(self.models_config.get(lang, {})) == base_key
+            for lang in self.loaded_models
+        )
+    
+    def _pop_base(self, base_key):
+        """Forget a base model and everything attached to it (call with load_lock held)"""
+        self.loaded_adapters.pop(base_key, None)
+        self.compiled_generators.pop(base_key, None)
+        return self.base_models.pop(base_key)
+    
+    def _free_base(self, released):
+        """Release a base model's memory"""
+        model_to_unload, tokenizer_to_unload = released
+        
+        # Explicitly move model to CPU first (helps with memory release)
+        if hasattr(model_to_unload, 'to'):
+            try:
+                model_to_unload.to('cpu')
+            except:
+                pass
+        
+        # Delete model and tokenizer references
+        del model_to_unload
+        del tokenizer_to_unload
         
-        return False
+        # Extra aggressive memory cleanup
+        self._optimize_memory()
             
     def is_model_loaded(self, language):
         """
@@ -523,7 +1096,8 @@ class MultiModelManager:
         """
         return language in self.loaded_models
     
-    def generate_code(self, prompt, chat_history=None, language=None, temperature=0.2, max_new_tokens=1024, repetition_penalty=1.1):
+    def generate_code(self, prompt, chat_history=None, language=None, temperature=0.2, max_new_tokens=1024, repetition_penalty=1.1,
+                      stream=False, cancel_token=None, token_cache=None, best_of=1, few_shot=0):
         """
         Generate code with improved prompt handling
         
@@ -533,60 +1107,103 @@ class MultiModelManager:
         :param temperature: Sampling temperature
         :param max_new_tokens: Maximum number of tokens to generate
         :param repetition_penalty: Penalty for repeating tokens
-        :yield: Generated code responses
+        :param stream: Yield the growing response as tokens are generated
+        :param cancel_token: Optional `CancellationToken`; generation stops within
+            one decoding step of it being cancelled and nothing more is yielded
+        :param token_cache: Optional per-session dict of tokenizer name -> token-ID
+            cache (see session_store.py); history already tokenized for this
+            session is reused instead of re-tokenized
+        :param best_of: Sample this many candidates in one batch and return the
+            one that passes a syntax check with the highest mean log-probability
+            (yielded once, not streamed)
+        :param few_shot: Put up to this many of the most similar curated
+            training examples in the prompt, within FEW_SHOT_TOKEN_BUDGET tokens
+            (needs `example_index`)
+        :yield: Generated code responses (cumulative text)
         """
         # Detect language if not specified
         if language is None:
             language = self.detect_language(prompt)
         
-        # Lazy load model and tokenizer if not already loaded
-        model, tokenizer = self.load_model(language)
-        
-        # Format the prompt using the new chat prompt method
-        formatted_prompt = self._format_chat_prompt(prompt, chat_history, language)
-        
-        # Generate with optimized settings for RTX 4070 and 7800X3D
-        try:
-            # Process the response with PyTorch optimizations
-            for partial_response in self._generate_with_pytorch(
-                model, tokenizer, formatted_prompt, 
-                temperature, max_new_tokens, repetition_penalty
-            ):
-                # Clean the model response before yielding
-                cleaned_response = self._clean_model_response(partial_response)
-                yield cleaned_response
+        # Lazy load model and tokenizer if not already loaded, and hold it so
+        # it is not unloaded while this request is still generating
+        with self.use_model(language) as (model, tokenizer):
+            # Select this language's adapter (if any) on the shared base
+            adapter_kwargs = self._adapter_kwargs(model, [language])
+            
+            # Similar curated examples go ahead of the conversation
+            if few_shot and self.example_index is not None:
+                prompt, chat_history = self._with_examples(prompt, chat_history, language, tokenizer,
+                                                           min(few_shot, MAX_FEW_SHOT))
+            
+            # Format the prompt using the new chat prompt method
+            formatted_prompt = self._format_chat_prompt(prompt, chat_history, language)
+            
+            # This session's token ids for the tokenizer that serves the language
+            if token_cache is not None:
+                token_cache = token_cache.setdefault(self._base_key(self.models_config[language]), OrderedDict())
+            
+            # Records memory for this request only while a profiling window is open
+            with self.memory_profiler.track_request(language):
+                if best_of > 1:
+                    for response in self._generate_best_of(
+                        model, tokenizer, formatted_prompt, language, min(best_of, MAX_BEST_OF),
+                        temperature, max_new_tokens, repetition_penalty, cancel_token, token_cache
+                    ):
+                        yield self._clean_model_response(response)
+                    return
                 
-            # If in memory-saving mode, unload the model after use
-            if self.performance_mode == "memory":
-                Thread(target=self.unload_model, args=(language,)).start()
+                # Generate with optimized settings for RTX 4070 and 7800X3D
+                try:
+                    # Process the response with PyTorch optimizations
+                    for partial_response in self._generate_with_pytorch(
+                        model, tokenizer, formatted_prompt, 
+                        temperature, max_new_tokens, repetition_penalty,
+                        adapter_kwargs, stream, cancel_token, token_cache
+                    ):
+                        # Clean the model response before yielding
+                        cleaned_response = self._clean_model_response(partial_response)
+                        yield cleaned_response
+                    
+                except Exception as e:
+                    print(f"Error during generation: {e}")
+                    if cancel_token is not None and cancel_token.cancelled:
+                        return
+                    # Try with safe fallback settings
+                    for partial_response in self._generate_with_pytorch_safe(
+                        model, tokenizer, formatted_prompt, 
+                        temperature, max_new_tokens, repetition_penalty,
+                        adapter_kwargs, cancel_token
+                    ):
+                        # Clean the model response before yielding
+                        cleaned_response = self._clean_model_response(partial_response)
+                        yield cleaned_response
                     
-        except Exception as e:
-            print(f"Error during generation: {e}")
-            # Try with safe fallback settings
-            for partial_response in self._generate_with_pytorch_safe(
-                model, tokenizer, formatted_prompt, 
-                temperature, max_new_tokens, repetition_penalty
-            ):
-                # Clean the model response before yielding
-                cleaned_response = self._clean_model_response(partial_response)
-                yield cleaned_response
-                
     def _generate_with_pytorch(self, model, tokenizer, prompt, 
-                              temperature, max_new_tokens, repetition_penalty):
+                              temperature, max_new_tokens, repetition_penalty,
+                              adapter_kwargs=None, stream=False, cancel_token=None, token_cache=None):
         """
         Generate code with PyTorch optimized for 7800X3D and RTX 4070
         - Further optimized for CodeLlama-13B-Instruct
+        - With stream=True, yields the growing text as tokens arrive
+        - Stops within one step once `cancel_token` is cancelled
+        - With a session `token_cache`, only text not tokenized before is tokenized
         """
         # Run tokenization in thread pool to leverage multiple cores
-        tokenizer_future = self.tokenizer_pool.submit(
-            self._parallel_tokenize,
-            tokenizer,
-            prompt, 
-            return_tensors="pt", 
-            padding=True, 
-            truncation=True,
-            max_length=1024
-        )
+        if token_cache is not None:
+            tokenizer_future = self.tokenizer_pool.submit(
+                encode_with_cache, tokenizer, prompt, token_cache, max_length=1024
+            )
+        else:
+            tokenizer_future = self.tokenizer_pool.submit(
+                self._parallel_tokenize,
+                tokenizer,
+                prompt, 
+                return_tensors="pt", 
+                padding=True, 
+                truncation=True,
+                max_length=1024
+            )
         
         # Get tokenized inputs
         inputs = tokenizer_future.result()
@@ -595,23 +1212,41 @@ class MultiModelManager:
         inputs = {k: v.to(model.device) for k, v in inputs.items()}
         
         # Generation settings optimized for CodeLlama-13B-Instruct
+        generation_kwargs = dict(
+            input_ids=inputs['input_ids'],
+            attention_mask=inputs['attention_mask'],
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            repetition_penalty=repetition_penalty,
+            do_sample=True,
+            pad_token_id=tokenizer.pad_token_id,
+            use_cache=True,
+            top_k=50,
+            top_p=0.95,
+            num_beam_groups=1,
+            num_beams=2,  # Set `num_beams` > 1 to align with `early_stopping`
+            early_stopping=False,  # Unset `early_stopping` if `num_beams` is 1
+            return_dict_in_generate=False,
+            **(adapter_kwargs or {})
+        )
+        if stream and cancel_token is None:
+            # Lets the background generation stop if the caller stops reading
+            cancel_token = CancellationToken()
+        if cancel_token is not None:
+            generation_kwargs['stopping_criteria'] = StoppingCriteriaList([
+                CancellationCriteria(cancel_token, inputs['input_ids'].shape[1], max_new_tokens)
+            ])
+        
+        generate = self._generate_fn(model, adapter_kwargs)
+        if stream:
+            yield from self._stream_generate(model, tokenizer, generation_kwargs, cancel_token, generate)
+            return
+        
         with torch.no_grad(), torch.amp.autocast('cuda'):  # Use automatic mixed precision
-            generated_ids = model.generate(
-                input_ids=inputs['input_ids'],
-                attention_mask=inputs['attention_mask'],
-                max_new_tokens=max_new_tokens,
-                temperature=temperature,
-                repetition_penalty=repetition_penalty,
-                do_sample=True,
-                pad_token_id=tokenizer.pad_token_id,
-                use_cache=True,
-                top_k=50,
-                top_p=0.95,
-                num_beam_groups=1,
-                num_beams=2,  # Set `num_beams` > 1 to align with `early_stopping`
-                early_stopping=False,  # Unset `early_stopping` if `num_beams` is 1
-                return_dict_in_generate=False
-            )
+            generated_ids = generate(**generation_kwargs)
+        
+        if cancel_token is not None and cancel_token.cancelled:
+            return
         
         # Run decode in thread pool to leverage multiple cores
         decode_future = self.tokenizer_pool.submit(
@@ -625,8 +1260,248 @@ class MultiModelManager:
         
         yield generated_text
         
+    def _generate_best_of(self, model, tokenizer, prompt, language, n, temperature, max_new_tokens,
+                          repetition_penalty, cancel_token=None, token_cache=None, max_length=1024):
+        """
+        Sample `n` candidates in one batch and yield the one most likely to be right
+        
+        The prompt is prefilled once and its KV cache copied to every
+        candidate, so the extra cost over one request is only the batched
+        decode. Candidates are syntax-checked in parallel on `cpu_pool` and
+        ranked by validity, then by mean token log-probability.
+        
+        :yield: The chosen candidate's text, once (nothing if cancelled)
+        """
+        if token_cache is not None:
+            inputs = encode_with_cache(tokenizer, prompt, token_cache, max_length=max_length)
+        else:
+            inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=max_length)
+        input_ids = inputs['input_ids'].to(model.device)
+        prompt_length = input_ids.shape[1]
+        batch_ids = input_ids.repeat(n, 1)
+        
+        logprobs = TokenLogProbs(tokenizer.eos_token_id)
+        generation_kwargs = dict(
+            input_ids=batch_ids,
+            attention_mask=torch.ones_like(batch_ids),
+            max_new_tokens=max_new_tokens,
+            temperature=max(temperature, BEST_OF_MIN_TEMPERATURE),
+            repetition_penalty=repetition_penalty,
+            do_sample=True,
+            top_k=50,
+            top_p=0.95,
+            num_beams=1,
+            pad_token_id=tokenizer.pad_token_id,
+            use_cache=True,
+            logits_processor=LogitsProcessorList([logprobs]),
+            **self._adapter_kwargs(model, [language] * n)
+        )
+        if cancel_token is not None:
+            generation_kwargs['stopping_criteria'] = StoppingCriteriaList([
+                CancellationCriteria(cancel_token, prompt_length, max_new_tokens)
+            ])
+        
+        # Start the checker processes once, so the first request's spawn cost overlaps decoding
+        self._warm_cpu_pool()
+        
+        start = time.perf_counter()
+        with torch.no_grad(), torch.amp.autocast('cuda'):
+            if isinstance(model, torch.nn.Module) and prompt_length > 1:
+                cache = self._shared_prefill(model, input_ids, n, language)
+                if cache is not None:
+                    generation_kwargs['past_key_values'] = cache
+            sequences = model.generate(**generation_kwargs)
+        if cancel_token is not None and cancel_token.cancelled:
+            return
+        
+        if logprobs.total is None:
+            print(f"Best of {n}: the {language} backend reports no log-probabilities; ranking by syntax only")
+        mean_logprobs = logprobs.mean(sequences).tolist()
+        texts = self.tokenizer_pool.submit(
+            tokenizer.batch_decode, sequences[:, prompt_length:].cpu(), skip_special_tokens=True
+        ).result()
+        # Syntax checks run in parallel worker processes
+        checks = list(self.cpu_pool.map(check_code, [self._clean_model_response(text) for text in texts],
+                                        [language] * n))
+        best = max(range(n), key=lambda i: (checks[i]['valid'], mean_logprobs[i]))
+        print(f"Best of {n} in {time.perf_counter() - start:.1f}s: "
+              f"{sum(check['valid'] for check in checks)}/{n} candidates valid, picked #{best + 1} "
+              f"(mean log-prob {mean_logprobs[best]:.3f})"
+              + (f"; best is still invalid: {checks[best]['error']}" if not checks[best]['valid'] else ""))
+        yield texts[best]
+    
+    def _shared_prefill(self, model, input_ids, n, language):
+        """
+        KV cache of all but the last prompt token, computed once and repeated for `n` rows
+        
+        :return: The cache, or None if the model cannot prefill this way (generate then prefills every row)
+        """
+        try:
+            from transformers import DynamicCache
+            try:
+                cache = DynamicCache(config=model.config)
+            except TypeError:
+                cache = DynamicCache()
+            model(input_ids=input_ids[:, :-1], attention_mask=torch.ones_like(input_ids[:, :-1]),
+                  past_key_values=cache, use_cache=True, **self._adapter_kwargs(model, [language]))
+            cache.batch_repeat_interleave(n)
+            return cache
+        except Exception as e:
+            print(f"Shared prefill unavailable, prefilling every candidate: {e}")
+            return None
+    
+    def _stream_generate(self, model, tokenizer, generation_kwargs, cancel_token, generate=None):
+        """
+        Run `model.generate` on a background thread and yield the growing text
+        
+        Streamers cannot follow beam search, so streaming samples a single beam.
+        If the caller stops iterating, `cancel_token` stops the background
+        generation at its next step. `generate` defaults to `model.generate`.
+        """
+        from transformers import TextIteratorStreamer
+        
+        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        generation_kwargs = dict(generation_kwargs, num_beams=1, streamer=streamer)
+        generation_kwargs.pop('early_stopping', None)
+        generate = generate or model.generate
+        errors = []
+        
+        def run_generation():
+            try:
+                with torch.no_grad(), torch.amp.autocast('cuda'):
+                    generate(**generation_kwargs)
+            except Exception as e:
+                errors.append(e)
+                streamer.end()  # unblock the consumer
+        
+        Thread(target=run_generation, daemon=True, name="generate-stream").start()
+        
+        generated_text = ""
+        finished = False
+        try:
+            for new_text in streamer:
+                if cancel_token.cancelled:
+                    return
+                generated_text += new_text
+                yield generated_text
+            finished = True
+        finally:
+            if not finished:
+                cancel_token.cancel("caller stopped reading")
+        
+        if errors:
+            raise errors[0]
+        
+    def generate_batch(self, requests, batch_size=8, temperature=0.2, max_new_tokens=1024,
+                       repetition_penalty=1.1, max_length=1024):
+        """
+        Generate responses for many prompts with length-bucketed batches
+        
+        Requests are grouped by base model (languages sharing a base are mixed
+        in one batch through per-row adapters), sorted by prompt length and
+        split into batches, so every batch is left-padded only to its own
+        longest prompt. Batches sample a single beam.
+        
+        :param requests: List of dicts with 'prompt' and optional 'chat_history',
+            'language' and 'cancel_token'
+        :param batch_size: Prompts per `generate` call
+        :param max_length: Prompt truncation length in tokens
+        :yield: (request index, cleaned response, generated token count), batch by batch;
+            cancelled requests stop generating within one step and are not yielded
+        """
+        languages = [r.get('language') or self.detect_language(r['prompt']) for r in requests]
+        groups = {}
+        for i, language in enumerate(languages):
+            groups.setdefault(self._base_key(self.models_config.get(language, {})), []).append(i)
+        
+        for model_name, indices in groups.items():
+            # Held until the group is done, so an unload cannot pull the model out mid-batch
+            with ExitStack() as holds:
+                for language in dict.fromkeys(languages[i] for i in indices):
+                    holds.enter_context(self.use_model(language))
+                model, tokenizer = self.base_models[model_name]
+                
+                prompts = [
+                    self._format_chat_prompt(requests[i]['prompt'], requests[i].get('chat_history'), languages[i])
+                    for i in indices
+                ]
+                token_ids = self.tokenizer_pool.submit(
+                    self._parallel_tokenize, tokenizer, prompts, truncation=True, max_length=max_length
+                ).result()['input_ids']
+                
+                # Shortest first, so each batch holds prompts of similar length
+                order = sorted(range(len(indices)), key=lambda j: len(token_ids[j]))
+                for start in range(0, len(order), batch_size):
+                    rows = order[start:start + batch_size]
+                    cancel_tokens = [requests[indices[j]].get('cancel_token') for j in rows]
+                    if all(token is not None and token.cancelled for token in cancel_tokens):
+                        continue
+                    outputs = self._generate_rows(
+                        model, tokenizer,
+                        [token_ids[j] for j in rows],
+                        [languages[indices[j]] for j in rows],
+                        temperature, max_new_tokens, repetition_penalty,
+                        cancel_tokens
+                    )
+                    for j, token, (text, generated_tokens) in zip(rows, cancel_tokens, outputs):
+                        if token is not None and token.cancelled:
+                            continue
+                        yield indices[j], self._clean_model_response(text), generated_tokens
+    
+    def _generate_rows(self, model, tokenizer, token_ids, languages,
+                       temperature, max_new_tokens, repetition_penalty, cancel_tokens=None):
+        """
+        Run one left-padded batch through `generate`, halving it on out-of-memory
+        
+        :return: List of (decoded text, generated token count) per row
+        """
+        inputs = tokenizer.pad({'input_ids': token_ids}, padding=True, return_tensors="pt")
+        inputs = {k: v.to(model.device) for k, v in inputs.items()}
+        try:
+            with torch.no_grad(), torch.amp.autocast('cuda'):
+                generated_ids = model.generate(
+                    input_ids=inputs['input_ids'],
+                    attention_mask=inputs['attention_mask'],
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature if temperature > 0 else None,
+                    repetition_penalty=repetition_penalty,
+                    do_sample=temperature > 0,
+                    pad_token_id=tokenizer.pad_token_id,
+                    use_cache=True,
+                    top_k=50,
+                    top_p=0.95,
+                    num_beams=1,
+                    stopping_criteria=StoppingCriteriaList([
+                        CancellationCriteria(cancel_tokens or [None] * len(token_ids),
+                                             inputs['input_ids'].shape[1], max_new_tokens)
+                    ]),
+                    **self._adapter_kwargs(model, languages)
+                )
+        except Exception as e:
+            if "out of memory" not in str(e).lower() or len(token_ids) == 1:
+                raise
+            print(f"Batch of {len(token_ids)} ran out of memory, splitting it")
+            del inputs
+            self._optimize_memory()
+            half = len(token_ids) // 2
+            cancel_tokens = cancel_tokens or [None] * len(token_ids)
+            return (
+                self._generate_rows(model, tokenizer, token_ids[:half], languages[:half],
+                                    temperature, max_new_tokens, repetition_penalty, cancel_tokens[:half]) +
+                self._generate_rows(model, tokenizer, token_ids[half:], languages[half:],
+                                    temperature, max_new_tokens, repetition_penalty, cancel_tokens[half:])
+            )
+        
+        new_tokens = generated_ids[:, inputs['input_ids'].shape[1]:].cpu()
+        texts = self.tokenizer_pool.submit(
+            tokenizer.batch_decode, new_tokens, skip_special_tokens=True
+        ).result()
+        counts = (new_tokens != tokenizer.pad_token_id).sum(dim=1).tolist()
+        return list(zip(texts, counts))
+        
     def _generate_with_pytorch_safe(self, model, tokenizer, prompt, 
-                                  temperature, max_new_tokens, repetition_penalty):
+                                  temperature, max_new_tokens, repetition_penalty,
+                                  adapter_kwargs=None, cancel_token=None):
         """
         Generate code with PyTorch using safe settings (fallback mode)
         """
@@ -652,9 +1527,16 @@ class MultiModelManager:
                 temperature=temperature,
                 repetition_penalty=repetition_penalty,
                 do_sample=True,
-                pad_token_id=tokenizer.pad_token_id
+                pad_token_id=tokenizer.pad_token_id,
+                stopping_criteria=StoppingCriteriaList([
+                    CancellationCriteria(cancel_token, inputs['input_ids'].shape[1], max_new_tokens)
+                ]),
+                **(adapter_kwargs or {})
             )
         
+        if cancel_token is not None and cancel_token.cancelled:
+            return
+        
         # Decode generated tokens
         generated_text = tokenizer.decode(
             generated_ids[0][inputs['input_ids'].shape[1]:], 
@@ -663,6 +1545,39 @@ class MultiModelManager:
         
         yield generated_text
         
+    def _with_examples(self, prompt, chat_history, language, tokenizer, k):
+        """
+        Add the curated examples most similar to `prompt` to the request
+        
+        Chat models see them as earlier exchanges (the most similar one last);
+        other models get them as a preamble to the request.
+        
+        :return: (prompt, chat_history) to format
+        """
+        try:
+            examples = self.example_index.few_shot(
+                prompt, language=language, k=k, token_budget=FEW_SHOT_TOKEN_BUDGET,
+                count_tokens=lambda text: len(tokenizer(text, add_special_tokens=False)["input_ids"])
+            )
+        except Exception as e:
+            print(f"Few-shot retrieval failed: {e}")
+            return prompt, chat_history
+        if not examples:
+            return prompt, chat_history
+        
+        if self.models_config.get(language, {}).get('supports_chat', False):
+            turns = []
+            for example in reversed(examples):
+                turns.append({"role": "user", "content": example["instruction"]})
+                turns.append({"role": "assistant", "content": example["response"]})
+            return prompt, turns + list(chat_history or [])
+        
+        preamble = "\n\n".join(
+            f"Example request: {example['instruction']}\nExample solution:\n{example['response']}"
+            for example in reversed(examples)
+        )
+        return f"{preamble}\n\n{prompt}", chat_history
+    
     def _format_chat_prompt(self, current_message, chat_history=None, language=None):
         """
         Format prompt with chat history for different model types
@@ -833,18 +1748,7 @@ class MultiModelManager:
         """
         Detect programming language from the prompt
         """
-        # Simple language detection based on keywords
-        prompt_lower = prompt.lower()
-        
-        # PowerShell detection
-        powershell_keywords = ['get-', 'set-', 'new-', 'remove-', 'invoke-', 
-                                'windows', 'azure', 'active directory', 
-                                'powershell', 'cmdlet']
-        if any(keyword in prompt_lower for keyword in powershell_keywords):
-            return 'powershell'
-        
-        # Default to Python
-        return 'python'
+        return detect_language(prompt)
     
     def format_code(self, code, language):
         """
@@ -877,6 +1781,7 @@ class MultiModelManager:
         Clean shutdown all resources
         """
         print("Shutting down model manager...")
+        self.eviction_stop.set()
         
         # Unload all models
         for language in list(self.loaded_models.keys()):
@@ -0,0 +1,388 @@
+# onnx_backend.py - ONNX Runtime backend for CPU serving
+#
+# Usage:
+#   python onnx_backend.py export --model-name PATH [--int8] [--cache-dir models]
+#   python onnx_backend.py parity --model-name PATH [--int8] [--max-new-tokens 16]
+#
+# A models_config entry with 'backend': 'onnx' is exported once to ONNX with
+# explicit KV-cache inputs (past_key_values.N.key/value) and outputs
+# (present.N.key/value), optionally int8-quantized, graph-optimized by ONNX
+# Runtime and cached under <cache_dir>/onnx/. OnnxCausalLM then decodes with
+# the same `generate` keywords the manager passes to transformers models
+# (streamer, stopping_criteria, sampling settings), so streaming and
+# cancellation work unchanged.
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+
+# Opset with the ops Llama-style decoders need (Trilu, LayerNormalization)
+ONNX_OPSET = 17
+
+# Above this size ONNX files keep their weights in a separate data file
+EXTERNAL_DATA_THRESHOLD = 2 * 1024**3 - 1024**2
+
+PROMPTS = [
+    "Write a Python function that reverses a string.",
+    "Write a PowerShell script that lists running services.",
+    "def fibonacci(n):",
+]
+
+
+def _require_onnxruntime():
+    try:
+        import onnxruntime
+        return onnxruntime
+    except ImportError:
+        raise ImportError("The ONNX backend needs onnxruntime and onnx: pip install onnxruntime onnx")
+
+
+def artifact_dir(model_name, cache_dir="models"):
+    return os.path.join(cache_dir, "onnx", model_name.strip("/").replace("/", "--"))
+
+
+def _export_info():
+    import transformers
+    return {"torch": torch.__version__, "transformers": transformers.__version__, "opset": ONNX_OPSET}
+
+
+def _head_dim(config):
+    return getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+
+
+class _KVCacheWrapper(torch.nn.Module):
+    def __init__(self, model):
+        """Flatten the model's cache into per-layer key/value tensors so it can cross the ONNX boundary"""
+        super().__init__()
+        self.model = model
+        self.num_layers = model.config.num_hidden_layers
+
+    def forward(self, input_ids, attention_mask, position_ids, *past):
+        from transformers import DynamicCache
+        try:
+            cache = DynamicCache(config=self.model.config)
+        except TypeError:
+            cache = DynamicCache()
+        for layer in range(self.num_layers):
+            cache.update(past[2 * layer], past[2 * layer + 1], layer)
+        outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                             past_key_values=cache, use_cache=True)
+        present = []
+        for layer in range(self.num_layers):
+            if hasattr(outputs.past_key_values, "layers"):
+                present += [outputs.past_key_values.layers[layer].keys, outputs.past_key_values.layers[layer].values]
+            else:
+                present += list(outputs.past_key_values[layer])
+        return (outputs.logits, *present)
+
+
+def export_onnx(model_name, output_dir, hf_token=None, cache_dir=None):
+    """
+    Export a causal LM to `output_dir`/model.onnx with KV-cache inputs and outputs
+
+    :return: Path of the exported model
+    """
+    from transformers import AutoModelForCausalLM
+
+    auth_kwargs = {"token": hf_token} if hf_token else {}
+    print(f"Exporting {model_name} to ONNX...")
+    start = time.perf_counter()
+    # Eager attention traces to plain MatMul/Softmax, which every ONNX Runtime build optimizes
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name, **auth_kwargs, cache_dir=cache_dir, torch_dtype=torch.float32, attn_implementation="eager"
+    ).eval()
+    config = model.config
+    num_layers, num_heads, head_dim = config.num_hidden_layers, config.num_key_value_heads, _head_dim(config)
+
+    past_names = [f"past_key_values.{i}.{kind}" for i in range(num_layers) for kind in ("key", "value")]
+    present_names = [f"present.{i}.{kind}" for i in range(num_layers) for kind in ("key", "value")]
+    dynamic_axes = {
+        "input_ids": {0: "batch", 1: "sequence"},
+        "attention_mask": {0: "batch", 1: "total_sequence"},
+        "position_ids": {0: "batch", 1: "sequence"},
+        "logits": {0: "batch", 1: "sequence"},
+    }
+    dynamic_axes.update({name: {0: "batch", 2: "past_sequence"} for name in past_names})
+    dynamic_axes.update({name: {0: "batch", 2: "total_sequence"} for name in present_names})
+
+    # Trace with a non-empty past so the cache concatenation is part of the graph
+    past_length, sequence_length = 3, 4
+    input_ids = torch.randint(0, config.vocab_size, (1, sequence_length))
+    attention_mask = torch.ones(1, past_length + sequence_length, dtype=torch.long)
+    position_ids = torch.arange(past_length, past_length + sequence_length).unsqueeze(0)
+    past = [torch.zeros(1, num_heads, past_length, head_dim) for _ in past_names]
+
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, "model.onnx")
+    export_kwargs = dict(
+        input_names=["input_ids", "attention_mask", "position_ids"] + past_names,
+        output_names=["logits"] + present_names,
+        dynamic_axes=dynamic_axes,
+        opset_version=ONNX_OPSET,
+    )
+    with torch.no_grad():
+        try:
+            torch.onnx.export(_KVCacheWrapper(model), (input_ids, attention_mask, position_ids, *past), path,
+                              dynamo=False, **export_kwargs)
+        except TypeError:
+            # torch < 2.5 has only the TorchScript exporter
+            torch.onnx.export(_KVCacheWrapper(model), (input_ids, attention_mask, position_ids, *past), path,
+                              **export_kwargs)
+    config.save_pretrained(output_dir)
+    print(f"Exported in {time.perf_counter() - start:.1f}s")
+    return path
+
+
+def quantize_int8(path, output_path):
+    """Dynamic int8 quantization of the weights (activations stay float)"""
+    _require_onnxruntime()
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    print("Quantizing ONNX model to int8...")
+    quantize_dynamic(path, output_path, weight_type=QuantType.QInt8,
+                     use_external_data_format=os.path.getsize(path) > EXTERNAL_DATA_THRESHOLD)
+    return output_path
+
+
+def prepare_onnx_model(model_name, cache_dir="models", hf_token=None, quantize=True, force=False):
+    """
+    Export (and quantize) `model_name` unless a matching artifact is cached
+
+    :return: Directory holding model.onnx / model.int8.onnx and config.json
+    """
+    output_dir = artifact_dir(model_name, cache_dir)
+    info_path = os.path.join(output_dir, "export_info.json")
+    info = _export_info()
+    cached = {}
+    if os.path.exists(info_path) and not force:
+        with open(info_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+    if {k: cached.get(k) for k in info} != info:
+        export_onnx(model_name, output_dir, hf_token, cache_dir)
+        cached = dict(info, quantized=False)
+        # Optimized graphs were built from the previous export
+        for name in os.listdir(output_dir):
+            if name.endswith(".opt.onnx"):
+                os.remove(os.path.join(output_dir, name))
+    if quantize and not cached.get("quantized"):
+        quantize_int8(os.path.join(output_dir, "model.onnx"), os.path.join(output_dir, "model.int8.onnx"))
+        cached["quantized"] = True
+    with open(info_path, "w", encoding="utf-8") as f:
+        json.dump(cached, f, indent=2)
+    return output_dir
+
+
+class OnnxCausalLM:
+    def __init__(self, model_dir, quantized=True, num_threads=None):
+        """
+        Causal LM served by ONNX Runtime with an explicit KV cache
+
+        The first session for a model writes its graph-optimized form next to
+        the export (`*.opt.onnx`); later loads start from that file.
+
+        :param model_dir: Directory from `prepare_onnx_model`
+        :param quantized: Use the int8 model
+        :param num_threads: Intra-op threads (default: torch's thread count)
+        """
+        ort = _require_onnxruntime()
+        from transformers import AutoConfig
+
+        self.config = AutoConfig.from_pretrained(model_dir)
+        self.num_layers = self.config.num_hidden_layers
+        self.num_kv_heads = self.config.num_key_value_heads
+        self.head_dim = _head_dim(self.config)
+        self.device = torch.device("cpu")
+
+        name = "model.int8" if quantized else "model"
+        optimized_path = os.path.join(model_dir, f"{name}.opt.onnx")
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads or torch.get_num_threads()
+        if os.path.exists(optimized_path):
+            # Already optimized offline; skip the work at load
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            source = optimized_path
+        else:
+            # Extended (not ALL) keeps the saved graph free of CPU-specific layouts,
+            # so a cache directory shared between machines stays valid
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+            options.optimized_model_filepath = optimized_path
+            source = os.path.join(model_dir, f"{name}.onnx")
+            if os.path.getsize(source) > EXTERNAL_DATA_THRESHOLD:
+                options.add_session_config_entry(
+                    "session.optimized_model_external_initializers_file_name", f"{name}.opt.onnx.data"
+                )
+        self.session = ort.InferenceSession(source, options, providers=["CPUExecutionProvider"])
+        self.past_names = [f"past_key_values.{i}.{kind}" for i in range(self.num_layers) for kind in ("key", "value")]
+        print(f"ONNX Runtime session ready: {source}")
+
+    def _logits_processors(self, prompt_length, do_sample, temperature, top_k, top_p, repetition_penalty,
+                           min_new_tokens, eos_token_id):
+        from transformers import (
+            LogitsProcessorList, RepetitionPenaltyLogitsProcessor, MinNewTokensLengthLogitsProcessor,
+            TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+        )
+        processors = LogitsProcessorList()
+        if repetition_penalty and repetition_penalty != 1.0:
+            processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+        if min_new_tokens and eos_token_id is not None:
+            processors.append(MinNewTokensLengthLogitsProcessor(prompt_length, min_new_tokens, eos_token_id))
+        if do_sample:
+            if temperature and temperature != 1.0:
+                processors.append(TemperatureLogitsWarper(temperature))
+            if top_k:
+                processors.append(TopKLogitsWarper(top_k))
+            if top_p is not None and top_p < 1.0:
+                processors.append(TopPLogitsWarper(top_p))
+        return processors
+
+    def forward(self, input_ids, attention_mask, position_ids, past=None):
+        """One ONNX Runtime call; returns (logits, present key/values) as numpy arrays"""
+        if past is None:
+            batch_size = input_ids.shape[0]
+            empty = np.zeros((batch_size, self.num_kv_heads, 0, self.head_dim), dtype=np.float32)
+            past = [empty] * len(self.past_names)
+        feed = {
+            "input_ids": input_ids.numpy().astype(np.int64),
+            "attention_mask": attention_mask.numpy().astype(np.int64),
+            "position_ids": position_ids.numpy().astype(np.int64),
+        }
+        feed.update(zip(self.past_names, past))
+        outputs = self.session.run(None, feed)
+        return outputs[0], outputs[1:]
+
+    def generate(self, input_ids, attention_mask=None, max_new_tokens=20, min_new_tokens=0, do_sample=False,
+                 temperature=1.0, top_k=50, top_p=1.0, repetition_penalty=1.0, pad_token_id=None,
+                 eos_token_id=None, streamer=None, stopping_criteria=None, logits_processor=None, **unused):
+        """
+        Greedy or sampled decoding with the keyword arguments of `transformers` `generate`
+
+        Beam search settings (num_beams, early_stopping) are ignored: the
+        backend decodes a single beam per row. Rows that finish are padded
+        with `pad_token_id`, as in `transformers`. A caller's `logits_processor`
+        runs after the backend's own processors on every step.
+
+        :return: Tensor of prompt + generated ids
+        """
+        input_ids = input_ids.cpu()
+        attention_mask = torch.ones_like(input_ids) if attention_mask is None else attention_mask.cpu()
+        eos_token_id = self.config.eos_token_id if eos_token_id is None else eos_token_id
+        if isinstance(eos_token_id, (list, tuple)):
+            eos_token_id = eos_token_id[0]
+        pad_token_id = eos_token_id if pad_token_id is None else pad_token_id
+        processors = self._logits_processors(input_ids.shape[1], do_sample, temperature, top_k, top_p,
+                                             repetition_penalty, min_new_tokens, eos_token_id)
+
+        if streamer is not None:
+            streamer.put(input_ids)
+        # Left padding: positions count only real tokens
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        step_ids, past = input_ids, None
+        unfinished = torch.ones(input_ids.shape[0], dtype=torch.bool)
+        for _ in range(max_new_tokens):
+            logits, past = self.forward(step_ids, attention_mask, position_ids, past)
+            scores = processors(input_ids, torch.from_numpy(logits[:, -1, :]).float())
+            if logits_processor:
+                scores = logits_processor(input_ids, scores)
+            if do_sample:
+                next_tokens = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+            else:
+                next_tokens = scores.argmax(dim=-1)
+            next_tokens = torch.where(unfinished, next_tokens, torch.full_like(next_tokens, pad_token_id))
+
+            input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+            attention_mask = torch.cat([attention_mask, torch.ones_like(next_tokens[:, None])], dim=-1)
+            if streamer is not None:
+                streamer.put(next_tokens)
+
+            if eos_token_id is not None:
+                unfinished &= next_tokens != eos_token_id
+            if stopping_criteria:
+                unfinished &= ~torch.as_tensor(stopping_criteria(input_ids, scores), dtype=torch.bool)
+            if not unfinished.any():
+                break
+            step_ids = next_tokens[:, None]
+            position_ids = attention_mask.sum(-1, keepdim=True) - 1
+
+        if streamer is not None:
+            streamer.end()
+        return input_ids
+
+
+def load_onnx_model(model_name, cache_dir="models", hf_token=None, quantize=True):
+    """Export or reuse the cached artifact for `model_name` and open it; returns an `OnnxCausalLM`"""
+    model_dir = prepare_onnx_model(model_name, cache_dir, hf_token, quantize=quantize)
+    return OnnxCausalLM(model_dir, quantized=quantize)
+
+
+def parity(args):
+    """Compare greedy generations and prefill logits of the ONNX and PyTorch paths"""
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name, cache_dir=args.cache_dir)
+    reference = AutoModelForCausalLM.from_pretrained(args.model_name, cache_dir=args.cache_dir,
+                                                     torch_dtype=torch.float32).eval()
+    onnx_model = load_onnx_model(args.model_name, args.cache_dir, quantize=args.int8)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+    print(f"\nParity ({'int8' if args.int8 else 'fp32'} ONNX vs PyTorch), greedy, {args.max_new_tokens} new tokens")
+    print(f"{'prompt':<40}{'max |dlogit|':>14}{'tokens equal':>14}{'torch ms':>10}{'onnx ms':>10}")
+    mismatches = 0
+    for prompt in args.prompts:
+        inputs = tokenizer(prompt, return_tensors="pt")
+        with torch.no_grad():
+            torch_logits = reference(**inputs).logits.numpy()
+        position_ids = torch.arange(inputs["input_ids"].shape[1]).unsqueeze(0)
+        onnx_logits, _ = onnx_model.forward(inputs["input_ids"], inputs["attention_mask"], position_ids)
+        logit_error = float(np.abs(torch_logits - onnx_logits).max())
+
+        kwargs = dict(max_new_tokens=args.max_new_tokens, do_sample=False, pad_token_id=pad_token_id)
+        start = time.perf_counter()
+        with torch.no_grad():
+            torch_ids = reference.generate(**inputs, **kwargs)
+        torch_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        onnx_ids = onnx_model.generate(**inputs, **kwargs)
+        onnx_ms = (time.perf_counter() - start) * 1000
+
+        length = min(torch_ids.shape[1], onnx_ids.shape[1])
+        equal = bool(torch.equal(torch_ids[:, :length], onnx_ids[:, :length]))
+        mismatches += not equal
+        print(f"{prompt[:38]:<40}{logit_error:>14.2e}{str(equal):>14}{torch_ms:>10.0f}{onnx_ms:>10.0f}")
+
+    if mismatches and not args.int8:
+        print(f"{mismatches} prompt(s) decoded differently")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export and check the ONNX Runtime backend")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export = subparsers.add_parser("export", help="Export (and quantize) a model into the ONNX cache")
+    export.add_argument("--model-name", required=True)
+    export.add_argument("--cache-dir", default="models")
+    export.add_argument("--int8", action="store_true", help="Also write the int8-quantized model")
+    export.add_argument("--force", action="store_true", help="Re-export even if a cached artifact exists")
+
+    check = subparsers.add_parser("parity", help="Compare ONNX and PyTorch outputs on a few prompts")
+    check.add_argument("--model-name", required=True)
+    check.add_argument("--cache-dir", default="models")
+    check.add_argument("--int8", action="store_true", help="Check the int8 model (differences are expected)")
+    check.add_argument("--max-new-tokens", type=int, default=16)
+    check.add_argument("--prompts", nargs="+", default=PROMPTS)
+
+    args = parser.parse_args()
+    if args.command == "export":
+        print(prepare_onnx_model(args.model_name, args.cache_dir, os.environ.get("HUGGING_FACE_HUB_TOKEN"),
+                                 quantize=args.int8, force=args.force))
+        return 0
+    return parity(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
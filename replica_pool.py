@@ -0,0 +1,369 @@
+# replica_pool.py - Inference replicas in separate processes, pinned to disjoint CPU cores
+#
+# Each replica is a spawned process with its own MultiModelManager, its own
+# GIL and its own torch thread pool sized to its core set. A router in the
+# front-end process sends every request to the replica with the fewest
+# outstanding tokens and streams partial responses back.
+
+import os
+import time
+import queue
+import itertools
+import threading
+import multiprocessing
+from collections import Counter
+
+from language_detection import detect_language
+
+# Rough characters per token, used only to weigh prompts when routing
+CHARS_PER_TOKEN = 4
+
+# Seconds between checks of a request's cancellation token while waiting for output
+CANCEL_POLL_INTERVAL = 0.2
+
+# Seconds a replica may take to start (import torch, build its manager)
+REPLICA_START_TIMEOUT = 300
+
+# Seconds between checks for replicas that died, however busy the response queue is
+REPLICA_CHECK_INTERVAL = 1.0
+
+
+def split_cores(num_replicas, cores=None):
+    """
+    Split the usable CPU cores into `num_replicas` disjoint, contiguous sets
+
+    Contiguous ranges keep a replica's threads on neighbouring cores, which
+    usually share a cache complex.
+    """
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    if num_replicas > len(cores):
+        raise ValueError(f"Cannot pin {num_replicas} replicas to {len(cores)} cores")
+    size, extra = divmod(len(cores), num_replicas)
+    core_sets = []
+    start = 0
+    for i in range(num_replicas):
+        end = start + size + (1 if i < extra else 0)
+        core_sets.append(cores[start:end])
+        start = end
+    return core_sets
+
+
+class SharedCancellation:
+    def __init__(self, cancels, cancelled_ids, request_id):
+        """
+        Cancellation token for one request on a replica
+
+        The front end cancels by putting the request id on the replica's
+        `cancels` queue. Every token of a replica drains that queue into the
+        shared `cancelled_ids` set, so requests still waiting in the replica's
+        queue can be cancelled too, not only the one being served.
+        """
+        self.cancels = cancels
+        self.cancelled_ids = cancelled_ids
+        self.request_id = request_id
+
+    @property
+    def cancelled(self):
+        while True:
+            try:
+                self.cancelled_ids.add(self.cancels.get_nowait())
+            except queue.Empty:
+                break
+        return self.request_id in self.cancelled_ids
+
+    def is_cancelled(self):
+        return self.cancelled
+
+    def cancel(self, reason="cancelled"):
+        self.cancelled_ids.add(self.request_id)
+
+
+def replica_main(replica_id, cores, models_config, cache_dir, hf_token, preload, requests, responses, cancels,
+                 training_dir=None):
+    """
+    Worker process entry point: serve requests from `requests` until a None arrives
+
+    Messages put on `responses` are (replica_id, request_id, kind, payload)
+    with kind one of "ready", "text", "done" or "error". "done" carries the
+    replica's cancellation counters.
+    """
+    # Pin before torch starts its thread pools so they inherit the core set
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    os.environ["OMP_NUM_THREADS"] = str(len(cores))
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+    import torch
+    from model_manager import MultiModelManager
+    from cancellation import cancellation_metrics
+
+    # Calibrating here would run one calibration per replica at once; a cached
+    # result for this core count and model (e.g. from `cpu_calibration.py` under taskset) is used
+    model_manager = MultiModelManager(models_config, cache_dir=cache_dir, cpu_calibration="cached")
+    model_manager.set_auth_token(hf_token)
+    if training_dir:
+        from example_index import ExampleIndex
+        model_manager.example_index = ExampleIndex.open(training_dir)
+    # The manager sizes torch threads for the whole machine; this replica owns only its cores
+    torch.set_num_threads(len(cores))
+    for language in preload or []:
+        model_manager.load_model(language)
+    responses.put((replica_id, None, "ready", model_manager.models_config))
+
+    cancelled_ids = set()
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        request_id, kwargs = message
+        cancel_token = SharedCancellation(cancels, cancelled_ids, request_id)
+        cancelled = cancel_token.cancelled
+        # Ids reach this replica in increasing order, so cancels for earlier ids (which can
+        # arrive after their request finished) are stale
+        cancelled_ids.difference_update([i for i in cancelled_ids if i < request_id])
+        if cancelled:
+            responses.put((replica_id, request_id, "done", cancellation_metrics()))
+            continue
+        try:
+            for text in model_manager.generate_code(cancel_token=cancel_token, **kwargs):
+                responses.put((replica_id, request_id, "text", text))
+            responses.put((replica_id, request_id, "done", cancellation_metrics()))
+        except Exception as e:
+            responses.put((replica_id, request_id, "error", f"{type(e).__name__}: {e}"))
+
+    model_manager.shutdown()
+
+
+class ReplicaPool:
+    def __init__(self, num_replicas, models_config=None, cache_dir="models", hf_token=None,
+                 preload=None, cores=None, training_dir=None):
+        """
+        Start `num_replicas` inference processes and route requests between them
+
+        Exposes the subset of the `MultiModelManager` interface the API server
+        uses (`generate_code`, `detect_language`, `models_config`, `loaded_models`),
+        so it can be dropped in wherever a manager is expected.
+
+        :param num_replicas: Number of worker processes
+        :param models_config: Model configuration passed to every replica's manager
+        :param cache_dir: Model cache directory
+        :param hf_token: Hugging Face token
+        :param preload: Languages each replica loads before reporting ready
+        :param cores: CPU cores to divide between replicas (default: all usable cores)
+        :param training_dir: Training data directory each replica indexes for few-shot prompts
+        """
+        self.num_replicas = num_replicas
+        self.core_sets = split_cores(num_replicas, cores)
+        self.loaded_tokenizers = {}  # token counts are not available across processes
+        # Languages some replica has loaded (preloaded or already served)
+        self.loaded_models = set(preload or [])
+        self.models_config = dict(models_config or {})
+
+        context = multiprocessing.get_context('spawn')  # Avoid fork issues
+        self.responses = context.Queue()
+        self.request_queues = []
+        self.cancel_queues = []
+        self.processes = []
+        for replica_id, cores in enumerate(self.core_sets):
+            requests = context.Queue()
+            cancels = context.Queue()
+            process = context.Process(
+                target=replica_main,
+                args=(replica_id, cores, models_config, cache_dir, hf_token, preload, requests, self.responses,
+                      cancels, training_dir),
+                name=f"replica-{replica_id}",
+                daemon=True
+            )
+            process.start()
+            self.request_queues.append(requests)
+            self.cancel_queues.append(cancels)
+            self.processes.append(process)
+
+        # Router state, guarded by self.lock
+        self.lock = threading.Lock()
+        self.outstanding = [0] * num_replicas  # estimated tokens still to process per replica
+        self.inflight = {}  # request_id -> {"replica", "remaining", "streamed", "output"}
+        self.completed = [0] * num_replicas
+        self.alive = [True] * num_replicas
+        self.replica_metrics = [{} for _ in range(num_replicas)]  # latest cancellation counters
+        self.request_ids = itertools.count()
+
+        self._wait_until_ready()
+        self.dispatcher = threading.Thread(target=self._dispatch_responses, daemon=True, name="replica-router")
+        self.dispatcher.start()
+
+    def _wait_until_ready(self):
+        ready = set()
+        deadline = time.monotonic() + REPLICA_START_TIMEOUT
+        while len(ready) < self.num_replicas:
+            try:
+                replica_id, _, kind, payload = self.responses.get(timeout=1)
+            except queue.Empty:
+                for replica_id, process in enumerate(self.processes):
+                    if not process.is_alive():
+                        self.shutdown()
+                        raise RuntimeError(f"Replica {replica_id} exited during start-up (code {process.exitcode})")
+                if time.monotonic() > deadline:
+                    self.shutdown()
+                    raise RuntimeError(f"Replicas did not start within {REPLICA_START_TIMEOUT}s")
+                continue
+            if kind == "ready":
+                ready.add(replica_id)
+                self.models_config = payload
+                print(f"Replica {replica_id} ready on cores {self.core_sets[replica_id]}")
+
+    def _dispatch_responses(self):
+        """Route messages from every replica to the queue of the request they belong to"""
+        next_check = time.monotonic() + REPLICA_CHECK_INTERVAL
+        while True:
+            if time.monotonic() >= next_check:
+                # Checked on every pass, so a replica that dies while others keep streaming is noticed
+                self._check_replicas()
+                next_check = time.monotonic() + REPLICA_CHECK_INTERVAL
+            try:
+                replica_id, request_id, kind, payload = self.responses.get(timeout=REPLICA_CHECK_INTERVAL)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                return  # pool shut down
+            with self.lock:
+                entry = self.inflight.get(request_id)
+                if entry is None:
+                    if kind == "done" and payload:
+                        self.replica_metrics[replica_id] = payload
+                    continue
+                if kind == "text":
+                    # Count streamed output against the estimate so long generations free up capacity
+                    progress = len(payload) // CHARS_PER_TOKEN
+                    used = min(entry["remaining"], max(0, progress - entry["streamed"]))
+                    entry["remaining"] -= used
+                    entry["streamed"] = progress
+                    self.outstanding[replica_id] -= used
+                else:
+                    self._finish(request_id)
+                    if kind == "done" and payload:
+                        self.replica_metrics[replica_id] = payload
+            entry["output"].put((kind, payload))
+
+    def _finish(self, request_id):
+        entry = self.inflight.pop(request_id)
+        self.outstanding[entry["replica"]] -= entry["remaining"]
+        self.completed[entry["replica"]] += 1
+
+    def _check_replicas(self):
+        """Fail the in-flight requests of replicas that died and stop routing to them"""
+        with self.lock:
+            for replica_id, process in enumerate(self.processes):
+                if not self.alive[replica_id] or process.is_alive():
+                    continue
+                self.alive[replica_id] = False
+                print(f"Replica {replica_id} exited (code {process.exitcode}); routing around it")
+                for request_id, entry in list(self.inflight.items()):
+                    if entry["replica"] == replica_id:
+                        self._finish(request_id)
+                        entry["output"].put(("error", f"Replica {replica_id} exited"))
+
+    def _pick_replica(self):
+        candidates = [i for i in range(self.num_replicas) if self.alive[i]]
+        if not candidates:
+            raise RuntimeError("No inference replicas are running")
+        return min(candidates, key=lambda i: (self.outstanding[i], i))
+
+    ### Manager interface
+
+    def detect_language(self, prompt):
+        return detect_language(prompt)
+
+    def generate_code(self, prompt, chat_history=None, language=None, temperature=0.2, max_new_tokens=1024,
+                      repetition_penalty=1.1, stream=False, cancel_token=None, best_of=1, few_shot=0):
+        """
+        Run `MultiModelManager.generate_code` on the least loaded replica
+
+        Cancelling `cancel_token`, or closing this generator early, stops the
+        replica's generation within one decoding step.
+
+        :yield: Generated code responses (cumulative text), as the replica produces them
+        """
+        kwargs = {
+            "prompt": prompt,
+            "chat_history": chat_history,
+            "language": language or detect_language(prompt),
+            "temperature": temperature,
+            "max_new_tokens": max_new_tokens,
+            "repetition_penalty": repetition_penalty,
+            "stream": stream,
+            "best_of": best_of,
+            "few_shot": few_shot,
+        }
+        history_chars = sum(len(m.get("content") or "") for m in chat_history or [])
+        cost = (len(prompt) + history_chars) // CHARS_PER_TOKEN + max_new_tokens * best_of
+
+        self.loaded_models.add(kwargs["language"])
+        output = queue.Queue()
+        with self.lock:
+            replica_id = self._pick_replica()
+            request_id = next(self.request_ids)
+            self.outstanding[replica_id] += cost
+            self.inflight[request_id] = {"replica": replica_id, "remaining": cost, "streamed": 0, "output": output}
+            # Queued under the lock so each replica receives its request ids in increasing order
+            self.request_queues[replica_id].put((request_id, kwargs))
+
+        finished = False
+        try:
+            while True:
+                try:
+                    kind, payload = output.get(timeout=CANCEL_POLL_INTERVAL)
+                except queue.Empty:
+                    if cancel_token is not None and cancel_token.cancelled:
+                        return
+                    continue
+                if kind == "text":
+                    yield payload
+                elif kind == "done":
+                    finished = True
+                    return
+                else:
+                    finished = True
+                    raise RuntimeError(payload)
+        finally:
+            with self.lock:
+                pending = request_id in self.inflight
+                if pending:
+                    self._finish(request_id)
+            if not finished and pending:
+                # Nobody is listening any more; skip the request if it is still queued on
+                # the replica, or stop it at its next decoding step
+                self.cancel_queues[replica_id].put(request_id)
+
+    def cancellation_metrics(self):
+        """Cancellation counters summed over replicas"""
+        with self.lock:
+            totals = Counter()
+            for metrics in self.replica_metrics:
+                totals.update(metrics)
+            return dict(totals)
+
+    def stats(self):
+        """Per-replica routing counters"""
+        with self.lock:
+            return [
+                {
+                    "replica": i,
+                    "cores": self.core_sets[i],
+                    "alive": self.alive[i],
+                    "outstanding_tokens": self.outstanding[i],
+                    "completed": self.completed[i],
+                }
+                for i in range(self.num_replicas)
+            ]
+
+    def shutdown(self):
+        print("Shutting down inference replicas...")
+        for requests, process in zip(self.request_queues, self.processes):
+            if process.is_alive():
+                requests.put(None)
+        for process in self.processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
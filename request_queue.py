@@ -0,0 +1,245 @@
+# request_queue.py - Admission control and scheduling for inference requests
+#
+# Requests take a ticket before they may generate. At most `max_concurrency`
+# tickets run at once; up to `max_depth` more wait, and anything beyond that
+# is rejected immediately with `QueueFull`. Waiting tickets are ordered by:
+#   1. priority class (interactive before batch)
+#   2. fairness round: a session's k-th queued request competes in round k,
+#      and sessions already running a request start one round later
+#   3. shortest expected job (prompt + max_new_tokens), aged by waiting time
+#   4. arrival order
+
+import time
+import asyncio
+import itertools
+import threading
+from contextlib import contextmanager
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+PRIORITY_CLASSES = (INTERACTIVE, BATCH)
+
+# Rough characters per token for cost estimates before tokenization
+CHARS_PER_TOKEN = 4
+
+# Expected-cost tokens forgiven per second of waiting, so long jobs are not starved
+AGING_TOKENS_PER_SEC = 50
+
+# Weight of the newest request in the running average of service time
+SERVICE_TIME_SMOOTHING = 0.2
+
+
+def estimate_cost(prompt, max_new_tokens, chat_history=None):
+    """Expected work of a request in tokens: its prompt (estimated) plus the tokens it may generate"""
+    history_chars = sum(len(m.get("content") or "") for m in chat_history or [])
+    return (len(prompt or "") + history_chars) // CHARS_PER_TOKEN + int(max_new_tokens)
+
+
+class QueueFull(Exception):
+    def __init__(self, message, reason, retry_after):
+        """
+        Raised when a request cannot be admitted
+
+        :param reason: "queue_full" or "session_limit"
+        :param retry_after: Suggested seconds before retrying
+        """
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    def __init__(self, session_id, cost, priority, sequence):
+        """A request's place in the queue; granted once it may start generating"""
+        self.session_id = session_id
+        self.cost = cost
+        self.priority = priority
+        self.sequence = sequence
+        self.enqueued_at = time.monotonic()
+        self.granted_at = None
+        self.released = False
+        self._granted = threading.Event()
+        self._callbacks = []
+
+    @property
+    def granted(self):
+        return self._granted.is_set()
+
+    @property
+    def wait_time(self):
+        """Seconds spent waiting (so far, if still queued)"""
+        return (self.granted_at or time.monotonic()) - self.enqueued_at
+
+    def wait(self, timeout=None):
+        """Block until granted; returns False on timeout"""
+        return self._granted.wait(timeout)
+
+    async def wait_async(self):
+        """Wait for the grant without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def on_grant():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        self._add_callback(on_grant)
+        await future
+
+    def _add_callback(self, callback):
+        self._callbacks.append(callback)
+        if self.granted:
+            callback()
+
+    def _grant(self):
+        self.granted_at = time.monotonic()
+        self._granted.set()
+        for callback in self._callbacks:
+            callback()
+
+
+class RequestQueue:
+    def __init__(self, max_concurrency=1, max_depth=32, max_per_session=4):
+        """
+        Bounded, prioritised, per-session fair queue in front of the model manager
+
+        :param max_concurrency: Requests generating at the same time
+        :param max_depth: Requests allowed to wait; more are rejected immediately
+        :param max_per_session: Requests (waiting + running) one session may hold
+        """
+        self.max_concurrency = max_concurrency
+        self.max_depth = max_depth
+        self.max_per_session = max_per_session
+
+        self.lock = threading.Lock()
+        self.waiting = []
+        self.running = set()
+        self.sequence = itertools.count()
+        self.avg_service_time = None
+        self.counters = {"admitted": 0, "rejected": 0, "completed": 0, "abandoned": 0}
+
+    ### Admission
+
+    def submit(self, session_id, cost, priority=INTERACTIVE):
+        """
+        Admit a request or reject it immediately
+
+        :param session_id: Fairness key (browser session, API user, client address)
+        :param cost: Expected work in tokens, see `estimate_cost`
+        :param priority: INTERACTIVE or BATCH
+        :return: A `Ticket`, possibly already granted
+        :raises QueueFull: The queue or the session's share of it is full
+        """
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class: {priority}")
+
+        with self.lock:
+            held = sum(1 for t in self.waiting if t.session_id == session_id)
+            held += sum(1 for t in self.running if t.session_id == session_id)
+            if held >= self.max_per_session:
+                self.counters["rejected"] += 1
+                raise QueueFull(
+                    f"Too many requests in flight for this session ({held}); wait for one to finish",
+                    "session_limit", self._retry_after(1)
+                )
+            if len(self.waiting) >= self.max_depth and len(self.running) >= self.max_concurrency:
+                self.counters["rejected"] += 1
+                raise QueueFull(
+                    f"Server is busy: {len(self.waiting)} requests already queued",
+                    "queue_full", self._retry_after(len(self.waiting))
+                )
+
+            ticket = Ticket(session_id, cost, priority, next(self.sequence))
+            self.waiting.append(ticket)
+            self.counters["admitted"] += 1
+            self._schedule()
+            return ticket
+
+    def release(self, ticket):
+        """Free a running ticket's slot, or withdraw a waiting one"""
+        with self.lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket in self.running:
+                self.running.discard(ticket)
+                self.counters["completed"] += 1
+                service_time = time.monotonic() - ticket.granted_at
+                if self.avg_service_time is None:
+                    self.avg_service_time = service_time
+                else:
+                    self.avg_service_time += SERVICE_TIME_SMOOTHING * (service_time - self.avg_service_time)
+            elif ticket in self.waiting:
+                self.waiting.remove(ticket)
+                self.counters["abandoned"] += 1
+            self._schedule()
+
+    @contextmanager
+    def slot(self, session_id, cost, priority=INTERACTIVE):
+        """Hold a slot for the duration of a `with` block (blocks while queued)"""
+        ticket = self.submit(session_id, cost, priority)
+        try:
+            ticket.wait()
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    ### Scheduling
+
+    def _order(self, now):
+        """Sort key for every waiting ticket, best first"""
+        running_sessions = {t.session_id for t in self.running}
+        by_session = {}
+        for ticket in self.waiting:
+            by_session.setdefault(ticket.session_id, []).append(ticket)
+
+        keys = {}
+        for session_id, tickets in by_session.items():
+            tickets.sort(key=lambda t: (PRIORITY_CLASSES.index(t.priority), self._aged_cost(t, now), t.sequence))
+            offset = 1 if session_id in running_sessions else 0
+            for rank, ticket in enumerate(tickets):
+                keys[ticket] = (
+                    PRIORITY_CLASSES.index(ticket.priority),
+                    rank + offset,
+                    self._aged_cost(ticket, now),
+                    ticket.sequence,
+                )
+        return keys
+
+    @staticmethod
+    def _aged_cost(ticket, now):
+        return ticket.cost - AGING_TOKENS_PER_SEC * (now - ticket.enqueued_at)
+
+    def _schedule(self):
+        while self.waiting and len(self.running) < self.max_concurrency:
+            keys = self._order(time.monotonic())
+            ticket = min(self.waiting, key=keys.__getitem__)
+            self.waiting.remove(ticket)
+            self.running.add(ticket)
+            ticket._grant()
+
+    def _retry_after(self, ahead):
+        per_request = self.avg_service_time or 5.0
+        return max(1, round(per_request * ahead / max(1, self.max_concurrency)))
+
+    ### Introspection
+
+    def position(self, ticket):
+        """1-based position among waiting tickets, or 0 once granted"""
+        with self.lock:
+            if ticket not in self.waiting:
+                return 0
+            keys = self._order(time.monotonic())
+            return sorted(self.waiting, key=keys.__getitem__).index(ticket) + 1
+
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            return {
+                "running": len(self.running),
+                "waiting": len(self.waiting),
+                "max_concurrency": self.max_concurrency,
+                "max_depth": self.max_depth,
+                "oldest_wait_sec": round(max((now - t.enqueued_at for t in self.waiting), default=0.0), 3),
+                "avg_service_sec": round(self.avg_service_time or 0.0, 3),
+                **self.counters,
+            }
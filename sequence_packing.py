@@ -0,0 +1,218 @@
+# sequence_packing.py - Sequence packing, dynamic padding and throughput metrics for fine-tuning
+
+import time
+
+import numpy as np
+import torch
+from transformers import TrainerCallback
+
+# Label value ignored by the causal LM loss
+IGNORE_INDEX = -100
+
+
+# Bin packing is first-fit decreasing within chunks of this many examples,
+# which keeps planning linear in the dataset size
+PACKING_CHUNK_SIZE = 1000
+
+
+def plan_packing(lengths, max_length, chunk_size=PACKING_CHUNK_SIZE):
+    """
+    Group example indices into rows of at most `max_length` tokens
+
+    :param lengths: Token count of each example, including its trailing EOS
+    :param max_length: Length of a packed row
+    :return: List of index lists, one per packed row
+    """
+    rows = []
+    for chunk_start in range(0, len(lengths), chunk_size):
+        chunk = sorted(
+            range(chunk_start, min(chunk_start + chunk_size, len(lengths))),
+            key=lambda i: lengths[i],
+            reverse=True
+        )
+        bins = []  # each bin: [free_space, [indices]]
+        for i in chunk:
+            length = min(lengths[i], max_length)
+            for packed in bins:
+                if packed[0] >= length:
+                    packed[0] -= length
+                    packed[1].append(i)
+                    break
+            else:
+                bins.append([max_length - length, [i]])
+        rows.extend(members for _, members in bins)
+    return rows
+
+
+def build_packed_row(sequences, max_length, eos_token_id):
+    """
+    Concatenate tokenized conversations into one packed training row
+
+    Every conversation is terminated with EOS and gets `position_ids` that
+    restart at 0, which the collator uses to rebuild the attention boundaries.
+    The first token of each conversation is excluded from the loss so it is
+    never predicted from the previous one.
+
+    :param sequences: Token ID sequences (lists or numpy arrays, without EOS)
+    :param max_length: Length of a packed row
+    :param eos_token_id: Token appended to every conversation
+    :return: Dict with `input_ids`, `labels` and `position_ids` int64 arrays
+    """
+    input_ids, labels, position_ids = [], [], []
+    eos = np.array([eos_token_id], dtype=np.int64)
+    for ids in sequences:
+        ids = np.concatenate([np.asarray(ids[:max_length - 1], dtype=np.int64), eos])
+        input_ids.append(ids)
+        label = ids.copy()
+        label[0] = IGNORE_INDEX
+        labels.append(label)
+        position_ids.append(np.arange(len(ids), dtype=np.int64))
+
+    return {
+        "input_ids": np.concatenate(input_ids),
+        "labels": np.concatenate(labels),
+        "position_ids": np.concatenate(position_ids),
+    }
+
+
+def _as_long_tensor(values):
+    # Converting through numpy copies memory-mapped int32 views exactly once
+    return torch.from_numpy(np.asarray(values, dtype=np.int64))
+
+
+class PaddingStats:
+    """Running count of real versus padded token positions seen by a collator"""
+
+    def __init__(self):
+        self.real_tokens = 0
+        self.total_tokens = 0
+
+    def update(self, real, total):
+        self.real_tokens += real
+        self.total_tokens += total
+
+    @property
+    def padding_ratio(self):
+        if not self.total_tokens:
+            return 0.0
+        return 1.0 - self.real_tokens / self.total_tokens
+
+
+class DynamicPaddingCollator:
+    def __init__(self, pad_token_id, pad_to_length=None):
+        """
+        Pad a batch of unpadded examples and build causal LM labels
+
+        :param pad_token_id: Token used for padding
+        :param pad_to_length: Pad every batch to this length instead of the
+            longest example (reproduces `padding="max_length"`)
+        """
+        self.pad_token_id = pad_token_id
+        self.pad_to_length = pad_to_length
+        self.stats = PaddingStats()
+
+    def __call__(self, features):
+        lengths = [len(f["input_ids"]) for f in features]
+        length = self.pad_to_length or max(lengths)
+
+        input_ids = torch.full((len(features), length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(features), length), dtype=torch.long)
+        labels = torch.full((len(features), length), IGNORE_INDEX, dtype=torch.long)
+
+        for i, feature in enumerate(features):
+            ids = _as_long_tensor(feature["input_ids"][:length])
+            input_ids[i, :len(ids)] = ids
+            attention_mask[i, :len(ids)] = 1
+            labels[i, :len(ids)] = ids
+
+        self.stats.update(int(attention_mask.sum()), input_ids.numel())
+        return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+
+
+class PackedCollator:
+    def __init__(self, pad_token_id, attn_implementation=None, mask_dtype=torch.float32):
+        """
+        Collate packed rows produced by `build_packed_row`
+
+        With Flash Attention 2 the per-conversation `position_ids` are enough
+        for transformers to attend within each conversation only. Other
+        attention implementations get an explicit 4D block-diagonal causal
+        mask in the inverted (additive) form transformers expects.
+
+        :param pad_token_id: Token used for padding
+        :param attn_implementation: The model's `config._attn_implementation`
+        :param mask_dtype: dtype of the 4D attention mask
+        """
+        self.pad_token_id = pad_token_id
+        self.use_position_ids_only = attn_implementation == "flash_attention_2"
+        self.mask_dtype = mask_dtype
+        self.stats = PaddingStats()
+
+    def __call__(self, features):
+        length = max(len(f["input_ids"]) for f in features)
+        batch_size = len(features)
+
+        input_ids = torch.full((batch_size, length), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((batch_size, length), IGNORE_INDEX, dtype=torch.long)
+        position_ids = torch.zeros((batch_size, length), dtype=torch.long)
+        # Segment 0 marks padding; conversations are numbered from 1
+        segment_ids = torch.zeros((batch_size, length), dtype=torch.long)
+
+        for i, feature in enumerate(features):
+            n = len(feature["input_ids"])
+            input_ids[i, :n] = _as_long_tensor(feature["input_ids"])
+            labels[i, :n] = _as_long_tensor(feature["labels"])
+            positions = _as_long_tensor(feature["position_ids"])
+            position_ids[i, :n] = positions
+            segment_ids[i, :n] = torch.cumsum(positions == 0, dim=0)
+
+        real = int((segment_ids > 0).sum())
+        self.stats.update(real, input_ids.numel())
+
+        batch = {"input_ids": input_ids, "labels": labels, "position_ids": position_ids}
+        if self.use_position_ids_only:
+            return batch
+
+        same_segment = segment_ids[:, :, None] == segment_ids[:, None, :]
+        causal = torch.ones((length, length), dtype=torch.bool).tril()
+        allowed = same_segment & causal & (segment_ids > 0)[:, :, None]
+        # Let padding rows attend to themselves so softmax never sees an empty row
+        allowed |= torch.eye(length, dtype=torch.bool)
+
+        mask = torch.zeros((batch_size, 1, length, length), dtype=self.mask_dtype)
+        mask.masked_fill_(~allowed[:, None], torch.finfo(self.mask_dtype).min)
+        batch["attention_mask"] = mask
+        return batch
+
+
+class ThroughputCallback(TrainerCallback):
+    def __init__(self, stats):
+        """
+        Report padding ratio and effective (non-padding) tokens/sec in the trainer logs
+
+        :param stats: The `PaddingStats` of the collator in use
+        """
+        self.stats = stats
+        self.start_time = None
+        self.start_real_tokens = 0
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.start_time = time.perf_counter()
+        self.start_real_tokens = self.stats.real_tokens
+
+    def _summary(self):
+        elapsed = max(time.perf_counter() - self.start_time, 1e-9)
+        real_tokens = self.stats.real_tokens - self.start_real_tokens
+        return {
+            "padding_ratio": round(self.stats.padding_ratio, 4),
+            "effective_tokens_per_sec": round(real_tokens / elapsed, 1),
+        }
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs is not None and self.start_time is not None:
+            logs.update(self._summary())
+
+    def on_train_end(self, args, state, control, **kwargs):
+        summary = self._summary()
+        print(f"Padding ratio: {summary['padding_ratio']:.1%}, "
+              f"effective throughput: {summary['effective_tokens_per_sec']:.1f} tokens/sec")
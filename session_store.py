@@ -0,0 +1,312 @@
+# session_store.py - Persistent chat sessions with fast resume
+#
+# Every session has one append-only JSON-lines log under CHAT_HISTORY_DIR.
+# Each line is either a chat turn or a batch of token-ID cache entries, so a
+# session is resumed by reading a single file once, and a resumed
+# conversation reuses the token IDs of its history instead of re-tokenizing
+# it. Recently used sessions stay in an in-memory LRU; compaction deletes
+# sessions past their age limit, then the oldest ones until the directory
+# fits its size budget, and rewrites logs that have grown too long.
+#
+# Usage:
+#   store = SessionStore("chat_history")
+#   session = store.get(session_id)
+#   manager.generate_code(message, chat_history=session.history(), token_cache=session.token_cache)
+#   store.append(session_id, "user", message)
+#   store.append(session_id, "assistant", response)
+#   store.save_tokens(session_id)
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+
+CHAT_HISTORY_DIR = "chat_history"
+
+# Sessions kept in memory; older ones are re-read from disk on demand
+MAX_HOT_SESSIONS = 64
+
+# Sessions untouched for this long are deleted by compaction
+MAX_SESSION_AGE_DAYS = 30
+
+# Budget for the whole history directory
+MAX_HISTORY_MB = 256
+
+# Logs past this size are rewritten with only their recent turns and cache entries
+MAX_SESSION_BYTES = 2 * 1024 * 1024
+
+# What a rewritten log keeps
+MAX_TURNS_KEPT = 200
+MAX_CACHED_PIECES = 256
+
+# Appends between automatic compactions
+COMPACT_EVERY = 200
+
+_SAFE_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def _piece_key(piece, anchor):
+    digest = hashlib.blake2b(f"{anchor or ''}\0{piece}".encode("utf-8"), digest_size=12)
+    return digest.hexdigest()
+
+
+def _affixes(tokenizer):
+    """Token ids the tokenizer adds before and after a sequence (e.g. BOS)"""
+    with_special = tokenizer("a", add_special_tokens=True)["input_ids"]
+    plain = tokenizer("a", add_special_tokens=False)["input_ids"]
+    for start in range(len(with_special) - len(plain) + 1):
+        if with_special[start:start + len(plain)] == plain:
+            return with_special[:start], with_special[start + len(plain):]
+    return [], []
+
+
+def encode_with_cache(tokenizer, text, cache, max_length=1024):
+    """
+    Tokenize `text` like `tokenizer(text, truncation=True, max_length=...)`,
+    reusing token ids of pieces seen before
+
+    The text is split at special tokens (e.g. the `</s><s>` between chat
+    exchanges). Fast tokenizers encode each piece between special tokens
+    independently, so the concatenated ids match a one-shot encode exactly.
+    A piece after a special token is encoded behind that token so prefix-space
+    and whitespace-stripping rules match too. Hits move to the end of `cache` when it is an
+    OrderedDict, so it can be trimmed to the most recently used pieces.
+
+    :param cache: dict of piece key -> token ids, updated in place
+    :return: dict with `input_ids` and `attention_mask` tensors of shape (1, n)
+    """
+    specials = sorted(set(tokenizer.all_special_tokens), key=len, reverse=True)
+    pattern = "(" + "|".join(re.escape(token) for token in specials) + ")" if specials else None
+    pieces = re.split(pattern, text) if pattern else [text]
+
+    ids = []
+    anchor = None
+    for piece in pieces:
+        if not piece:
+            continue
+        if piece in specials:
+            ids.append(tokenizer.convert_tokens_to_ids(piece))
+            anchor = piece
+            continue
+        key = _piece_key(piece, anchor)
+        piece_ids = cache.get(key)
+        if piece_ids is None:
+            if anchor is not None:
+                # Encode behind the special token it follows, as in the full text, then drop it
+                piece_ids = tokenizer(anchor + piece, add_special_tokens=False)["input_ids"][1:]
+            else:
+                piece_ids = tokenizer(piece, add_special_tokens=False)["input_ids"]
+            cache[key] = piece_ids
+        elif hasattr(cache, "move_to_end"):
+            cache.move_to_end(key)
+        ids.extend(piece_ids)
+        anchor = None
+
+    prefix, suffix = _affixes(tokenizer)
+    budget = max_length - len(prefix) - len(suffix)
+    if len(ids) > budget:
+        ids = ids[-budget:] if tokenizer.truncation_side == "left" else ids[:budget]
+    input_ids = torch.tensor([prefix + ids + suffix], dtype=torch.long)
+    return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+
+class ChatSession:
+    def __init__(self, session_id):
+        """
+        One conversation: its turns and per-tokenizer token-ID caches
+
+        :param session_id: Stable id the session is stored under
+        """
+        self.session_id = session_id
+        self.turns = []
+        # tokenizer name -> OrderedDict of piece key -> token ids
+        self.token_cache = {}
+        self._saved_pieces = {}
+
+    def history(self):
+        """Turns in the `{"role", "content"}` format the chat UI and model manager use"""
+        return [{"role": turn["role"], "content": turn["content"]} for turn in self.turns]
+
+    def _apply(self, record):
+        if record.get("type") == "turn":
+            self.turns.append(record)
+        elif record.get("type") == "tokens":
+            cache = self.token_cache.setdefault(record["tokenizer"], OrderedDict())
+            cache.update(record["pieces"])
+            self._saved_pieces.setdefault(record["tokenizer"], set()).update(record["pieces"])
+
+    def _unsaved_pieces(self):
+        unsaved = {}
+        for tokenizer_name, cache in self.token_cache.items():
+            saved = self._saved_pieces.setdefault(tokenizer_name, set())
+            new = {key: ids for key, ids in list(cache.items()) if key not in saved}
+            if new:
+                unsaved[tokenizer_name] = new
+        return unsaved
+
+
+class SessionStore:
+    def __init__(self, root=CHAT_HISTORY_DIR, max_hot_sessions=MAX_HOT_SESSIONS,
+                 max_age_days=MAX_SESSION_AGE_DAYS, max_total_mb=MAX_HISTORY_MB):
+        """
+        Append-only per-session logs with an LRU of hot sessions
+
+        :param root: Directory holding one `<session>.jsonl` log per session
+        :param max_hot_sessions: Sessions kept in memory
+        :param max_age_days: Sessions untouched for longer are deleted by `compact`
+        :param max_total_mb: Size budget for `root`, enforced by `compact`
+        """
+        self.root = root
+        self.max_hot_sessions = max_hot_sessions
+        self.max_age_days = max_age_days
+        self.max_total_bytes = max_total_mb * 1024 * 1024
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.appends_since_compact = 0
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, session_id):
+        name = session_id if _SAFE_ID_RE.match(session_id) else \
+            hashlib.blake2b(session_id.encode("utf-8"), digest_size=16).hexdigest()
+        return os.path.join(self.root, f"{name}.jsonl")
+
+    def _load(self, session_id):
+        """Rebuild a session from its log: one file read"""
+        session = ChatSession(session_id)
+        try:
+            with open(self._path(session_id), encoding="utf-8") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return session
+        for line in lines:
+            try:
+                session._apply(json.loads(line))
+            except (json.JSONDecodeError, KeyError, TypeError):
+                # A torn final line from a crash mid-write; everything before it is intact
+                continue
+        return session
+
+    def get(self, session_id):
+        """The session with this id, from memory or resumed from disk (empty if new)"""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                self.sessions.move_to_end(session_id)
+                return session
+            session = self._load(session_id)
+            self.sessions[session_id] = session
+            while len(self.sessions) > self.max_hot_sessions:
+                self.sessions.popitem(last=False)
+            return session
+
+    def _write(self, session_id, records):
+        with open(self._path(session_id), "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def append(self, session_id, role, content):
+        """Add one turn to a session and its log"""
+        session = self.get(session_id)
+        record = {"type": "turn", "role": role, "content": content, "ts": time.time()}
+        with self.lock:
+            session.turns.append(record)
+            self._write(session_id, [record])
+            self.appends_since_compact += 1
+            compact = self.appends_since_compact >= COMPACT_EVERY
+        if compact:
+            self.compact()
+
+    def save_tokens(self, session_id):
+        """Persist token-ID cache entries added since the last save"""
+        session = self.get(session_id)
+        with self.lock:
+            unsaved = session._unsaved_pieces()
+            if not unsaved:
+                return
+            self._write(session_id, [
+                {"type": "tokens", "tokenizer": tokenizer_name, "pieces": pieces}
+                for tokenizer_name, pieces in unsaved.items()
+            ])
+            for tokenizer_name, pieces in unsaved.items():
+                session._saved_pieces[tokenizer_name].update(pieces)
+
+    def clear(self, session_id):
+        """Forget a session entirely"""
+        with self.lock:
+            self.sessions.pop(session_id, None)
+            try:
+                os.remove(self._path(session_id))
+            except FileNotFoundError:
+                pass
+
+    def _rewrite(self, path):
+        """Rewrite an oversized log with its recent turns and most recently used cache entries"""
+        session = self._load(os.path.basename(path)[:-len(".jsonl")])
+        records = session.turns[-MAX_TURNS_KEPT:]
+        for tokenizer_name, cache in session.token_cache.items():
+            pieces = dict(list(cache.items())[-MAX_CACHED_PIECES:])
+            records.append({"type": "tokens", "tokenizer": tokenizer_name, "pieces": pieces})
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(temp_path, path)
+
+    def compact(self):
+        """
+        Bound disk usage: delete expired sessions, shrink oversized logs, then
+        delete the least recently written sessions until under the size budget
+
+        :return: dict with counts of deleted and rewritten sessions
+        """
+        stats = {"expired": 0, "rewritten": 0, "evicted": 0}
+        changed = set()
+        with self.lock:
+            self.appends_since_compact = 0
+            cutoff = time.time() - self.max_age_days * 86400
+            logs = []
+            for entry in os.scandir(self.root):
+                if not entry.name.endswith(".jsonl"):
+                    continue
+                try:
+                    info = entry.stat()
+                    if info.st_mtime < cutoff:
+                        os.remove(entry.path)
+                        changed.add(entry.path)
+                        stats["expired"] += 1
+                        continue
+                    if info.st_size > MAX_SESSION_BYTES:
+                        self._rewrite(entry.path)
+                        changed.add(entry.path)
+                        stats["rewritten"] += 1
+                        info = os.stat(entry.path)
+                    logs.append((info.st_mtime, info.st_size, entry.path))
+                except OSError as e:
+                    print(f"Could not compact {entry.path}: {e}")
+
+            total = sum(size for _, size, _ in logs)
+            for _, size, path in sorted(logs):
+                if total <= self.max_total_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    changed.add(path)
+                    total -= size
+                    stats["evicted"] += 1
+                except OSError as e:
+                    print(f"Could not remove {path}: {e}")
+
+            # Dropped or rewritten sessions are re-read from disk on next use
+            for session_id in list(self.sessions):
+                if self._path(session_id) in changed:
+                    del self.sessions[session_id]
+
+        if any(stats.values()):
+            print(f"Chat history compaction: {stats['expired']} expired, {stats['rewritten']} rewritten, "
+                  f"{stats['evicted']} evicted for space")
+        return stats
@@ -0,0 +1,201 @@
+# stub_backend.py - Deterministic stand-in model for load-testing the serving stack
+#
+# A models_config entry with 'backend': 'stub' loads StubCausalLM instead of
+# a transformers model. It needs no weights, no GPU and no download, and
+# "generates" a canned code answer (chosen by hashing the prompt) at a fixed
+# pace, so queueing, streaming, cancellation, HTTP/Gradio and post-processing
+# can be profiled without model compute drowning them out.
+#
+# Entry options (all optional):
+#   'stub_tokens_per_sec': 30     decode speed per row
+#   'stub_ttft': 0.25             seconds before the first token (prefill)
+#   'stub_load_time': 0           seconds spent "loading"
+#   'stub_fail_every': 0          every Nth generate call fails (0: never)
+#   'stub_failure': 'oom'         'oom' (CUDA out-of-memory) or 'error'
+#
+# Usage:
+#   python api_server.py --stub --stub-tokens-per-sec 50
+#   CODEBUDDY_STUB_BACKEND=1 python launcher.py
+
+import time
+import zlib
+import threading
+
+import torch
+
+DEFAULT_TOKENS_PER_SEC = 30
+DEFAULT_TTFT = 0.25
+
+# Canned answers, cycled if a request asks for more tokens than one holds
+RESPONSES = {
+    'python': [
+        "```python\ndef process_items(items):\n    \"\"\"Return the unique items, sorted.\"\"\"\n"
+        "    seen = set()\n    result = []\n    for item in items:\n        if item not in seen:\n"
+        "            seen.add(item)\n            result.append(item)\n    return sorted(result)\n```\n",
+        "```python\nimport csv\n\n\ndef read_rows(path):\n    with open(path, newline='') as f:\n"
+        "        return list(csv.DictReader(f))\n```\n",
+    ],
+    'powershell': [
+        "```powershell\n# List running services\nGet-Service | Where-Object { $_.Status -eq 'Running' } |\n"
+        "    Sort-Object DisplayName |\n    Select-Object Name, DisplayName\n```\n",
+    ],
+}
+
+
+def stub_models_config(languages=('python', 'powershell'), **options):
+    """
+    models_config entries that serve `languages` from the stub backend
+
+    :param options: Stub options without the 'stub_' prefix, e.g. tokens_per_sec=50
+    """
+    config = {'backend': 'stub'}
+    config.update({f'stub_{key}': value for key, value in options.items() if value is not None})
+    return {
+        language: dict(config, model_name=f'codebuddy-stub-{language}', stub_language=language)
+        for language in languages
+    }
+
+
+def stub_tokenizer():
+    """
+    Byte-level tokenizer with the full `transformers` tokenizer API
+
+    Every byte is one token, so token counts are predictable (and pessimistic).
+    """
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+    from transformers import PreTrainedTokenizerFast
+
+    alphabet = pre_tokenizers.ByteLevel.alphabet()
+    vocab = {"<pad>": 0, "<s>": 1, "</s>": 2}
+    vocab.update({symbol: i + 3 for i, symbol in enumerate(sorted(alphabet))})
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, pad_token="<pad>", bos_token="<s>", eos_token="</s>",
+        padding_side='left', truncation_side='left'
+    )
+
+
+class StubConfig:
+    def __init__(self, vocab_size, eos_token_id, pad_token_id):
+        self.vocab_size = vocab_size
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+
+
+class StubCausalLM:
+    def __init__(self, tokenizer, language='python', tokens_per_sec=DEFAULT_TOKENS_PER_SEC, ttft=DEFAULT_TTFT,
+                 fail_every=0, failure='oom'):
+        """
+        Fake causal LM with the `generate` contract of a transformers model
+
+        :param tokenizer: Tokenizer used to encode the canned responses
+        :param language: Which canned responses to emit
+        :param tokens_per_sec: Decode speed per row
+        :param ttft: Seconds before the first token
+        :param fail_every: Every Nth `generate` call raises (0: never)
+        :param failure: 'oom' raises a CUDA out-of-memory error, 'error' a RuntimeError
+        """
+        self.tokenizer = tokenizer
+        self.config = StubConfig(len(tokenizer), tokenizer.eos_token_id, tokenizer.pad_token_id)
+        self.device = torch.device("cpu")
+        self.tokens_per_sec = tokens_per_sec
+        self.ttft = ttft
+        self.fail_every = fail_every
+        self.failure = failure
+        self.responses = [
+            tokenizer(text, add_special_tokens=False)["input_ids"]
+            for text in RESPONSES.get(language, RESPONSES['python'])
+        ]
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def _maybe_fail(self):
+        with self.lock:
+            self.calls += 1
+            calls = self.calls
+        if self.fail_every and calls % self.fail_every == 0:
+            if self.failure == 'oom':
+                error = getattr(torch.cuda, "OutOfMemoryError", RuntimeError)
+                raise error("CUDA out of memory. Tried to allocate 2.00 GiB (injected by stub backend)")
+            raise RuntimeError("Generation failed (injected by stub backend)")
+
+    def _response_for(self, prompt_ids):
+        """Canned token ids for a prompt; the same prompt always gets the same answer"""
+        digest = zlib.crc32(bytes(int(t) % 256 for t in prompt_ids))
+        return self.responses[digest % len(self.responses)]
+
+    def generate(self, input_ids, attention_mask=None, max_new_tokens=20, min_new_tokens=0, pad_token_id=None,
+                 eos_token_id=None, streamer=None, stopping_criteria=None, **unused):
+        """
+        Emit canned tokens at the configured pace
+
+        Honors `streamer` and `stopping_criteria` (so cancellation works) and
+        ends each row with EOS once its answer is complete, unless
+        `min_new_tokens` asks for more.
+        """
+        self._maybe_fail()
+        input_ids = input_ids.cpu()
+        eos_token_id = self.config.eos_token_id if eos_token_id is None else eos_token_id
+        pad_token_id = self.config.pad_token_id if pad_token_id is None else pad_token_id
+        mask = torch.ones_like(input_ids) if attention_mask is None else attention_mask.cpu()
+        answers = [self._response_for(row[m.bool()].tolist()) for row, m in zip(input_ids, mask)]
+
+        if streamer is not None:
+            streamer.put(input_ids)
+        time.sleep(self.ttft)
+        started = time.perf_counter()
+        unfinished = torch.ones(input_ids.shape[0], dtype=torch.bool)
+        for step in range(max_new_tokens):
+            next_tokens = []
+            for answer in answers:
+                if step < len(answer):
+                    next_tokens.append(answer[step])
+                elif step == len(answer) and step >= min_new_tokens:
+                    next_tokens.append(eos_token_id)
+                else:
+                    next_tokens.append(answer[step % len(answer)])
+            next_tokens = torch.tensor(next_tokens, dtype=input_ids.dtype)
+            next_tokens = torch.where(unfinished, next_tokens, torch.full_like(next_tokens, pad_token_id))
+            input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+
+            # Pace against the start time so per-token overhead does not accumulate
+            delay = started + (step + 1) / self.tokens_per_sec - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if streamer is not None:
+                streamer.put(next_tokens)
+
+            unfinished &= next_tokens != eos_token_id
+            if stopping_criteria:
+                scores = torch.zeros(input_ids.shape[0], self.config.vocab_size)
+                unfinished &= ~torch.as_tensor(stopping_criteria(input_ids, scores), dtype=torch.bool)
+            if not unfinished.any():
+                break
+
+        if streamer is not None:
+            streamer.end()
+        return input_ids
+
+
+def load_stub_model(model_config):
+    """
+    Build the stub model and tokenizer for a models_config entry
+
+    :return: (StubCausalLM, tokenizer)
+    """
+    load_time = model_config.get('stub_load_time', 0)
+    if load_time:
+        print(f"Stub backend: simulating a {load_time}s model load")
+        time.sleep(load_time)
+    tokenizer = stub_tokenizer()
+    model = StubCausalLM(
+        tokenizer,
+        language=model_config.get('stub_language', 'python'),
+        tokens_per_sec=model_config.get('stub_tokens_per_sec', DEFAULT_TOKENS_PER_SEC),
+        ttft=model_config.get('stub_ttft', DEFAULT_TTFT),
+        fail_every=model_config.get('stub_fail_every', 0),
+        failure=model_config.get('stub_failure', 'oom'),
+    )
+    return model, tokenizer
@@ -0,0 +1,88 @@
+# Parity of the ONNX Runtime backend with the PyTorch path on a tiny random Llama
+
+import pytest
+import torch
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("onnx")
+
+from transformers import LlamaForCausalLM
+from transformers.generation.streamers import BaseStreamer
+
+from benchmark import tiny_llama_config
+from stub_backend import stub_tokenizer
+from onnx_backend import load_onnx_model, PROMPTS
+
+MAX_NEW_TOKENS = 16
+
+
+class CollectingStreamer(BaseStreamer):
+    def __init__(self):
+        self.chunks = []
+        self.ended = False
+
+    def put(self, value):
+        self.chunks.append(value.clone())
+
+    def end(self):
+        self.ended = True
+
+
+@pytest.fixture(scope="module")
+def models(tmp_path_factory):
+    """(tokenizer, PyTorch model, fp32 ONNX model) from one saved tiny checkpoint"""
+    model_dir = str(tmp_path_factory.mktemp("tiny-llama"))
+    tokenizer = stub_tokenizer()
+    torch.manual_seed(0)
+    reference = LlamaForCausalLM(tiny_llama_config(vocab_size=len(tokenizer))).eval()
+    reference.save_pretrained(model_dir)
+    tokenizer.save_pretrained(model_dir)
+    onnx_model = load_onnx_model(model_dir, str(tmp_path_factory.mktemp("cache")), quantize=False)
+    return tokenizer, reference, onnx_model
+
+
+def _greedy(model, tokenizer, inputs, **kwargs):
+    with torch.no_grad():
+        return model.generate(**inputs, max_new_tokens=MAX_NEW_TOKENS, do_sample=False,
+                              pad_token_id=tokenizer.pad_token_id, **kwargs)
+
+
+@pytest.mark.parametrize("prompt", PROMPTS)
+def test_prefill_logits_match(models, prompt):
+    tokenizer, reference, onnx_model = models
+    inputs = tokenizer(prompt, return_tensors="pt")
+    with torch.no_grad():
+        torch_logits = reference(**inputs).logits
+    position_ids = torch.arange(inputs["input_ids"].shape[1]).unsqueeze(0)
+    onnx_logits, _ = onnx_model.forward(inputs["input_ids"], inputs["attention_mask"], position_ids)
+    assert (torch_logits - torch.from_numpy(onnx_logits)).abs().max().item() < 1e-4
+
+
+@pytest.mark.parametrize("prompt", PROMPTS)
+def test_greedy_tokens_match(models, prompt):
+    tokenizer, reference, onnx_model = models
+    inputs = tokenizer(prompt, return_tensors="pt")
+    assert torch.equal(_greedy(onnx_model, tokenizer, inputs), _greedy(reference, tokenizer, inputs))
+
+
+def test_left_padded_batch_matches(models):
+    tokenizer, reference, onnx_model = models
+    inputs = tokenizer(PROMPTS, return_tensors="pt", padding=True)
+    assert tokenizer.padding_side == "left"
+    assert (inputs["attention_mask"] == 0).any()
+    assert torch.equal(_greedy(onnx_model, tokenizer, inputs), _greedy(reference, tokenizer, inputs))
+
+
+def test_streamer_receives_generated_tokens(models):
+    tokenizer, reference, onnx_model = models
+    inputs = tokenizer(PROMPTS[0], return_tensors="pt")
+    torch_streamer, onnx_streamer = CollectingStreamer(), CollectingStreamer()
+    torch_ids = _greedy(reference, tokenizer, inputs, streamer=torch_streamer)
+    onnx_ids = _greedy(onnx_model, tokenizer, inputs, streamer=onnx_streamer)
+
+    assert onnx_streamer.ended
+    assert torch.equal(onnx_streamer.chunks[0], inputs["input_ids"])
+    streamed = torch.cat([chunk.reshape(-1) for chunk in onnx_streamer.chunks[1:]])
+    assert torch.equal(streamed, onnx_ids[0, inputs["input_ids"].shape[1]:])
+    assert torch.equal(streamed, torch.cat([chunk.reshape(-1) for chunk in torch_streamer.chunks[1:]]))
+    assert torch.equal(onnx_ids, torch_ids)
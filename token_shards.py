@@ -0,0 +1,239 @@
+# token_shards.py - Pre-tokenized, memory-mapped training shards with a fingerprint cache
+
+import os
+import json
+import shutil
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from torch.utils.data import Dataset as TorchDataset
+
+from dataset_builder import format_conversation, load_snapshot
+from sequence_packing import plan_packing, build_packed_row
+
+# Bump when the on-disk shard layout changes
+SHARD_FORMAT_VERSION = 1
+
+# Number of fingerprinted shard sets kept in the cache (newest first)
+KEEP_SHARD_SETS = 2
+
+TOKENIZE_BATCH_SIZE = 1000
+
+# Worker start-up (importing torch and transformers) costs seconds, so each
+# worker should have at least this many rows to tokenize
+MIN_ROWS_PER_WORKER = 20000
+
+# Rendered with placeholder content so any change to the template changes the fingerprint
+_TEMPLATE_PROBE = [
+    {"role": "user", "content": "<instruction>"},
+    {"role": "assistant", "content": "<response>"},
+]
+
+
+def tokenizer_fingerprint(tokenizer):
+    """Hash everything about a tokenizer that affects the token IDs it produces"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(type(tokenizer).__name__.encode("utf-8"))
+    digest.update(str(getattr(tokenizer, "name_or_path", "")).encode("utf-8"))
+    digest.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode("utf-8"))
+    digest.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode("utf-8"))
+    digest.update(repr(tokenizer("a\nb c", add_special_tokens=True)["input_ids"]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def shard_fingerprint(tokenizer, max_length, snapshot_path):
+    """
+    Key for a set of token shards
+
+    :param tokenizer: Tokenizer used to produce the shards
+    :param max_length: Truncation length
+    :param snapshot_path: Versioned dataset snapshot the shards were built from
+    """
+    digest = hashlib.blake2b(digest_size=12)
+    for part in (
+        f"format:{SHARD_FORMAT_VERSION}",
+        f"tokenizer:{tokenizer_fingerprint(tokenizer)}",
+        f"template:{format_conversation(_TEMPLATE_PROBE)}",
+        f"max_length:{max_length}",
+        f"dataset:{os.path.basename(snapshot_path)}",
+    ):
+        digest.update(part.encode("utf-8") + b"\0")
+    return digest.hexdigest()
+
+
+def tokenize_range(snapshot_path, start, end, tokenizer, max_length, shard_prefix):
+    """
+    Tokenize rows [start, end) of a snapshot into one shard
+
+    Runs in a worker process. Writes `<prefix>.tokens.npy` (flat int32 token
+    IDs) and `<prefix>.offsets.npy` (int64, one more entry than rows).
+
+    :return: Number of rows written
+    """
+    # Each worker is already one of num_proc processes; avoid nested thread pools
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+    dataset = load_snapshot(snapshot_path)
+    chunks = []
+    offsets = [0]
+    for batch_start in range(start, end, TOKENIZE_BATCH_SIZE):
+        batch = dataset[batch_start:min(batch_start + TOKENIZE_BATCH_SIZE, end)]
+        prompts = [format_conversation(messages) for messages in batch["messages"]]
+        for ids in tokenizer(prompts, truncation=True, max_length=max_length)["input_ids"]:
+            chunks.append(np.asarray(ids, dtype=np.int32))
+            offsets.append(offsets[-1] + len(ids))
+
+    tokens = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int32)
+    np.save(shard_prefix + ".tokens.npy", tokens)
+    np.save(shard_prefix + ".offsets.npy", np.asarray(offsets, dtype=np.int64))
+    return end - start
+
+
+class TokenShardCache:
+    def __init__(self, cache_dir, tokenizer, max_length=1024, num_proc=None):
+        """
+        Build and reuse token shards keyed by tokenizer, template, max length and dataset version
+
+        :param cache_dir: Root directory for shard sets
+        :param tokenizer: Tokenizer to encode with
+        :param max_length: Truncation length
+        :param num_proc: Number of tokenization worker processes
+        """
+        self.cache_dir = cache_dir
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.num_proc = num_proc or max(1, (os.cpu_count() or 2) // 2)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def build(self, snapshot_path):
+        """
+        Return the shard directory for `snapshot_path`, tokenizing only on a cache miss
+
+        :param snapshot_path: Arrow snapshot from `DatasetBuilder.build`
+        :return: Path to a directory readable by `TokenShardDataset`
+        """
+        fingerprint = shard_fingerprint(self.tokenizer, self.max_length, snapshot_path)
+        shard_dir = os.path.join(self.cache_dir, fingerprint)
+        if os.path.exists(os.path.join(shard_dir, "meta.json")):
+            print(f"Token shards {fingerprint} are up to date, skipping tokenization")
+            os.utime(shard_dir)  # mark as recently used for pruning
+            return shard_dir
+
+        num_rows = len(load_snapshot(snapshot_path))
+        num_shards = max(1, min(self.num_proc, num_rows // MIN_ROWS_PER_WORKER))
+        bounds = np.linspace(0, num_rows, num_shards + 1, dtype=np.int64)
+
+        tmp_dir = shard_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        print(f"Tokenizing {num_rows} examples into {num_shards} shards "
+              f"with {min(self.num_proc, num_shards)} processes...")
+        jobs = [
+            (snapshot_path, int(bounds[i]), int(bounds[i + 1]), self.tokenizer, self.max_length,
+             os.path.join(tmp_dir, f"shard-{i:05d}"))
+            for i in range(num_shards)
+        ]
+        if num_shards == 1:
+            tokenize_range(*jobs[0])
+        else:
+            with ProcessPoolExecutor(
+                max_workers=min(self.num_proc, num_shards),
+                mp_context=multiprocessing.get_context('spawn')  # Avoid fork issues
+            ) as pool:
+                for future in [pool.submit(tokenize_range, *job) for job in jobs]:
+                    future.result()
+
+        # meta.json is written last; its presence marks a complete shard set
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "format": SHARD_FORMAT_VERSION,
+                "num_rows": num_rows,
+                "num_shards": num_shards,
+                "max_length": self.max_length,
+                "snapshot": os.path.basename(snapshot_path),
+            }, f)
+        shutil.rmtree(shard_dir, ignore_errors=True)
+        os.replace(tmp_dir, shard_dir)
+
+        self._prune(shard_dir)
+        return shard_dir
+
+    def _prune(self, current):
+        shard_sets = sorted(
+            (os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+             if not name.endswith(".tmp")),
+            key=os.path.getmtime,
+            reverse=True
+        )
+        keep = {current}
+        keep.update([p for p in shard_sets if p != current][:KEEP_SHARD_SETS - 1])
+        for path in shard_sets:
+            if path not in keep:
+                shutil.rmtree(path, ignore_errors=True)
+
+
+class TokenShardDataset(TorchDataset):
+    def __init__(self, shard_dir):
+        """
+        Read-only view over a shard set; examples are zero-copy slices of memory-mapped arrays
+
+        :param shard_dir: Directory returned by `TokenShardCache.build`
+        """
+        with open(os.path.join(shard_dir, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+
+        self.tokens = []
+        self.offsets = []
+        for i in range(self.meta["num_shards"]):
+            prefix = os.path.join(shard_dir, f"shard-{i:05d}")
+            self.tokens.append(np.load(prefix + ".tokens.npy", mmap_mode="r"))
+            self.offsets.append(np.load(prefix + ".offsets.npy", mmap_mode="r"))
+
+        # Global row index -> shard via cumulative row counts
+        self.row_starts = np.cumsum([0] + [len(o) - 1 for o in self.offsets])
+
+    def __len__(self):
+        return int(self.row_starts[-1])
+
+    def get_tokens(self, index):
+        shard = int(np.searchsorted(self.row_starts, index, side="right")) - 1
+        row = index - self.row_starts[shard]
+        offsets = self.offsets[shard]
+        return self.tokens[shard][offsets[row]:offsets[row + 1]]
+
+    def __getitem__(self, index):
+        return {"input_ids": self.get_tokens(index)}
+
+    @property
+    def lengths(self):
+        """Token count of every row, read from the offsets only"""
+        return np.concatenate([np.diff(o) for o in self.offsets])
+
+
+class PackedTokenDataset(TorchDataset):
+    def __init__(self, shards, max_length, eos_token_id):
+        """
+        Packed rows assembled on the fly from a `TokenShardDataset`
+
+        Packing is planned from the shard offsets alone, so no token is read
+        until the dataloader asks for a row.
+
+        :param shards: Source `TokenShardDataset`
+        :param max_length: Length of a packed row
+        :param eos_token_id: Token appended to every conversation
+        """
+        self.shards = shards
+        self.max_length = max_length
+        self.eos_token_id = eos_token_id
+        # +1 for the EOS appended to every conversation
+        self.rows = plan_packing([int(n) + 1 for n in shards.lengths], max_length)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        sequences = [self.shards.get_tokens(i) for i in self.rows[index]]
+        return build_packed_row(sequences, self.max_length, self.eos_token_id)